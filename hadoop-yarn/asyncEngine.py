@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+# Description:
+#   asyncio backend to run commands and existing Fabric tasks on thousands
+#   of hosts from a single process (Python 3 only).
+#
+#   Fabric's @parallel forks a process per host, which runs the control node
+#   out of memory and file descriptors past a few hundred hosts. Here every
+#   command is an ssh subprocess multiplexed over the SSHConnectionPool
+#   master connection of its host, driven by one event loop, with at most
+#   maxConcurrency of them in flight.
+#
+#   Existing tasks run unchanged through AsyncSSHEngine.executeTask(), the
+#   equivalent of Fabric's execute(): each host gets a thread in which env
+#   (host_string, cd(), settings()...) is private to that thread, and
+#   run/sudo/put in the given modules are rebound to go through the engine
+#   while the task runs.
+#
+#   Usage:
+#       engine = AsyncSSHEngine(SSHConnectionPool(), maxConcurrency=512)
+#       results = engine.runOnHosts("uptime", hosts)
+#       privateIps = engine.executeTask(getPrivateIp, hosts=hosts)
+
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fabric.api import env, abort
+from fabric.network import normalize
+import sshPool
+from sshPool import FabricOperations, usePool, restoreBindings
+
+_local = threading.local()
+_DELETED = object()
+
+
+class EngineError(Exception):
+    pass
+
+
+class AsyncSSHEngine(object):
+    def __init__(self, pool, maxConcurrency=256, maxChannelsPerHost=8, modules=()):
+        self.pool = pool
+        self.maxConcurrency = maxConcurrency
+        self.maxChannelsPerHost = maxChannelsPerHost
+        # Modules whose run/sudo/put are rebound while executeTask() runs
+        self.modules = list(modules)
+        self.operations = _EngineOperations(self)
+        self.masters = set()
+        self.masterLocks = {}
+        self.hostSemaphores = {}
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.call(self._setup())
+
+    async def _setup(self):
+        # Created from inside the loop, which older Pythons bind them to
+        self.semaphore = asyncio.Semaphore(self.maxConcurrency)
+
+    def call(self, coroutine):
+        """Runs coroutine in the engine's loop and waits for its result. Safe
+        to call from any thread but the loop's."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def execute(self, hostString, command, stdin=None):
+        """Runs command on hostString. Returns (returnCode, stdout, stderr)."""
+        args = self.pool.sshArgs(hostString)
+        if hostString not in self.hostSemaphores:
+            self.hostSemaphores[hostString] = asyncio.Semaphore(self.maxChannelsPerHost)
+
+        async with self.hostSemaphores[hostString]:
+            async with self.semaphore:
+                await self._ensureMaster(hostString, args)
+                process = await asyncio.create_subprocess_exec(
+                    *(args + [command]),
+                    stdin=asyncio.subprocess.PIPE if stdin is not None else asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+                stdout, stderr = await process.communicate(stdin)
+        sshPool._record(args[-1], channels=1)
+        return (process.returncode, stdout.decode('utf-8', 'replace'),
+                stderr.decode('utf-8', 'replace'))
+
+    async def _ensureMaster(self, hostString, args):
+        if hostString not in self.masterLocks:
+            self.masterLocks[hostString] = asyncio.Lock()
+        async with self.masterLocks[hostString]:
+            if hostString in self.masters:
+                return
+            if await self._ssh(args[:-1] + ["-O", "check", args[-1]]) != 0:
+                start = time.time()
+                if await self._ssh(args[:-1] + ["-M", "-f", "-N", "-o",
+                                                "ControlPersist=%d" % self.pool.persistSeconds,
+                                                args[-1]]) != 0:
+                    raise EngineError("Could not connect to %s" % hostString)
+                sshPool._record(args[-1], handshakes=1, connectSeconds=time.time() - start)
+            # So that the pool closes it at exit
+            self.pool.prepare([hostString])
+            self.masters.add(hostString)
+
+    async def _ssh(self, args):
+        process = await asyncio.create_subprocess_exec(
+            *args, stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        return await process.wait()
+
+    def runOnHosts(self, command, hosts):
+        """Runs command on every host. Returns {host: (returnCode, stdout,
+        stderr)}, or {host: EngineError} for the hosts it couldn't reach."""
+        async def runAll():
+            results = await asyncio.gather(
+                *[self.execute(host, command) for host in hosts],
+                return_exceptions=True)
+            return dict(zip(hosts, results))
+        return self.call(runAll())
+
+    def executeTask(self, task, *args, **kwargs):
+        """Like Fabric's execute(): runs task on every host (env.hosts unless
+        hosts= is given) and returns {host: return value}. Aborts after all
+        hosts are done if the task failed on any of them."""
+        hosts = kwargs.pop("hosts", None) or env.hosts
+        _installThreadLocalEnv()
+
+        results = {}
+        errors = {}
+        previous = usePool(self.operations, self.modules)
+        try:
+            workers = max(1, min(len(hosts), self.maxConcurrency))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = dict((executor.submit(_runTask, task, host, args, kwargs), host)
+                               for host in hosts)
+                for future in as_completed(futures):
+                    try:
+                        results[futures[future]] = future.result()
+                    except (Exception, SystemExit) as e:
+                        errors[futures[future]] = e
+        finally:
+            restoreBindings(previous)
+
+        if errors:
+            abort("%s failed on %d of %d hosts:\n%s" % (
+                getattr(task, "__name__", task), len(errors), len(hosts),
+                "\n".join("%s: %s" % (host, errors[host]) for host in sorted(errors))))
+        return results
+
+
+class _EngineOperations(FabricOperations):
+    # run/sudo/put for the tasks executeTask() runs
+    def __init__(self, engine):
+        self.engine = engine
+
+    def execute(self, hostString, command, stdin=None):
+        return self.engine.call(self.engine.execute(hostString, command, stdin))
+
+
+def _runTask(task, host, args, kwargs):
+    user, hostname, port = normalize(host)
+    _local.overlay = {"host_string": host, "host": hostname, "user": user,
+                      "port": str(port)}
+    try:
+        return task(*args, **kwargs)
+    finally:
+        _local.overlay = None
+
+
+class _ThreadLocalEnvMixin(object):
+    # Reads and writes go to the current thread's overlay when it has one,
+    # so that concurrent tasks each see their own host, cd() and settings()
+
+    def _overlay(self):
+        return getattr(_local, "overlay", None)
+
+    def __getitem__(self, key):
+        overlay = self._overlay()
+        if overlay is not None and key in overlay:
+            if overlay[key] is _DELETED:
+                raise KeyError(key)
+            return overlay[key]
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        overlay = self._overlay()
+        if overlay is not None:
+            overlay[key] = value
+        else:
+            dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        overlay = self._overlay()
+        if overlay is not None:
+            if key not in self:
+                raise KeyError(key)
+            overlay[key] = _DELETED
+        else:
+            dict.__delitem__(self, key)
+
+    def __contains__(self, key):
+        overlay = self._overlay()
+        if overlay is not None and key in overlay:
+            return overlay[key] is not _DELETED
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+
+def _installThreadLocalEnv():
+    # env is shared by reference by every module that imported it, so its
+    # class is swapped in place rather than the object being replaced (and
+    # through object.__setattr__, as env's own __setattr__ sets a key)
+    if not isinstance(env, _ThreadLocalEnvMixin):
+        object.__setattr__(env, "__class__", type(
+            "ThreadLocalEnv", (_ThreadLocalEnvMixin, type(env)), {}))
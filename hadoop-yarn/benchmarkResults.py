@@ -0,0 +1,209 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+# Description:
+#   Parses the output of the Hadoop benchmarks (TestDFSIO, TeraGen/TeraSort/
+#   TeraValidate, NNBench, MRBench) into JSON records, stores them on the
+#   control node and compares each run with the previous one of the same
+#   benchmark. Also summarizes repeated runs of a workload, to rank config
+#   variants by their runtimes.
+#
+#   A record holds the benchmark name, when it ran, the hash of the cluster's
+#   configuration, the parameters it ran with, its metrics (numbers, e.g.
+#   throughput or latency) and the counters of its MapReduce jobs.
+#
+#   Usage:
+#       store = BenchmarkStore("~/.cache/benchmarks")
+#       record = benchmarkRecord("dfsio-write", {"files": 8}, configHash,
+#                                durationSeconds, parseTestDFSIO(output),
+#                                parseCounters(output))
+#       previous = store.previous("dfsio-write")
+#       store.save(record)
+#       print(formatComparison(record, previous))
+
+import os
+import re
+import json
+import math
+import time
+
+COUNTER_GROUP_RE = re.compile(r'^\s+([A-Za-z][^=]*[^=\s])\s*$')
+COUNTER_RE = re.compile(r'^\s+([^=]+?)=(-?\d+)\s*$')
+NUMBER_RE = re.compile(r'^-?\d+(\.\d+)?([eE][-+]?\d+)?$')
+
+
+def _number(value):
+    value = value.strip()
+    if NUMBER_RE.match(value):
+        return float(value) if "." in value or "e" in value.lower() else int(value)
+    return None
+
+
+def _metricName(name):
+    # "Average IO rate mb/sec" -> "average_io_rate_mb_sec"
+    return re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_')
+
+
+def parseLoggedValues(output, logger):
+    """{metric: number} for the "<logger>: <name>: <number>" lines that
+    TestDFSIO and NNBench log their results with."""
+    metrics = {}
+    for line in output.splitlines():
+        _, found, rest = line.partition("%s: " % logger)
+        if not found or ": " not in rest:
+            continue
+        name, _, value = rest.strip().rpartition(": ")
+        number = _number(value)
+        if number is not None and name:
+            metrics[_metricName(name)] = number
+    return metrics
+
+
+def parseTestDFSIO(output):
+    return parseLoggedValues(output, "TestDFSIO")
+
+
+def parseNNBench(output):
+    return parseLoggedValues(output, "NNBench")
+
+
+def parseMRBench(output):
+    """MRBench ends with a header line and a line of tab separated values,
+    the last one being the average job time in milliseconds."""
+    lines = [line.strip() for line in output.splitlines() if line.strip()]
+    for index, line in enumerate(lines[:-1]):
+        if line.startswith("DataLines") and "AvgTime" in line:
+            values = lines[index + 1].split()
+            if len(values) >= 4:
+                return {"data_lines": _number(values[0]), "maps": _number(values[1]),
+                        "reduces": _number(values[2]), "average_job_ms": _number(values[3])}
+    return {}
+
+
+def parseCounters(output):
+    """{"Group: Counter": value} for the counters that MapReduce prints
+    when a job finishes. Later jobs in output overwrite earlier ones."""
+    counters = {}
+    group = None
+    inCounters = False
+    for line in output.splitlines():
+        if re.search(r'Counters: \d+\s*$', line):
+            inCounters = True
+            group = None
+            continue
+        if not inCounters:
+            continue
+        counter = COUNTER_RE.match(line)
+        if counter and group:
+            counters["%s: %s" % (group, counter.group(1).strip())] = int(counter.group(2))
+            continue
+        groupMatch = COUNTER_GROUP_RE.match(line)
+        if groupMatch:
+            group = groupMatch.group(1)
+        else:
+            inCounters = False
+    return counters
+
+
+def benchmarkRecord(name, parameters, configHash, durationSeconds, metrics, counters=None):
+    metrics = dict(metrics)
+    metrics["duration_seconds"] = round(durationSeconds, 3)
+    return {
+        "benchmark": name,
+        "timestamp": time.time(),
+        "configHash": configHash,
+        "parameters": parameters,
+        "metrics": metrics,
+        "counters": counters or {},
+    }
+
+
+class BenchmarkStore(object):
+    """One JSON file per run under directory."""
+
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+
+    def save(self, record):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fileName = os.path.join(self.directory, "%s-%s.json" % (
+            time.strftime("%Y%m%d-%H%M%S", time.localtime(record["timestamp"])),
+            record["benchmark"]))
+        with open(fileName, "w") as f:
+            json.dump(record, f, indent=2, sort_keys=True)
+        return fileName
+
+    def records(self, name=None):
+        """Stored records (of benchmark name only, if given), oldest first."""
+        if not os.path.isdir(self.directory):
+            return []
+        records = []
+        for fileName in os.listdir(self.directory):
+            if not fileName.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, fileName)) as f:
+                    record = json.load(f)
+            except ValueError:
+                continue
+            if name is None or record.get("benchmark") == name:
+                records.append(record)
+        return sorted(records, key=lambda record: record["timestamp"])
+
+    def previous(self, name):
+        records = self.records(name)
+        return records[-1] if records else None
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of values, e.g. fraction=0.95 for p95."""
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(fraction * len(ordered))) - 1)]
+
+
+def summarizeRuns(durations):
+    """Median, p95, mean and (sample) variance of the durations of the runs
+    of a workload."""
+    mean = sum(durations) / float(len(durations))
+    variance = (sum((duration - mean) ** 2 for duration in durations) / (len(durations) - 1)
+                if len(durations) > 1 else 0.0)
+    ordered = sorted(durations)
+    median = (ordered[(len(ordered) - 1) // 2] + ordered[len(ordered) // 2]) / 2.0
+    return {"runs": len(durations), "median": median,
+            "p95": percentile(durations, 0.95), "mean": mean, "variance": variance}
+
+
+def formatRanking(summaries):
+    """Table of {variant: summarizeRuns()} ranked by median, then p95,
+    runtime."""
+    ranked = sorted(summaries.items(), key=lambda item: (item[1]["median"], item[1]["p95"]))
+    lines = ["%-4s %-30s %5s %10s %10s %10s %10s" % ("Rank", "Variant", "Runs", "Median (s)",
+                                                   "p95 (s)", "Mean (s)", "Variance")]
+    for rank, (variant, summary) in enumerate(ranked, 1):
+        lines.append("%-4d %-30s %5d %10.1f %10.1f %10.1f %10.2f" % (
+            rank, variant, summary["runs"], summary["median"], summary["p95"],
+            summary["mean"], summary["variance"]))
+    return "\n".join(lines)
+
+
+def formatComparison(record, previous):
+    """Table of the metrics of record next to those of previous."""
+    lines = ["%s (config %s)" % (record["benchmark"], record["configHash"][:12])]
+    if previous is None:
+        lines.append("  No previous run to compare with")
+    elif previous["configHash"] != record["configHash"]:
+        lines.append("  The configuration changed since the previous run (%s, config %s)" % (
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(previous["timestamp"])),
+            previous["configHash"][:12]))
+    lines.append("  %-40s %15s %15s %9s" % ("Metric", "Previous", "Current", "Change"))
+    for metric in sorted(record["metrics"]):
+        current = record["metrics"][metric]
+        before = (previous or {}).get("metrics", {}).get(metric)
+        if before:
+            change = "%+.1f%%" % (100.0 * (current - before) / before)
+        else:
+            change = "-"
+        lines.append("  %-40s %15s %15s %9s" % (
+            metric, before if before is not None else "-", current, change))
+    return "\n".join(lines)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+# Description:
+#   Cluster state as reported by the daemons themselves, through the
+#   NameNode/DataNode JMX servlets and the ResourceManager/NodeManager REST
+#   APIs, for tasks that have to wait until the cluster is healthy again
+#   (e.g. between the batches of a rolling restart).
+#
+#   The HTTP requests are made with wget from probeHost, a cluster host, as
+#   the web ports usually aren't reachable from the control node.
+#
+#   Usage:
+#       health = ClusterHealth(NAMENODE_HOST,
+#                              namenodes={"nn1": "10.0.0.1:50070", ...},
+#                              resourcemanagers={"rm1": "10.0.0.1:8088", ...})
+#       health.waitFor("DataNodes to register",
+#                      lambda: health.liveDataNodes() >= 10, timeout=300)
+
+import json
+import math
+import time
+from fabric.api import run, settings, hide
+
+DATANODE_HTTP_PORT = 50075
+NODEMANAGER_HTTP_PORT = 8042
+
+
+class HealthError(Exception):
+    pass
+
+
+class ClusterHealth(object):
+    def __init__(self, probeHost, namenodes, resourcemanagers, pollSeconds=5):
+        self.probeHost = probeHost
+        self.namenodes = namenodes
+        self.resourcemanagers = resourcemanagers
+        self.pollSeconds = pollSeconds
+
+    def get(self, url):
+        """Returns the decoded JSON document at url, or None if it couldn't
+        be fetched."""
+        # Standby ResourceManagers redirect to the active one, which would
+        # make them look active
+        with settings(hide('running', 'stdout', 'stderr', 'warnings'),
+                      host_string=self.probeHost, warn_only=True):
+            result = run("wget -qO- --max-redirect=0 --timeout=10 --tries=1 '%s'" % url)
+        if result.failed:
+            return None
+        try:
+            return json.loads(str(result))
+        except ValueError:
+            return None
+
+    def jmx(self, address, query):
+        document = self.get("http://%s/jmx?qry=%s" % (address, query))
+        if not document or not document.get("beans"):
+            return None
+        return document["beans"][0]
+
+    def namenodeState(self, namenodeId):
+        """"active", "standby" or None if the NameNode isn't up."""
+        bean = self.jmx(self.namenodes[namenodeId], "Hadoop:service=NameNode,name=NameNodeStatus")
+        return bean.get("State") if bean else None
+
+    def activeNamenode(self):
+        for namenodeId in sorted(self.namenodes):
+            if self.namenodeState(namenodeId) == "active":
+                return namenodeId
+        return None
+
+    def resourcemanagerState(self, resourcemanagerId):
+        """"ACTIVE", "STANDBY" or None if the ResourceManager isn't up."""
+        document = self.get("http://%s/ws/v1/cluster/info" % self.resourcemanagers[resourcemanagerId])
+        if not document:
+            return None
+        return document.get("clusterInfo", {}).get("haState")
+
+    def activeResourcemanager(self):
+        for resourcemanagerId in sorted(self.resourcemanagers):
+            if self.resourcemanagerState(resourcemanagerId) == "ACTIVE":
+                return resourcemanagerId
+        return None
+
+    def liveDataNodes(self):
+        """Number of live DataNodes according to the active NameNode."""
+        active = self.activeNamenode()
+        if active is None:
+            return 0
+        bean = self.jmx(self.namenodes[active], "Hadoop:service=NameNode,name=FSNamesystemState")
+        return int(bean.get("NumLiveDataNodes", 0)) if bean else 0
+
+    def activeNodeManagers(self):
+        """Number of active NodeManagers according to the active
+        ResourceManager."""
+        active = self.activeResourcemanager()
+        if active is None:
+            return 0
+        document = self.get("http://%s/ws/v1/cluster/metrics" % self.resourcemanagers[active])
+        if not document:
+            return 0
+        return int(document.get("clusterMetrics", {}).get("activeNodes", 0))
+
+    def dataNodeRegistered(self, host):
+        """True once the DataNode on host is up and registered with every
+        NameNode."""
+        bean = self.jmx("%s:%d" % (host, DATANODE_HTTP_PORT),
+                        "Hadoop:service=DataNode,name=DataNodeInfo")
+        if not bean:
+            return False
+        try:
+            actors = json.loads(bean.get("BPServiceActorInfo") or "[]")
+        except ValueError:
+            return False
+        return len(actors) >= len(self.namenodes) and \
+            all(actor.get("ActorState") == "RUNNING" for actor in actors)
+
+    def nodeManagerRegistered(self, host, since):
+        """True once the NodeManager on host has reported to the active
+        ResourceManager as RUNNING after since (a timestamp)."""
+        document = self.get("http://%s:%d/ws/v1/node/info" % (host, NODEMANAGER_HTTP_PORT))
+        active = self.activeResourcemanager()
+        if not document or active is None:
+            return False
+        hostName = document.get("nodeInfo", {}).get("nodeHostName")
+
+        nodes = self.get("http://%s/ws/v1/cluster/nodes" % self.resourcemanagers[active])
+        if not nodes or not nodes.get("nodes"):
+            return False
+        return any(node.get("nodeHostName") == hostName and node.get("state") == "RUNNING" and
+                   node.get("lastHealthUpdate", 0) >= since * 1000
+                   for node in nodes["nodes"].get("node", []))
+
+    def waitFor(self, description, check, timeout):
+        """Polls check() until it returns True, or raises HealthError after
+        timeout seconds."""
+        deadline = time.time() + timeout
+        print("Waiting for %s" % description)
+        while not check():
+            if time.time() > deadline:
+                raise HealthError("Timed out after %ds waiting for %s" % (timeout, description))
+            time.sleep(self.pollSeconds)
+
+
+def requiredUp(count, minCapacity):
+    # How many of count hosts must stay up to keep minCapacity (a fraction)
+    return int(math.ceil(minCapacity * count))
+
+
+def planBatches(hosts, batchSize, minCapacity):
+    """Splits hosts into batches that can be down at the same time while
+    keeping at least minCapacity (a fraction) of them up."""
+    maxDown = len(hosts) - requiredUp(len(hosts), minCapacity)
+    if hosts and maxDown < 1:
+        raise HealthError("Restarting any of the %d hosts would leave less than %d%% of them up"
+                          % (len(hosts), 100 * minCapacity))
+    size = max(1, min(batchSize, maxDown))
+    return [hosts[i:i + size] for i in range(0, len(hosts), size)]
@@ -0,0 +1,118 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+# Description:
+#   Which hosts play which role in the cluster, and in which rack each host
+#   is. Everything that depends on the layout (the ZooKeeper ensemble and
+#   myids, the JournalNode quorum, the HA NameNode and ResourceManager ids,
+#   the rack mapping used by Hadoop's topology script) is derived from it
+#   instead of from fixed positions in the host lists.
+#
+#   Usage:
+#       topology = ClusterTopology({
+#           "namenode": ["nn-a", "nn-b"],
+#           "resourcemanager": ["nn-a", "nn-b"],
+#           "zookeeper": ["nn-a", "nn-b", "worker-1"],
+#           "journalnode": ["nn-a", "nn-b", "worker-1"],
+#       }, racks={"nn-a": "/rack1", "nn-b": "/rack2"})
+#       topology.zookeeperServers()  # {"server.1": "nn-a:2888:3888", ...}
+#       topology.qjournalUri("cluster")
+
+# Roles whose hosts form a majority-based ensemble
+ENSEMBLE_ROLES = ["zookeeper", "journalnode"]
+# Roles listed first when going through every host
+MASTER_ROLES = ["namenode", "resourcemanager"] + ENSEMBLE_ROLES
+
+
+class TopologyError(Exception):
+    pass
+
+
+class ClusterTopology(object):
+    def __init__(self, roles, racks=None, defaultRack="/default-rack"):
+        self.roles = dict((role, _unique(hosts)) for role, hosts in roles.items())
+        self.racks = dict(racks or {})
+        self.defaultRack = defaultRack
+        self.validate()
+
+    def validate(self):
+        for role in ENSEMBLE_ROLES:
+            hosts = self.hosts(role)
+            if hosts and len(hosts) % 2 == 0:
+                raise TopologyError("The %s ensemble needs an odd number of hosts, got %d: %s"
+                                    % (role, len(hosts), ", ".join(hosts)))
+        if len(self.hosts("namenode")) > 2:
+            # Hadoop 2 only supports HA pairs
+            raise TopologyError("At most two NameNodes are supported, got %d"
+                                % len(self.hosts("namenode")))
+
+    def hosts(self, role):
+        return list(self.roles.get(role, []))
+
+    def allHosts(self):
+        roles = MASTER_ROLES + sorted(role for role in self.roles if role not in MASTER_ROLES)
+        return _unique(host for role in roles for host in self.roles.get(role, []))
+
+    def hostRoles(self, host):
+        return sorted(role for role, hosts in self.roles.items() if host in hosts)
+
+    def rack(self, host):
+        return self.racks.get(host, self.defaultRack)
+
+    def isRackAware(self):
+        return bool(self.racks)
+
+    def haIds(self, role, prefix):
+        """[(id, host)] of the HA instances of role, e.g. [("nn1", host)]."""
+        return [("%s%d" % (prefix, index), host)
+                for index, host in enumerate(self.hosts(role), 1)]
+
+    def myid(self, host):
+        """ZooKeeper server id of host, or None if it isn't in the ensemble.
+        Ids follow the order of the zookeeper hosts, so they are the same on
+        every run."""
+        hosts = self.hosts("zookeeper")
+        return hosts.index(host) + 1 if host in hosts else None
+
+    def zookeeperServers(self, peerPort=2888, electionPort=3888):
+        return dict(("server.%d" % self.myid(host), "%s:%d:%d" % (host, peerPort, electionPort))
+                    for host in self.hosts("zookeeper"))
+
+    def zookeeperQuorum(self, clientPort=2181):
+        return ",".join("%s:%d" % (host, clientPort) for host in self.hosts("zookeeper"))
+
+    def qjournalUri(self, journalId, port=8485):
+        return "qjournal://%s/%s" % (
+            ";".join("%s:%d" % (host, port) for host in self.hosts("journalnode")), journalId)
+
+    def quorumWarnings(self):
+        """Ensembles that a single rack failure would take below quorum."""
+        warnings = []
+        if not self.isRackAware():
+            return warnings
+        for role in ENSEMBLE_ROLES:
+            hosts = self.hosts(role)
+            for rack in sorted(set(self.rack(host) for host in hosts)):
+                inRack = [host for host in hosts if self.rack(host) == rack]
+                if hosts and len(hosts) - len(inRack) <= len(hosts) // 2:
+                    warnings.append("Losing rack %s takes the %s ensemble below quorum "
+                                    "(%d of its %d hosts are there)"
+                                    % (rack, role, len(inRack), len(hosts)))
+        return warnings
+
+    def renderRackMapping(self, aliases=None):
+        """Content of the data file read by topology.sh: a "<name> <rack>"
+        line per host and per alias of it (aliases maps hosts to the other
+        names, e.g. IPs, Hadoop may know them by), plus the default rack."""
+        lines = []
+        for host in self.allHosts():
+            for name in _unique([host] + list((aliases or {}).get(host, []))):
+                if name:
+                    lines.append("%s %s" % (name, self.rack(host)))
+        lines.append("* %s" % self.defaultRack)
+        return "\n".join(lines) + "\n"
+
+
+def _unique(hosts):
+    seen = set()
+    return [host for host in hosts if host and host not in seen and not seen.add(host)]
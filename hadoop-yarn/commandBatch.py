@@ -0,0 +1,225 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+# Description:
+#   Collects the commands a task would run on the current host and runs
+#   them as a single remote script, in one SSH round trip. Every queued
+#   command keeps its own exit code and output, so warn_only and the usual
+#   `.failed` checks still work once the batch has been executed.
+#
+#   Usage:
+#       batch = CommandBatch()
+#       exists = batch.run("test -d /some/dir")
+#       with settings(warn_only=True):
+#           batch.sudo("service foo stop")
+#       batch.run("cat > /tmp/data.json", stdin=jsonData)
+#       batch.execute()
+#       if exists.failed:
+#           ...
+
+import base64
+import uuid
+from io import BytesIO
+from fabric.api import run, sudo, put, env, settings, hide, abort
+from fabric.state import output
+from fabric.operations import _prefix_commands, _prefix_env_vars, _shell_wrap
+
+# Scripts whose base64 encoding is larger than this are uploaded with put()
+# instead of being inlined in the command line, to stay clear of the kernel's
+# limit on the size of a single argument (MAX_ARG_STRLEN, 128KB).
+INLINE_SCRIPT_LIMIT = 96 * 1024
+
+
+class BatchedCommand(object):
+    """A command queued in a CommandBatch.
+
+    Once the batch has been executed it can be used like the string returned
+    by run()/sudo(): it holds the command output and exposes `failed`,
+    `succeeded` and `return_code`.
+    """
+
+    def __init__(self, command, useSudo, warnOnly, wrappedCommand, stdin=None):
+        self.command = command
+        self.useSudo = useSudo
+        self.warnOnly = warnOnly
+        self.wrappedCommand = wrappedCommand
+        self.stdin = stdin
+        self.executed = False
+        self.return_code = None
+        self.stdout = ""
+        self.stderr = ""
+
+    @property
+    def failed(self):
+        return self.return_code != 0
+
+    @property
+    def succeeded(self):
+        return not self.failed
+
+    def strip(self):
+        return self.stdout.strip()
+
+    def __str__(self):
+        return self.stdout
+
+    def __repr__(self):
+        return "<BatchedCommand %r rc=%r>" % (self.command, self.return_code)
+
+
+class CommandBatch(object):
+    """Queue of commands to be run on env.host_string in one session."""
+
+    def __init__(self):
+        self.commands = []
+
+    def run(self, command, stdin=None):
+        """Queues command. If stdin is given, it is fed to the command's
+        standard input (it travels inside the batch script, so it isn't
+        subject to command line length or quoting limits)."""
+        return self._queue(command, False, stdin)
+
+    def sudo(self, command, stdin=None):
+        return self._queue(command, True, stdin)
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.execute()
+
+    def _queue(self, command, useSudo, stdin):
+        # Wrap the command the same way run()/sudo() would, so cd(), prefix(),
+        # shell_env() and the shell escaping rules apply as usual.
+        wrappedCommand = _shell_wrap(
+            _prefix_env_vars(_prefix_commands(command, 'remote')),
+            True, True)
+        queued = BatchedCommand(command, useSudo, env.warn_only, wrappedCommand, stdin)
+        self.commands.append(queued)
+        return queued
+
+    def execute(self):
+        """Run every queued command on the current host.
+
+        Returns the list of BatchedCommand results, in queueing order.
+        Aborts like run()/sudo() would if a command queued without
+        warn_only fails; the commands after it are not executed.
+        """
+        commands, self.commands = self.commands, []
+        if not commands:
+            return []
+
+        token = uuid.uuid4().hex
+        useSudo = any(queued.useSudo for queued in commands)
+        script = _buildScript(commands, token, useSudo)
+
+        runner = sudo if useSudo else run
+        if output.running:
+            print("[%s] batch: %d commands" % (env.host_string, len(commands)))
+        with settings(hide('running', 'stdout', 'stderr'), warn_only=True):
+            encodedScript = base64.b64encode(script.encode('utf-8')).decode('ascii')
+            if len(encodedScript) <= INLINE_SCRIPT_LIMIT:
+                result = runner(
+                    "_f=$(mktemp) && echo %s | base64 -d > \"$_f\" && "
+                    "bash \"$_f\"; _rc=$?; rm -f \"$_f\"; exit $_rc" % encodedScript)
+            else:
+                remoteScript = "/tmp/fab-batch-%s.sh" % token
+                put(BytesIO(script.encode('utf-8')), remoteScript, mode=0o700)
+                result = runner("bash %(f)s; _rc=$?; rm -f %(f)s; exit $_rc"
+                                % {"f": remoteScript})
+
+        _parseOutput(commands, token, result.stdout)
+        _reportResults(commands)
+
+        for queued in commands:
+            if not queued.executed:
+                break
+            if queued.failed and not queued.warnOnly:
+                abort("%s() received nonzero return code %s while executing!"
+                      "\n\nRequested: %s\nExecuted: %s"
+                      % ("sudo" if queued.useSudo else "run", queued.return_code,
+                         queued.command, queued.wrappedCommand))
+
+        if result.failed and not all(queued.executed for queued in commands):
+            # The script stopped before reaching a command that was allowed to
+            # fail, so something went wrong outside of the queued commands.
+            abort("Command batch failed with return code %s:\n%s"
+                  % (result.return_code, result.stdout))
+
+        return commands
+
+
+def _marker(token, index, kind):
+    return "__FAB_BATCH_%s_%s_%d__" % (token, kind, index)
+
+
+def _buildScript(commands, token, useSudo):
+    lines = []
+    for index, queued in enumerate(commands):
+        command = queued.wrappedCommand
+        if useSudo and not queued.useSudo:
+            # The whole script runs as root: drop back to the login user
+            command = "sudo -u %s -H %s" % (env.user, command)
+        lines.append("printf '%%s\\n' '%s'" % _marker(token, index, "BEGIN"))
+        if queued.stdin is None:
+            lines.append("%s 2>&1 </dev/null" % command)
+        else:
+            dataMarker = _marker(token, index, "DATA")
+            lines.append("base64 -d <<'%s' | %s 2>&1" % (dataMarker, command))
+            lines.extend(_encodeLines(queued.stdin))
+            lines.append(dataMarker)
+        lines.append("_rc=$?")
+        lines.append("printf '\\n%%s %%d\\n' '%s' \"$_rc\""
+                     % _marker(token, index, "END"))
+        if not queued.warnOnly:
+            lines.append("[ \"$_rc\" -eq 0 ] || exit \"$_rc\"")
+    lines.append("exit 0")
+    return "\n".join(lines) + "\n"
+
+
+def _encodeLines(data, lineLength=76):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    encoded = base64.b64encode(data).decode('ascii')
+    return [encoded[i:i + lineLength] for i in range(0, len(encoded), lineLength)]
+
+
+def _parseOutput(commands, token, stdout):
+    current = None
+    buf = []
+    for line in stdout.splitlines():
+        line = line.rstrip("\r")
+        if current is None:
+            for index in range(len(commands)):
+                if line == _marker(token, index, "BEGIN"):
+                    current = index
+                    buf = []
+                    break
+            continue
+
+        endMarker = _marker(token, current, "END")
+        if line.startswith(endMarker):
+            queued = commands[current]
+            queued.executed = True
+            queued.return_code = int(line[len(endMarker):].strip())
+            queued.stdout = "\n".join(buf).strip()
+            current = None
+        else:
+            buf.append(line)
+
+
+def _reportResults(commands):
+    for queued in commands:
+        if not queued.executed:
+            break
+        if output.running:
+            print("[%s] %s: %s" % (env.host_string,
+                                   "sudo" if queued.useSudo else "run",
+                                   queued.command))
+        if output.stdout and queued.stdout:
+            for line in queued.stdout.splitlines():
+                print("[%s] out: %s" % (env.host_string, line))
@@ -0,0 +1,201 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+# Description:
+#   Timing traces of every remote command of a run.
+#
+#   enableTracing() wraps run/sudo/put in the given modules so that each
+#   call records its host, the task it belongs to, the command, when it
+#   started and ended, its exit code and the bytes sent and received. Every
+#   process of the run (including the ones @parallel forks) writes its own
+#   records; when the run ends they are merged into a trace file in Chrome's
+#   trace event format (open it in chrome://tracing or ui.perfetto.dev, one
+#   row per host) and a summary of the slowest commands, hosts and tasks is
+#   printed.
+#
+#   The task of a command is the function of the traced modules that
+#   Fabric's execute() (or the fab command) called, so commands run by
+#   helpers are charged to the task that called the helper.
+#
+#   Usage:
+#       enableTracing("fabric-trace.json", [sys.modules[__name__], commandBatch])
+
+import os
+import sys
+import json
+import glob
+import time
+import atexit
+import shutil
+import tempfile
+from fabric.api import env
+
+# Slowest commands, hosts and tasks shown in the summary
+SUMMARY_LENGTH = 10
+
+_traceDir = None
+_traceOwner = None
+_traceFile = None
+_taskModules = set()
+
+
+def enableTracing(traceFile, modules):
+    """Starts tracing run/sudo/put in each of modules (or of any object with
+    such methods, e.g. an SSHConnectionPool). The trace is written to
+    traceFile when the process that called this exits."""
+    global _traceDir, _traceOwner, _traceFile
+    if _traceDir is None:
+        _traceDir = tempfile.mkdtemp(prefix="fab-trace-")
+        _traceOwner = os.getpid()
+        _traceFile = traceFile
+        atexit.register(_writeTrace)
+    for module in modules:
+        if hasattr(module, "__name__"):
+            _taskModules.add(module.__name__)
+        for name in ("run", "sudo", "put"):
+            operation = getattr(module, name, None)
+            if operation is not None and not getattr(operation, "traced", False):
+                setattr(module, name, _traced(name, operation))
+
+
+def _traced(name, operation):
+    def traced(*args, **kwargs):
+        start = time.time()
+        host = env.host_string
+        task = _currentTask()
+        result = None
+        try:
+            result = operation(*args, **kwargs)
+            return result
+        finally:
+            _record(name, host, task, start, time.time(), args, kwargs, result)
+    traced.traced = True
+    traced.__name__ = getattr(operation, "__name__", name)
+    return traced
+
+
+def _currentTask():
+    # The outermost frame of a traced module below the execute() that runs
+    # the current task
+    task = None
+    frame = sys._getframe(2)
+    while frame is not None:
+        module = frame.f_globals.get("__name__")
+        if module == "fabric.tasks" or module == "fabric.main":
+            break
+        if module in _taskModules:
+            task = frame.f_code.co_name
+        frame = frame.f_back
+    return task
+
+
+def _record(name, host, task, start, end, args, kwargs, result):
+    if name == "put":
+        localPath = args[0] if args else kwargs.get("local_path")
+        localName = localPath if isinstance(localPath, str) else \
+            getattr(localPath, "name", "<file-like object>")
+        command = "put %s %s" % (localName,
+                                 args[1] if len(args) > 1 else kwargs.get("remote_path", ""))
+        sent = _localSize(localPath)
+        received = 0
+        exitCode = None if result is None else (0 if not getattr(result, "failed", []) else 1)
+    else:
+        command = args[0] if args else kwargs.get("command", "")
+        sent = len(command)
+        received = len(result or "") + len(getattr(result, "stderr", "") or "")
+        exitCode = getattr(result, "return_code", None)
+    event = {"operation": name, "host": host, "task": task, "command": command,
+             "start": start, "end": end, "exitCode": exitCode,
+             "bytesSent": sent, "bytesReceived": received}
+    # One file per process, since forked processes can't share memory
+    with open(os.path.join(_traceDir, "%d.jsonl" % os.getpid()), "a") as f:
+        f.write(json.dumps(event) + "\n")
+
+
+def _localSize(localPath):
+    if hasattr(localPath, "getvalue"):
+        return len(localPath.getvalue())
+    if hasattr(localPath, "fileno"):
+        return os.fstat(localPath.fileno()).st_size
+    if not isinstance(localPath, str):
+        return 0
+    return sum(os.path.getsize(path) for path in glob.glob(os.path.expanduser(localPath))
+               if os.path.isfile(path))
+
+
+def collectEvents():
+    """Records of every process of the run so far, in start order."""
+    events = []
+    for fileName in os.listdir(_traceDir):
+        with open(os.path.join(_traceDir, fileName)) as f:
+            events.extend(json.loads(line) for line in f)
+    return sorted(events, key=lambda event: event["start"])
+
+
+def chromeTrace(events):
+    """The events in Chrome's trace event format: a process per host and a
+    thread per task."""
+    if not events:
+        return {"traceEvents": []}
+    origin = events[0]["start"]
+    hosts = sorted(set(event["host"] or "local" for event in events))
+    pids = dict((host, index) for index, host in enumerate(hosts, 1))
+    tasks = sorted(set(event["task"] or event["operation"] for event in events))
+    tids = dict((task, index) for index, task in enumerate(tasks, 1))
+    traceEvents = [{"name": "process_name", "ph": "M", "pid": pids[host],
+                    "args": {"name": host}} for host in hosts]
+    traceEvents += [{"name": "thread_name", "ph": "M", "pid": pids[host], "tid": tids[task],
+                     "args": {"name": task}} for host in hosts for task in tasks]
+    for event in events:
+        traceEvents.append({
+            "name": event["command"][:80],
+            "cat": event["task"] or event["operation"],
+            "ph": "X",
+            "ts": int((event["start"] - origin) * 1e6),
+            "dur": int((event["end"] - event["start"]) * 1e6),
+            "pid": pids[event["host"] or "local"],
+            "tid": tids[event["task"] or event["operation"]],
+            "args": dict((key, event[key]) for key in ("operation", "task", "command", "exitCode",
+                                                       "bytesSent", "bytesReceived")),
+        })
+    return {"traceEvents": traceEvents, "displayTimeUnit": "ms"}
+
+
+def summary(events):
+    """Lines listing the slowest commands, and the hosts and tasks where
+    the most time went."""
+    lines = ["", "Slowest commands:",
+             "%10s %-20s %-25s %-6s %s" % ("Time (s)", "Host", "Task", "Exit", "Command")]
+    slowest = sorted(events, key=lambda event: event["end"] - event["start"], reverse=True)
+    for event in slowest[:SUMMARY_LENGTH]:
+        lines.append("%10.2f %-20s %-25s %-6s %s" % (
+            event["end"] - event["start"], event["host"], event["task"],
+            "-" if event["exitCode"] is None else event["exitCode"],
+            " ".join(event["command"].split())[:100]))
+    for label, key in (("host", "host"), ("task", "task")):
+        totals = {}
+        for event in events:
+            total = totals.setdefault(event[key], [0, 0.0, 0])
+            total[0] += 1
+            total[1] += event["end"] - event["start"]
+            total[2] += event["bytesSent"] + event["bytesReceived"]
+        lines += ["", "Time per %s:" % label,
+                  "%10s %8s %12s %s" % ("Time (s)", "Commands", "Bytes", label.capitalize())]
+        for name, (count, seconds, transferred) in sorted(
+                totals.items(), key=lambda item: item[1][1], reverse=True)[:SUMMARY_LENGTH]:
+            lines.append("%10.2f %8d %12d %s" % (seconds, count, transferred, name))
+    return lines
+
+
+def _writeTrace():
+    if os.getpid() != _traceOwner:
+        return
+    events = collectEvents()
+    shutil.rmtree(_traceDir, ignore_errors=True)
+    if not events:
+        return
+    with open(_traceFile, "w") as f:
+        json.dump(chromeTrace(events), f)
+    for line in summary(events):
+        print(line)
+    print("\nTrace of %d commands written to %s" % (len(events), _traceFile))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+# Description:
+#   Which disks of a host can hold Hadoop data, and the commands to format
+#   and mount them, from the lsblk entries collected by hostFacts.
+#
+#   A disk is unused when it is a whole, writable, non-removable disk with
+#   no partitions, no filesystem (nor LVM/RAID signature) and no mount
+#   point. Data disks are mounted on <prefix>1, <prefix>2... and the Hadoop
+#   directories of a host are spread over every mount under the prefix.
+#
+#   Usage:
+#       for device, mountPoint in plannedMounts(facts.disks(), "/data/disk"):
+#           sudo(mountCommand(device, mountPoint, "ext4", "defaults,noatime"))
+#       dataMounts(facts.disks(), "/data/disk")  # ["/data/disk1", ...]
+#       # The first unused disk on its own, e.g. for a transaction log
+#       plannedMounts(facts.disks(), "/data/disk", "/data/zookeeper-log")
+
+import re
+
+
+def unusedDisks(disks):
+    """Device paths of the unused disks among the lsblk entries disks."""
+    parents = set(disk.get("PKNAME") for disk in disks if disk.get("PKNAME"))
+    return sorted("/dev/" + disk["KNAME"] for disk in disks
+                  if disk.get("TYPE") == "disk" and disk.get("KNAME") and
+                  disk["KNAME"] not in parents and
+                  not disk.get("FSTYPE") and not disk.get("MOUNTPOINT") and
+                  disk.get("RO", "0") == "0" and disk.get("RM", "0") == "0")
+
+
+def dataMounts(disks, mountPrefix):
+    """Mount points under mountPrefix, in disk number order."""
+    pattern = re.compile(r'^%s(\d+)$' % re.escape(mountPrefix))
+    mounts = [disk["MOUNTPOINT"] for disk in disks
+              if pattern.match(disk.get("MOUNTPOINT") or "")]
+    return sorted(set(mounts), key=lambda mount: int(pattern.match(mount).group(1)))
+
+
+def plannedMounts(disks, mountPrefix, dedicatedMount=None):
+    """[(device, mountPoint)] for the unused disks, numbered after the data
+    disks already mounted. With dedicatedMount, the first unused disk is
+    mounted there instead, unless something already is or it would leave
+    the host without data disks."""
+    used = [int(mount[len(mountPrefix):]) for mount in dataMounts(disks, mountPrefix)]
+    number = max(used or [0])
+    planned = []
+    devices = unusedDisks(disks)
+    if dedicatedMount and (used or len(devices) > 1) and \
+            not any(disk.get("MOUNTPOINT") == dedicatedMount for disk in disks):
+        planned.append((devices.pop(0), dedicatedMount))
+    for device in devices:
+        number += 1
+        planned.append((device, "%s%d" % (mountPrefix, number)))
+    return planned
+
+
+def mountCommand(device, mountPoint, fileSystem, options, owner):
+    """Shell command formatting device, adding it to /etc/fstab by UUID and
+    mounting it on mountPoint. It checks again that the device is unused,
+    as the facts may be older than the disk's last change."""
+    # ext filesystems reserve 5% of their blocks for root, which on data
+    # disks would just be lost
+    mkfsOptions = "-q -m 0" if fileSystem.startswith("ext") else "-q"
+    return ("test -z \"$(lsblk -n -o FSTYPE,MOUNTPOINT %(dev)s | tr -d ' \\n')\" && "
+            "! blkid %(dev)s >/dev/null && "
+            "mkfs -t %(fs)s %(mkfsOptions)s %(dev)s && "
+            "_uuid=`blkid -s UUID -o value %(dev)s` && test -n \"$_uuid\" && "
+            "mkdir -p %(mount)s && "
+            "echo \"UUID=$_uuid %(mount)s %(fs)s %(options)s 0 2\" >> /etc/fstab && "
+            "mount %(mount)s && chown %(owner)s %(mount)s" %
+            {"dev": device, "mount": mountPoint, "fs": fileSystem, "options": options,
+             "mkfsOptions": mkfsOptions, "owner": owner})
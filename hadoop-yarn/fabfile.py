@@ -9,10 +9,30 @@
 #   http://www.alexjf.net/blog/distributed-systems/hadoop-yarn-installation-definitive-guide
 
 import os
-from fabric.api import run, cd, env, settings, put, sudo
+import time
+from fabric.api import run, cd, env, settings, put, sudo, abort, hide, warn
 from fabric.decorators import runs_once, parallel
 from fabric.tasks import execute
 import json
+from commandBatch import CommandBatch
+from replaceHadoopProperty import EXIT_UNCHANGED as REPLACE_UNCHANGED, \
+    renderConfiguration
+from makeZKconfig import renderZKConfig
+from packageDistribution import cachePackage, distributePackage
+from taskGraph import TaskGraph, RUNS_ONCE
+from hostFacts import FactCache, FactProbe, KnownFacts, lastBackupNumberCommand
+from clusterHealth import ClusterHealth, HealthError, planBatches, requiredUp
+from clusterTopology import ClusterTopology, TopologyError
+from resourceSizing import SizingError, clusterValues, sizeHost
+from diskLayout import dataMounts, mountCommand, plannedMounts
+from benchmarkResults import BenchmarkStore, benchmarkRecord, formatComparison, \
+    formatRanking, parseCounters, parseMRBench, parseNNBench, parseTestDFSIO, summarizeRuns
+import sshPool
+from sshPool import REMOTE_MULTIPLEX_OPTIONS
+from commandTrace import enableTracing
+from jvmProfiles import envFileLines, heapMb
+from zkProbe import formatTable, healthProblems, probeEnsemble
+from nativeCodecs import CodecError, chooseCodec, compressionSiteValues, parseCheckNative
 
 ###############################################################
 #  START OF YOUR CONFIGURATION (CHANGE FROM HERE, IF NEEDED)  #
@@ -43,6 +63,12 @@ EC2_INSTANCE_STORAGEDEV = None
 
 #zookeeper rellated files
 ZOOKEEPER_DATA_DIR = "/HA/data/zookeeper"
+# ZooKeeper fsyncs its transaction log before acknowledging each write, so a
+# log sharing its disk with snapshots (or HDFS) slows down every session,
+# ZKFC's included. With DATA_DISKS, ZooKeeper hosts with more than one
+# unused disk get the first one mounted here for the transaction log;
+# the others keep it in ZOOKEEPER_DATA_DIR.
+ZOOKEEPER_DATA_LOG_MOUNT = "/data/zookeeper-log"
 IMPORTANT_ZK_DIRS = [ZOOKEEPER_DATA_DIR]
 
 #### Zookeper Package Information ####
@@ -50,6 +76,10 @@ ZOOKEEPER_VERSION = "3.4.6"
 ZOOKEEPER_PACKAGE = "zookeeper-%s" % ZOOKEEPER_VERSION
 #HADOOP_PACKAGE_URL = "http://apache.mirrors.spacedump.net/hadoop/common/stable/%s.tar.gz" % HADOOP_PACKAGE
 ZOOKEEPER_PACKAGE_URL = "https://archive.apache.org/dist/zookeeper/%(hadoop)s/%(hadoop)s.tar.gz" % {'hadoop': ZOOKEEPER_PACKAGE}
+# Published SHA-512 of the package, checked before it gets used. 3.4.6 only
+# ships MD5/SHA-1 sums, so without one the download is only checked against
+# the size reported by the server.
+ZOOKEEPER_PACKAGE_SHA512_URL = None
 ZOOKEEPER_PREFIX = "/home/ubuntu/Programs/%s" % ZOOKEEPER_PACKAGE
 ZOOKEEPER_CONF = os.path.join(ZOOKEEPER_PREFIX, "conf")
 
@@ -58,9 +88,131 @@ HADOOP_VERSION = "2.8.5"
 HADOOP_PACKAGE = "hadoop-%s" % HADOOP_VERSION
 #HADOOP_PACKAGE_URL = "http://apache.mirrors.spacedump.net/hadoop/common/stable/%s.tar.gz" % HADOOP_PACKAGE
 HADOOP_PACKAGE_URL = "https://archive.apache.org/dist/hadoop/common/%(hadoop)s/%(hadoop)s.tar.gz" % {'hadoop': HADOOP_PACKAGE}
+# Published SHA-512 of the package (.sha512 for newer releases)
+HADOOP_PACKAGE_SHA512_URL = HADOOP_PACKAGE_URL + ".mds"
 HADOOP_PREFIX = "/home/ubuntu/Programs/%s" % HADOOP_PACKAGE
 HADOOP_CONF = os.path.join(HADOOP_PREFIX, "etc/hadoop")
 
+#### Package distribution ####
+# If True, packages are downloaded only once, into PACKAGE_CACHE_DIR on this
+# machine, and then relayed between the hosts: in every wave, each host that
+# already has a verified copy sends it to PACKAGE_RELAY_FANOUT more hosts.
+# If False, every host downloads its own copy from the package URL.
+# Relaying needs PACKAGE_RELAY_SSH_KEY on every host, which isn't set up by
+# these scripts.
+PACKAGE_RELAY = False
+PACKAGE_CACHE_DIR = os.path.expanduser("~/.cache/fabric-scripts/packages")
+PACKAGE_RELAY_FANOUT = 2
+# Key the hosts use to ssh into each other (path on the remote hosts, which
+# must already be there)
+PACKAGE_RELAY_SSH_KEY = "~/.ssh/bdata1.pem"
+
+#### Execution ####
+# bootstrap runs its steps as a dependency graph, on all hosts at once.
+# This is how many (step, host) pairs can run at the same time.
+BOOTSTRAP_WORKERS = 10
+# How tasks that run on every host at once (setupHosts, package relay...)
+# are executed: "fabric" forks a process per host, which doesn't go much
+# beyond a few hundred hosts; "asyncio" drives every host from a single
+# process over the SSH connection pool below, with at most
+# ASYNC_MAX_CONCURRENCY commands in flight (needs Python 3).
+EXECUTION_BACKEND = "fabric"
+ASYNC_MAX_CONCURRENCY = 256
+
+#### SSH connections ####
+# If True, commands go through a single OpenSSH connection per host that is
+# kept open for the whole run and shared by every process, instead of the
+# connections Fabric opens again in each forked (@parallel) task. Needs the
+# ssh client on this machine and passwordless sudo on the hosts.
+SSH_CONNECTION_POOL = False
+# Most commands that may run on the same host at the same time (keep it
+# under sshd's MaxSessions, 10 by default)
+SSH_MAX_CHANNELS_PER_HOST = 8
+# Print the number of handshakes, the share of commands that reused a
+# connection and the time spent connecting to each host at the end of every
+# run (or of a single one with `fab connectionStats <tasks>`)
+SSH_CONNECTION_STATS = False
+
+#### Command traces ####
+# Record the host, task, timing, exit code and bytes transferred of every
+# remote command, and write them to COMMAND_TRACE_FILE (Chrome trace event
+# format, see chrome://tracing) with a summary of the slowest commands,
+# hosts and tasks at the end of a run
+COMMAND_TRACE = False
+COMMAND_TRACE_FILE = "fabric-trace.json"
+
+#### Host facts ####
+# What tasks check on the hosts before acting (private IP, CPU/memory/disk
+# inventory, which directories exist, helper digests, backup numbers) is
+# collected with a single command per host and cached here for
+# FACTS_CACHE_TTL seconds, so later tasks and reruns answer those checks
+# locally. Tasks drop the facts of the paths they change; run clearFacts
+# after changing the hosts by other means. 0 checks everything every time.
+FACTS_CACHE_DIR = os.path.expanduser("~/.cache/fabric-scripts/facts")
+FACTS_CACHE_TTL = 300
+
+#### Rolling restart ####
+# rollingRestart restarts the daemons without taking the cluster down. The
+# workers (DataNode + NodeManager) are restarted this many hosts at a time,
+# and each batch has to be registered again with the NameNodes and the
+# ResourceManager before the next one starts.
+ROLLING_RESTART_BATCH_SIZE = 1
+# Share (0-1) of the DataNodes and NodeManagers that must be up at all
+# times. Batches are made smaller if needed, and a batch only starts once
+# enough workers are live.
+ROLLING_RESTART_MIN_CAPACITY = 0.5
+# Seconds to wait for restarted daemons to register or take over
+ROLLING_RESTART_TIMEOUT = 300
+# Should rollingRestart only start if zkHealth passes?
+ROLLING_RESTART_CHECK_ZK = True
+
+#### ZooKeeper health ####
+# zkHealth queries every ZooKeeper server from this machine (so the client
+# port must be reachable from it) and fails if one is down, there's no
+# quorum or single leader, a follower is out of sync with the leader, or a
+# server is above these thresholds.
+ZK_HEALTH_MAX_AVG_LATENCY_MS = 50
+ZK_HEALTH_MAX_OUTSTANDING = 100
+ZK_PROBE_TIMEOUT = 5
+
+#### Start/stop ####
+# start and stop work tier by tier (see DAEMON_DEPENDENCIES), on all the
+# hosts of a tier at once. A tier is up when its daemons listen on their
+# ports (and, for HA, an active NameNode/ResourceManager has been elected);
+# start aborts if that takes longer than START_TIMEOUT seconds. Hosts where
+# a tier still listens STOP_GRACE_SECONDS after being stopped get every java
+# process killed.
+START_TIMEOUT = 120
+STOP_GRACE_SECONDS = 30
+
+#### Benchmarks ####
+# benchmark runs TestDFSIO, TeraGen/TeraSort/TeraValidate, NNBench and
+# MRBench from the ResourceManager host. The result of every run is stored
+# in BENCHMARK_RESULTS_DIR, on this machine, and compared with the previous
+# run of the same benchmark. Sizes are per DataNode, so that the load grows
+# with the cluster.
+BENCHMARK_RESULTS_DIR = os.path.expanduser("~/.cache/fabric-scripts/benchmarks")
+BENCHMARK_HDFS_DIR = "/benchmarks"
+BENCHMARK_DFSIO_FILES_PER_DATANODE = 2
+BENCHMARK_DFSIO_FILE_SIZE = "1GB"
+BENCHMARK_TERASORT_GB_PER_DATANODE = 1
+BENCHMARK_NNBENCH_FILES_PER_DATANODE = 1000
+BENCHMARK_MRBENCH_RUNS = 5
+
+#### Experiments ####
+# experiment:<file> tries each of the config variants described in <file>
+# (JSON) in turn: it applies the variant, restarts the daemons whose config
+# changed, runs a workload several times and reverts the variant. Variants
+# list the properties that change, by file, e.g.
+#   {"workload": "terasort", "runs": 5,
+#    "variants": {"sort-256": {"mapred-site.xml": {"mapreduce.task.io.sort.mb": 256}},
+#                 "handlers-64": {"hdfs-site.xml": {"dfs.namenode.handler.count": 64}}}}
+# The workload is terasort, dfsio-write, dfsio-read, mrbench or a command to
+# run from HADOOP_PREFIX. A "baseline" variant with no changes is always
+# added.
+EXPERIMENT_RUNS = 5
+EXPERIMENT_WORKLOAD = "terasort"
+
 
 #### Installation information ####
 # Change this to the command you would use to install packages on the
@@ -92,6 +244,25 @@ REQUIREMENTS_PRE_COMMANDS = ["service iptables stop","service ufw stop"]
 #    "echo debconf shared/accepted-oracle-license-v1-1 seen true | debconf-set-selections"
 #]
 
+#### Native libraries and compression ####
+# Should bootstrap install the native compression libraries, check with
+# `hadoop checknative -a` that every host loads them (and abort if one
+# doesn't) and compress map outputs with the first codec of
+# MAP_OUTPUT_CODECS that every host supports? Aggregated YARN logs are then
+# gzipped too. checkNativeCodecs runs the check alone.
+NATIVE_CODECS = False
+NATIVE_CODEC_PACKAGES = ["zlib1g", "libsnappy1v5", "liblz4-1", "libbz2-1.0", "libzstd1",
+                         "libssl-dev"] # Debian/Ubuntu
+#NATIVE_CODEC_PACKAGES = ["zlib", "snappy", "lz4", "bzip2", "zstd", "openssl"] # Arch Linux
+#NATIVE_CODEC_PACKAGES = ["zlib", "snappy", "lz4", "bzip2-libs", "libzstd", "openssl-devel"] # CentOS
+# zstd needs Hadoop 2.9 or later; older versions fall back to the next one
+MAP_OUTPUT_CODECS = ["zstd", "snappy", "lz4"]
+# Codec to use instead of the checked one ("snappy", "lz4"...), None to
+# leave map outputs uncompressed, or "auto" for the one the last check chose
+MAP_OUTPUT_CODEC = "auto"
+# Where the last check's results are kept, on this machine
+NATIVE_CODECS_FILE = os.path.expanduser("~/.cache/fabric-scripts/native-codecs.json")
+
 
 #### Environment ####
 # Set this to True/False depending on whether or not ENVIRONMENT_FILE
@@ -129,6 +300,13 @@ ENVIRONMENT_VARIABLES = [
 
 #### Host data (for non-EC2 deployments) ####
 HOSTS_FILE="/etc/hosts"
+# If True, the cluster entries of HOSTS_FILE are kept in a single block
+# between marker comments. The block is rendered locally and pushed once per
+# host, and only if it differs from what's already there. Lines outside the
+# block for the cluster's IPs (e.g. hand-made entries, or the ones the
+# line-by-line mode added) are removed. If False, each entry is looked up
+# and edited in place with its own commands.
+HOSTS_FILE_MANAGED_BLOCK = False
 NET_INTERFACE="ens5"
 RESOURCEMANAGER_HOST = "10.200.2.154"
 NAMENODE_HOST = RESOURCEMANAGER_HOST
@@ -147,6 +325,25 @@ JOBTRACKER_PORT = 8021
 JOBHISTORY_HOST = JOBTRACKER_HOST
 JOBHISTORY_PORT = 10020
 
+#### Topology ####
+# Hosts of each role. None keeps the default layout: the NameNodes on
+# NAMENODE_HOST and the first slave, the ResourceManagers on
+# RESOURCEMANAGER_HOST and the first other slave, ZooKeeper and the
+# JournalNodes on NAMENODE_HOST and the first two slaves. The first host of
+# NAMENODE_HOSTS/RESOURCEMANAGER_HOSTS is nn1/rm1, and so on; ZooKeeper
+# myids follow the order of ZOOKEEPER_HOSTS. ZooKeeper and JournalNode
+# ensembles need an odd number of hosts.
+NAMENODE_HOSTS = None
+RESOURCEMANAGER_HOSTS = None
+ZOOKEEPER_HOSTS = None
+JOURNALNODE_HOSTS = None
+# Rack of each host, e.g. {"10.200.2.175": "/rack1"}. When set, Hadoop gets
+# a topology script mapping hosts (and their IPs and names) to racks, so
+# HDFS places replicas and YARN schedules containers rack-aware. Hosts not
+# listed are in DEFAULT_RACK.
+HOST_RACKS = {}
+DEFAULT_RACK = "/default-rack"
+
 
 #### Configuration ####
 # Should the configuration options be applied to a clean (empty) configuration
@@ -161,16 +358,72 @@ HDFS_NAME_DIR = "/HA/data/namenode"
 
 IMPORTANT_DIRS = [HADOOP_TEMP, HDFS_DATA_DIR, HDFS_NAME_DIR]
 
+#### Short-circuit reads ####
+# Should HDFS clients on a DataNode host (e.g. the containers of a
+# co-located NodeManager) read local blocks straight from disk, with a file
+# descriptor the DataNode passes them over a UNIX domain socket, instead of
+# streaming them through the DataNode? Needs libhadoop on every host (see
+# NATIVE_CODECS); startCluster aborts if a DataNode doesn't open the socket.
+HDFS_SHORT_CIRCUIT_READS = False
+# Every directory above the socket must be owned by root or by the user
+# running the DataNode, and not writable by anyone else
+HDFS_DOMAIN_SOCKET_PATH = "/var/lib/hadoop-hdfs/dn_socket"
+
+#### Data disks ####
+# Should bootstrapHadoopYarn format and mount the unused disks of each host
+# (whole disks with no partitions, filesystem or mount point) and spread the
+# DataNode and NodeManager directories over every one of them? Hosts with no
+# data disks keep using HDFS_DATA_DIR and HADOOP_TEMP.
+DATA_DISKS = False
+# Data disks are mounted on DATA_DISKS_MOUNT_PREFIX1, DATA_DISKS_MOUNT_PREFIX2...
+DATA_DISKS_MOUNT_PREFIX = "/data/disk"
+DATA_DISKS_FILESYSTEM = "ext4"
+DATA_DISKS_MOUNT_OPTIONS = "defaults,noatime,nofail"
+
 
 #Cluster-Name
 CLUSTER_NAME = "wisilica"
 
+#### Resource sizing ####
+# Should the NodeManager memory/vcores of each host, and the container sizes
+# of the cluster, be computed from the cores, memory and disks of the hosts?
+# If so, they replace the fixed values in YARN_SITE_VALUES and
+# MAPRED_SITE_VALUES below (see showResourceSizing).
+AUTO_SIZE_RESOURCES = False
+# Heap (in MB) of each daemon, which is kept out of what YARN gets on the
+# hosts the daemon runs on. ZooKeeper's is also set in its zookeeper-env.sh.
+DAEMON_HEAP_MB = {
+    "zookeeper": 1024,
+    "journalnode": 1024,
+    "namenode": 1024,
+    "zkfc": 1024,
+    "datanode": 1024,
+    "resourcemanager": 1024,
+    "nodemanager": 1024,
+    "historyserver": 1024,
+}
+
+#### JVM profiles ####
+# Should the heap, garbage collector (G1) and rotated GC logs of each daemon
+# be set in hadoop-env.sh, yarn-env.sh, mapred-env.sh and zookeeper-env.sh,
+# according to the roles of each host? The heaps then also replace
+# DAEMON_HEAP_MB: the NameNode's is sized from NAMENODE_EXPECTED_OBJECTS,
+# the others from the memory of their host (see jvmProfiles.py).
+JVM_PROFILES = False
+# Files + directories + blocks the NameNode is expected to hold
+NAMENODE_EXPECTED_OBJECTS = 10 * 10 ** 6
+# Heaps (in MB) to use instead of the sized ones, e.g. {"namenode": 16384}
+JVM_HEAP_MB = {}
+JVM_GC_LOG_DIR = os.path.join(os.path.dirname(HADOOP_PREFIX), "gc-logs")
+
 
 # Need to do this in a function so that we can rewrite the values when any
 # of the hosts change in runtime (e.g. EC2 node discovery).
 def updateHadoopSiteValues():
     global CORE_SITE_VALUES, HDFS_SITE_VALUES, YARN_SITE_VALUES, MAPRED_SITE_VALUES,ZOOKEEPER_CONF_VALUES
+    global TOPOLOGY
 
+    TOPOLOGY = clusterTopology()
 
     ZOOKEEPER_CONF_VALUES = {
         "tickTime":2000,
@@ -178,10 +431,14 @@ def updateHadoopSiteValues():
         "syncLimit":5,
         "dataDir": ZOOKEEPER_DATA_DIR,
         "clientPort":2181,
-        "server.1":"%s:2888:3888" % NAMENODE_HOST,
-        "server.2":"%s:2888:3888" % SLAVE_HOSTS[0],
-        "server.3":"%s:2888:3888" % SLAVE_HOSTS[1]
+        # A snapshot every snapCount transactions. Every purgeInterval hours,
+        # all but the last snapRetainCount snapshots (and the transaction
+        # logs only they need) are deleted.
+        "snapCount": 100000,
+        "autopurge.snapRetainCount": 5,
+        "autopurge.purgeInterval": 1,
     }
+    ZOOKEEPER_CONF_VALUES.update(TOPOLOGY.zookeeperServers())
 
     CORE_SITE_VALUES = {
         "fs.defaultFS": "hdfs://%s/" % CLUSTER_NAME,
@@ -190,6 +447,8 @@ def updateHadoopSiteValues():
         "hadoop.tmp.dir": HADOOP_TEMP,
         "dfs.journalnode.edits.dir" : "/home/ubuntu/HA/data/jn"
     }
+    if TOPOLOGY.isRackAware():
+        CORE_SITE_VALUES["net.topology.script.file.name"] = os.path.join(HADOOP_CONF, "topology.sh")
 
     HDFS_SITE_VALUES = {
         "dfs.datanode.data.dir": "file://%s" % HDFS_DATA_DIR,
@@ -197,20 +456,23 @@ def updateHadoopSiteValues():
         "dfs.nameservices" : CLUSTER_NAME,
         "dfs.replication" : "1",
         "dfs.permissions": "false",
-        "dfs.ha.namenodes.%s" % CLUSTER_NAME: "nn1,nn2",
-        "dfs.namenode.rpc-address.%s.nn1" % CLUSTER_NAME: "%s:9000" % NAMENODE_HOST,
-        "dfs.namenode.rpc-address.%s.nn2" % CLUSTER_NAME: "%s:9000" % SLAVE_HOSTS[0], ## TODO: Remove hardcoding
-        "dfs.namenode.http-address.%s.nn1" % CLUSTER_NAME: "%s:50070" % NAMENODE_HOST,
-        "dfs.namenode.http-address.%s.nn2" % CLUSTER_NAME: "%s:50070" % SLAVE_HOSTS[0], ## TODO: Remove hardcoding
-        "dfs.namenode.shared.edits.dir": "qjournal://%s:8485;%s:8485;%s:8485/%s" %(NAMENODE_HOST,SLAVE_HOSTS[0],SLAVE_HOSTS[1],CLUSTER_NAME), ## TODO: Remove hardcoding
+        "dfs.ha.namenodes.%s" % CLUSTER_NAME:
+            ",".join(namenodeId for namenodeId, host in TOPOLOGY.haIds("namenode", "nn")),
+        "dfs.namenode.shared.edits.dir": TOPOLOGY.qjournalUri(CLUSTER_NAME),
         "dfs.client.failover.proxy.provider.%s" % CLUSTER_NAME : "org.apache.hadoop.hdfs.server.namenode.ha.ConfiguredFailoverProxyProvider",
         "dfs.ha.automatic-failover.enabled": "true",
-        "ha.zookeeper.quorum":"%s:2181,%s:2181,%s:2181" %(NAMENODE_HOST,SLAVE_HOSTS[0],SLAVE_HOSTS[1]),
+        "ha.zookeeper.quorum": TOPOLOGY.zookeeperQuorum(),
         "dfs.ha.fencing.methods":"sshfence",
         "dfs.ha.fencing.ssh.private-key-files": "/home/ubuntu/.ssh/id_rsa",
         "dfs.namenode.datanode.registration.ip-hostname-check":"false"
 
     }
+    for namenodeId, host in TOPOLOGY.haIds("namenode", "nn"):
+        HDFS_SITE_VALUES["dfs.namenode.rpc-address.%s.%s" % (CLUSTER_NAME, namenodeId)] = "%s:9000" % host
+        HDFS_SITE_VALUES["dfs.namenode.http-address.%s.%s" % (CLUSTER_NAME, namenodeId)] = "%s:50070" % host
+    if HDFS_SHORT_CIRCUIT_READS:
+        HDFS_SITE_VALUES["dfs.client.read.shortcircuit"] = "true"
+        HDFS_SITE_VALUES["dfs.domain.socket.path"] = HDFS_DOMAIN_SOCKET_PATH
 
     YARN_SITE_VALUES = {
         "yarn.resourcemanager.hostname": RESOURCEMANAGER_HOST,
@@ -228,13 +490,13 @@ def updateHadoopSiteValues():
 #HA part
         "yarn.resourcemanager.ha.enabled":"true",
         "yarn.resourcemanager.cluster-id":"cluster_1", ## TODO: can we change this?
-        "yarn.resourcemanager.ha.rm-ids" : "rm1,rm2",
-        "yarn.resourcemanager.hostname.rm1": NAMENODE_HOST,
-        "yarn.resourcemanager.hostname.rm2": SLAVE_HOSTS[0],
-        "yarn.resourcemanager.webapp.address.rm1": "%s:8088" % NAMENODE_HOST,
-        "yarn.resourcemanager.webapp.address.rm2": "%s:8088" % SLAVE_HOSTS[0],
-        "yarn.resourcemanager.zk-address": "%s:2181,%s:2181,%s:2181" %(NAMENODE_HOST,SLAVE_HOSTS[0],SLAVE_HOSTS[1])
+        "yarn.resourcemanager.ha.rm-ids":
+            ",".join(rmId for rmId, host in TOPOLOGY.haIds("resourcemanager", "rm")),
+        "yarn.resourcemanager.zk-address": TOPOLOGY.zookeeperQuorum()
     }
+    for rmId, host in TOPOLOGY.haIds("resourcemanager", "rm"):
+        YARN_SITE_VALUES["yarn.resourcemanager.hostname.%s" % rmId] = host
+        YARN_SITE_VALUES["yarn.resourcemanager.webapp.address.%s" % rmId] = "%s:8088" % host
 
     MAPRED_SITE_VALUES = {
         "yarn.app.mapreduce.am.resource.mb": 1024,
@@ -248,6 +510,10 @@ def updateHadoopSiteValues():
         "mapreduce.reduce.java.opts": "-Xmx768m",
     }
 
+    codec = mapOutputCodec()
+    if codec:
+        useMapOutputCodec(codec)
+
 ##############################################################
 #  END OF YOUR CONFIGURATION (CHANGE UNTIL HERE, IF NEEDED)  #
 ##############################################################
@@ -255,6 +521,53 @@ def updateHadoopSiteValues():
 #####################################################################
 #  DON'T CHANGE ANYTHING BELOW (UNLESS YOU KNOW WHAT YOU'RE DOING)  #
 #####################################################################
+MANAGED_BLOCK_BEGIN = "# BEGIN fabric-scripts managed block"
+MANAGED_BLOCK_END = "# END fabric-scripts managed block"
+
+# Daemons that have to be restarted when each config file changes. Changed
+# files leave the daemons to restart in RESTART_FLAGS_FILE on each host,
+# which restartChanged() picks up.
+CONFIG_FILE_DAEMONS = {
+    "core-site.xml": ["journalnode", "namenode", "zkfc", "datanode",
+                      "resourcemanager", "nodemanager", "historyserver"],
+    "hdfs-site.xml": ["journalnode", "namenode", "zkfc", "datanode"],
+    "yarn-site.xml": ["resourcemanager", "nodemanager"],
+    "mapred-site.xml": ["historyserver"],
+    "zoo.cfg": ["zookeeper"],
+    "topology.data": ["namenode", "resourcemanager"],
+    "hadoop-env.sh": ["journalnode", "namenode", "zkfc", "datanode"],
+    "yarn-env.sh": ["resourcemanager", "nodemanager"],
+    "mapred-env.sh": ["historyserver"],
+    "zookeeper-env.sh": ["zookeeper"],
+}
+RESTART_FLAGS_FILE = os.path.join(os.path.dirname(HADOOP_PREFIX), ".restart-required")
+
+# Daemons in start order, with the script that controls them
+DAEMONS = ["zookeeper", "journalnode", "namenode", "zkfc", "datanode",
+           "resourcemanager", "nodemanager", "historyserver"]
+# Daemons each daemon needs up before it can start. start and stop group
+# the daemons in tiers from this.
+DAEMON_DEPENDENCIES = {
+    "zookeeper": [],
+    "journalnode": [],
+    "namenode": ["journalnode"],
+    "zkfc": ["zookeeper", "namenode"],
+    "datanode": ["namenode"],
+    "resourcemanager": ["zookeeper"],
+    "nodemanager": ["resourcemanager"],
+    "historyserver": ["zkfc", "datanode"],
+}
+DAEMON_SCRIPTS = {
+    "journalnode": "sbin/hadoop-daemon.sh",
+    "namenode": "sbin/hadoop-daemon.sh",
+    "zkfc": "sbin/hadoop-daemon.sh",
+    "datanode": "sbin/hadoop-daemon.sh",
+    "resourcemanager": "sbin/yarn-daemon.sh",
+    "nodemanager": "sbin/yarn-daemon.sh",
+    "historyserver": "sbin/mr-jobhistory-daemon.sh",
+}
+
+TOPOLOGY = None
 CORE_SITE_VALUES = {}
 HDFS_SITE_VALUES = {}
 YARN_SITE_VALUES = {}
@@ -267,7 +580,8 @@ def bootstrapFabric():
     updateHadoopSiteValues()
 
     env.user = SSH_USER
-    hosts = [NAMENODE_HOST, RESOURCEMANAGER_HOST, JOBHISTORY_HOST] + SLAVE_HOSTS
+    hosts = [NAMENODE_HOST, RESOURCEMANAGER_HOST, JOBHISTORY_HOST] + SLAVE_HOSTS + \
+        TOPOLOGY.allHosts()
     seen = set()
     # Remove empty hosts and duplicates
     cleanedHosts = [host for host in hosts if host and host not in seen and not seen.add(host)]
@@ -281,12 +595,28 @@ def bootstrapFabric():
         MAPRED_SITE_VALUES["mapreduce.jobhistory.address"] = "%s:%s" % \
             (JOBHISTORY_HOST, JOBHISTORY_PORT)
 
+    if SSH_CONNECTION_STATS:
+        sshPool.enableStats()
+    if SSH_CONNECTION_POOL:
+        pool = connectionPool()
+        pool.prepare(env.hosts)
+        sshPool.usePool(pool, poolModules())
+    if COMMAND_TRACE:
+        # After the pool, so that its run/sudo/put are the ones traced
+        enableTracing(COMMAND_TRACE_FILE, poolModules())
+
 
 # MAIN FUNCTIONS
 def forceStopEveryJava():
     run("jps | grep -vi jps | cut -d ' ' -f 1 | xargs -L1 -r kill")
 
 
+@runs_once
+def connectionStats():
+    # Prints the SSH connection report (see SSH_CONNECTION_STATS) at the end
+    # of this run, e.g. `fab connectionStats bootstrap`
+    sshPool.enableStats()
+
 @runs_once
 def debugHosts():
     print("Resource Manager: {}".format(RESOURCEMANAGER_HOST))
@@ -295,28 +625,231 @@ def debugHosts():
     print("Job History: {}".format(JOBHISTORY_HOST))
     print("Slaves: {}".format(SLAVE_HOSTS))
 
+@runs_once
+def showTopology():
+    # Prints the roles and rack of every host, and warns about ensembles a
+    # single rack failure would take below quorum
+    print("%-30s %-20s %-5s %s" % ("Host", "Rack", "myid", "Roles"))
+    for host in TOPOLOGY.allHosts():
+        print("%-30s %-20s %-5s %s" % (host, TOPOLOGY.rack(host), TOPOLOGY.myid(host) or "-",
+                                        ", ".join(TOPOLOGY.hostRoles(host))))
+    for warning in TOPOLOGY.quorumWarnings():
+        warn(warning)
+
+def clusterTopology():
+    # Roles left to None in the configuration get the default layout
+    def slavesOtherThan(host, count):
+        return [slave for slave in SLAVE_HOSTS if slave != host][:count]
+    roles = {
+        "namenode": NAMENODE_HOSTS or [NAMENODE_HOST] + slavesOtherThan(NAMENODE_HOST, 1),
+        "resourcemanager": RESOURCEMANAGER_HOSTS or
+                           [RESOURCEMANAGER_HOST] + slavesOtherThan(RESOURCEMANAGER_HOST, 1),
+        "zookeeper": ZOOKEEPER_HOSTS or [NAMENODE_HOST] + slavesOtherThan(NAMENODE_HOST, 2),
+        "journalnode": JOURNALNODE_HOSTS or [NAMENODE_HOST] + slavesOtherThan(NAMENODE_HOST, 2),
+        "datanode": SLAVE_HOSTS,
+        "nodemanager": SLAVE_HOSTS,
+        "historyserver": [JOBHISTORY_HOST],
+    }
+    if roles["namenode"][0] != NAMENODE_HOST:
+        # Formatting and the first start happen on NAMENODE_HOST
+        abort("NAMENODE_HOSTS has to start with NAMENODE_HOST (%s)" % NAMENODE_HOST)
+    try:
+        return ClusterTopology(roles, HOST_RACKS, DEFAULT_RACK)
+    except TopologyError as e:
+        abort(str(e))
+
+def topologyFiles():
+    # Rack mapping read by topology.sh. Daemons may know a host by its
+    # configured name, its IP or its own host name, so all of them are in.
+    if not TOPOLOGY.isRackAware():
+        return []
+    aliases = {}
+    for host in TOPOLOGY.allHosts():
+        facts = clusterFacts(host)
+        hostName = facts.hostName()
+        aliases[host] = [facts.privateIp(), hostName, hostName.split(".")[0] if hostName else None]
+    return [(os.path.join(HADOOP_CONF, "topology.data"), TOPOLOGY.renderRackMapping(aliases))]
+
+def syncTopologyScript():
+    if TOPOLOGY.isRackAware():
+        syncHelper("topology.sh", HADOOP_CONF)
+
+@runs_once
+def showResourceSizing():
+    # Prints what YARN gets on every NodeManager host and the container
+    # sizes AUTO_SIZE_RESOURCES would configure
+    sizes = nodeManagerSizes()
+    print("%-30s %5s %9s %5s %11s %12s %6s" % ("Host", "Cores", "Memory", "Disks",
+                                               "Containers", "YARN memory", "Vcores"))
+    for host in daemonHosts("nodemanager"):
+        facts = clusterFacts(host)
+        size = sizes[host]
+        print("%-30s %5s %7sMB %5d %11d %10dMB %6d" % (
+            host, facts.cpus(), facts.memoryMb(), dataDiskCount(facts),
+            size.containers, size.memoryMb, size.vcores))
+    for fileName, propertyDict in sorted(clusterValues(sizes.values()).items()):
+        print("\n%s:" % fileName)
+        for key, value in sorted(propertyDict.items()):
+            print("    %s = %s" % (key, value))
+
+_nodeManagerSizes = None
+
+def nodeManagerSizes():
+    # HostSize of every NodeManager host, from the cluster facts. Computed
+    # once per process, so that every host gets the same cluster-wide values.
+    global _nodeManagerSizes
+    if _nodeManagerSizes is None:
+        sizes = {}
+        for host in daemonHosts("nodemanager"):
+            facts = clusterFacts(host)
+            daemonHeapMb = sum(daemonHeap(host, daemon) for daemon in hostDaemons(host))
+            try:
+                sizes[host] = sizeHost(facts.cpus(), facts.memoryMb(), dataDiskCount(facts),
+                                       daemonHeapMb)
+            except SizingError as e:
+                abort("Can't size the resources of %s: %s" % (host, e))
+        _nodeManagerSizes = sizes
+    return _nodeManagerSizes
+
+def resourceSiteValues(host):
+    # {fileName: properties} sized for host
+    sizes = nodeManagerSizes()
+    siteValues = clusterValues(sizes.values())
+    if host in sizes:
+        siteValues["yarn-site.xml"].update(sizes[host].nodeManagerValues())
+    return siteValues
+
+def dataDiskCount(facts):
+    # Disks the containers of a host spread their I/O over: its data disks,
+    # or else all of its whole disks (no partitions, loop devices, CD-ROMs...)
+    if DATA_DISKS and dataMounts(facts.disks(), DATA_DISKS_MOUNT_PREFIX):
+        return len(dataMounts(facts.disks(), DATA_DISKS_MOUNT_PREFIX))
+    return len([disk for disk in facts.disks() if disk.get("TYPE") == "disk"])
+
+def prepareDataDisks():
+    # Formats and mounts the unused disks of the host (see DATA_DISKS), and
+    # creates the Hadoop directories on every data disk
+    facts = currentFacts()
+    planned = plannedMounts(facts.disks(), DATA_DISKS_MOUNT_PREFIX,
+                            ZOOKEEPER_DATA_LOG_MOUNT if "zookeeper" in hostDaemons() else None)
+    if planned:
+        batch = CommandBatch()
+        with settings(warn_only=True):
+            mounted = [(device, mountPoint, batch.sudo(mountCommand(
+                device, mountPoint, DATA_DISKS_FILESYSTEM, DATA_DISKS_MOUNT_OPTIONS, env.user)))
+                for device, mountPoint in planned]
+        batch.execute()
+        for device, mountPoint, result in mounted:
+            if result.failed:
+                warn("Could not format and mount %s on %s:%s" % (device, mountPoint, env.host))
+        # The disks changed, so the inventory has to be collected again
+        facts.gather(["inventory"])
+    ensureDirectoriesExist([directory for directories in dataDirectories(env.host).values()
+                            for directory in directories])
+
+def dataDirectories(host):
+    # {property: [directory on each data disk]} of host, empty if it has no
+    # data disks
+    mounts = dataMounts(currentFacts(host).disks(), DATA_DISKS_MOUNT_PREFIX)
+    if not mounts:
+        return {}
+    return {
+        "dfs.datanode.data.dir": [os.path.join(mount, "hdfs/data") for mount in mounts],
+        "yarn.nodemanager.local-dirs": [os.path.join(mount, "yarn/local") for mount in mounts],
+        "yarn.nodemanager.log-dirs": [os.path.join(mount, "yarn/logs") for mount in mounts],
+    }
+
+def dataDirectorySiteValues(host):
+    # {fileName: properties} spreading the DataNode and NodeManager
+    # directories of host over its data disks
+    directories = dataDirectories(host)
+    if not directories:
+        return {}
+    return {
+        "hdfs-site.xml": {
+            "dfs.datanode.data.dir": ",".join("file://%s" % directory for directory
+                                              in directories["dfs.datanode.data.dir"]),
+        },
+        "yarn-site.xml": {
+            "yarn.nodemanager.local-dirs": ",".join(directories["yarn.nodemanager.local-dirs"]),
+            "yarn.nodemanager.log-dirs": ",".join(directories["yarn.nodemanager.log-dirs"]),
+        },
+    }
+
+@runs_once
 def bootstrap():
-    installDependencies()
-    setupEnvironment()
-    setupHosts()
-    bootstrapHadoopYarn()
-    bootstrapZK()
-    journalNodeOps('start')
+    # Steps run as soon as the steps they depend on are done (on the same
+    # host, for per-host steps), so hosts don't wait for each other and a
+    # failure only stops what depends on it.
+    for warning in TOPOLOGY.quorumWarnings():
+        warn(warning)
+    graph = TaskGraph()
+    graph.add("installDependencies", installDependencies)
+    graph.add("setupEnvironment", setupEnvironment)
+    graph.add("setupHosts", setupHosts, scope=RUNS_ONCE,
+              hosts=[RESOURCEMANAGER_HOST])
+    graph.add("distributePackages", distributePackages, scope=RUNS_ONCE,
+              collect=packagesDistributed)
+    # bootstrapHadoopYarn, in steps
+    graph.add("prepareDisks", prepareDisks)
+    graph.add("installHadoop", installHadoop,
+              deps=["installDependencies", "distributePackages", "prepareDisks"])
+    # Container sizes and the rack mapping depend on every host's facts, so
+    # these are collected once every host has its disks mounted, and the
+    # sizes computed from them here, before any config runs
+    graph.add("gatherClusterFacts", gatherClusterFacts, scope=RUNS_ONCE,
+              deps=["prepareDisks"], collect=useClusterFacts)
+    graph.add("configHadoop", config, deps=["installHadoop", "gatherClusterFacts"])
+    graph.add("bootstrapZK", bootstrapZK, hosts=daemonHosts("zookeeper"),
+              deps=["installDependencies", "setupEnvironment", "setupHosts",
+                    "distributePackages", "prepareDisks"])
+    graph.add("startJournalNodes", journalNodeOps, args=("start",),
+              hosts=daemonHosts("journalnode"),
+              deps=["setupEnvironment", "setupHosts", "configHadoop"])
+    if NATIVE_CODECS:
+        # The check needs Hadoop and its environment on every host, and its
+        # codec then goes into the config configHadoop wrote
+        graph.add("checkNativeCodecs", checkNativeCodecs, scope=RUNS_ONCE,
+                  deps=["setupEnvironment", "configHadoop"],
+                  collect=useMapOutputCodec)
+        graph.add("configNativeCodecs", config, deps=["checkNativeCodecs"])
+    graph.run(BOOTSTRAP_WORKERS)
+
+def distributePackages():
+    if PACKAGE_RELAY:
+        distributeHadoopPackage()
+        distributeZookeeperPackage()
+
+_packagesDistributed = False
+
+def packagesDistributed(value=None):
+    # Called once distributePackages is done (in another process, when run
+    # by bootstrap), so that install and install_ZK don't relay them again
+    global _packagesDistributed
+    _packagesDistributed = True
 
 def bootstrapHadoopYarn():
+    prepareDisks()
+    installHadoop()
+    #installDependencies()
+    #setupEnvironment()
+    config()
+    #setupHosts()
+    #formatHdfs()
+
+def prepareDisks():
     with settings(warn_only=True):
         if EC2_INSTANCE_STORAGEDEV and run("mountpoint /mnt").failed:
             sudo("mkfs.ext4 %s" % EC2_INSTANCE_STORAGEDEV)
             sudo("mount %s /mnt" % EC2_INSTANCE_STORAGEDEV)
             sudo("chmod 0777 /mnt")
             sudo("rm -rf /tmp/hadoop-ubuntu")
+    if DATA_DISKS:
+        prepareDataDisks()
+
+def installHadoop():
     ensureImportantDirectoriesExist()
-    #installDependencies()
     install()
-    #setupEnvironment()
-    config()
-    #setupHosts()
-    #formatHdfs()
 
 def bootstrapZK():
     ensureImportantZKDirectoriesExist()
@@ -328,66 +861,202 @@ def bootstrapZK():
     startZKserver()
 
 def ensureImportantDirectoriesExist():
-    for importantDir in IMPORTANT_DIRS:
-        ensureDirectoryExists(importantDir)
+    ensureDirectoriesExist(IMPORTANT_DIRS)
 def install():
     installDirectory = os.path.dirname(HADOOP_PREFIX)
+    if PACKAGE_RELAY and not _packagesDistributed:
+        distributeHadoopPackage()
     run("mkdir -p %s" % installDirectory)
     with cd(installDirectory):
-        with settings(warn_only=True):
-            if run("test -f %s.tar.gz" % HADOOP_PACKAGE).failed:
-                run("wget -O %s.tar.gz %s" % (HADOOP_PACKAGE, HADOOP_PACKAGE_URL))
-        run("tar --overwrite -xf %s.tar.gz" % HADOOP_PACKAGE)
+        if not PACKAGE_RELAY:
+            fetchPackage(HADOOP_PACKAGE_URL, "%s.tar.gz" % HADOOP_PACKAGE,
+                         HADOOP_PACKAGE_SHA512_URL)
+        activatePackage("%s.tar.gz" % HADOOP_PACKAGE, HADOOP_PREFIX)
+
+@runs_once
+def distributeHadoopPackage():
+    distributeCachedPackage(HADOOP_PACKAGE_URL, "%s.tar.gz" % HADOOP_PACKAGE,
+                            os.path.dirname(HADOOP_PREFIX), HADOOP_PACKAGE_SHA512_URL)
+
+def rollbackInstall():
+    # Points HADOOP_PREFIX and ZOOKEEPER_PREFIX back to the versions they
+    # pointed to before the last install switched them. Running it again
+    # rolls forward. Daemons have to be restarted to pick up the change.
+    for prefix in [HADOOP_PREFIX, ZOOKEEPER_PREFIX]:
+        if not currentFacts().isLink(prefix + ".previous"):
+            print("No previous version of %s to roll back to" % prefix)
+            continue
+        currentFacts().invalidate(prefix, prefix + ".previous")
+        run("_current=`readlink %(prefix)s` && _previous=`readlink %(prefix)s.previous` && "
+            "%(switchBack)s && %(switchPrevious)s && echo \"$_previous\"" %
+            {"prefix": prefix,
+             "switchBack": switchLinkCommand(prefix, "$_previous"),
+             "switchPrevious": switchLinkCommand(prefix + ".previous", "$_current")})
 
 def config():
-    changeHadoopProperties("core-site.xml", CORE_SITE_VALUES)
-    changeHadoopProperties("hdfs-site.xml", HDFS_SITE_VALUES)
-    changeHadoopProperties("yarn-site.xml", YARN_SITE_VALUES)
-    changeHadoopProperties("mapred-site.xml", MAPRED_SITE_VALUES)
+    syncTopologyScript()
+    ensureDomainSocketDirectory()
+    jvmFiles = configJvmProfiles() if JVM_PROFILES else []
+    if not CONFIGURATION_FILES_CLEAN:
+        # Merged files depend on what's already on each host, so they can't
+        # be rendered here. The remote helper still skips unchanged files.
+        changedFiles = changeHadoopPropertyFiles(hadoopSiteValues(env.host))
+        flagRestarts(changedFiles)
+        return jvmFiles + changedFiles + pushConfigFiles(topologyFiles())
+    return jvmFiles + pushConfigFiles(hadoopConfigFiles(env.host) + topologyFiles())
+
+def syncConfig():
+    # Same as config() + config_ZK(), with a single hash query per host
+    if not CONFIGURATION_FILES_CLEAN:
+        return config() + pushConfigFiles(zookeeperConfigFiles(env.host))
+    syncTopologyScript()
+    ensureDomainSocketDirectory()
+    jvmFiles = configJvmProfiles() if JVM_PROFILES else []
+    return jvmFiles + pushConfigFiles(hadoopConfigFiles(env.host) + topologyFiles() +
+                                      zookeeperConfigFiles(env.host))
+
+def ensureDomainSocketDirectory():
+    # Creates the directory of the DataNode's domain socket with the
+    # ownership and permissions HDFS insists on (see HDFS_DOMAIN_SOCKET_PATH)
+    if not HDFS_SHORT_CIRCUIT_READS or "datanode" not in hostDaemons():
+        return
+    directory = os.path.dirname(HDFS_DOMAIN_SOCKET_PATH)
+    if currentFacts().isDirectory(directory):
+        return
+    sudo("mkdir -p %(dir)s && chown %(user)s %(dir)s && chmod 0755 %(dir)s" %
+         {"dir": directory, "user": env.user})
+    currentFacts().invalidate(directory)
+
+@parallel
+def shortCircuitReadStatus():
+    # None if the DataNode of this host listens on its domain socket, and
+    # why it doesn't (from its log) otherwise
+    with settings(hide("everything"), warn_only=True):
+        if run("test -S %s" % HDFS_DOMAIN_SOCKET_PATH).succeeded:
+            return None
+        reason = run("grep -h -i 'short-circuit\\|domain socket' %s | tail -n 1" %
+                     os.path.join(HADOOP_PREFIX, "logs", "hadoop-*-datanode-*.log"))
+    return reason.strip() or "%s doesn't exist" % HDFS_DOMAIN_SOCKET_PATH
+
+def configJvmProfiles():
+    # Sets the JVM options of the daemons of this host in their env files,
+    # through a managed block in each. Returns the files that changed.
+    daemons = hostDaemons()
+    heaps = dict((daemon, daemonHeap(env.host, daemon)) for daemon in daemons)
+    memoryMb = currentFacts().memoryMb()
+    if memoryMb and sum(heaps.values()) > 0.8 * memoryMb:
+        warn("The daemons of %s get %dMB of heap out of its %dMB of memory" %
+             (env.host, sum(heaps.values()), memoryMb))
+    ensureDirectoriesExist([JVM_GC_LOG_DIR])
+
+    changedFiles = []
+    for fileName, lines in sorted(envFileLines(heaps, JVM_GC_LOG_DIR).items()):
+        if fileName == "zookeeper-env.sh":
+            if "zookeeper" not in daemons:
+                continue
+            filePath = os.path.join(ZOOKEEPER_CONF, fileName)
+        else:
+            filePath = os.path.join(HADOOP_CONF, fileName)
+        if replaceManagedBlock(filePath, lines):
+            changedFiles.append(filePath)
+    flagRestarts(changedFiles)
+    return changedFiles
+
+def daemonHeap(host, daemon):
+    # Heap (in MB) of daemon on host
+    if not JVM_PROFILES:
+        return DAEMON_HEAP_MB.get(daemon, 0)
+    if daemon in JVM_HEAP_MB:
+        return JVM_HEAP_MB[daemon]
+    return heapMb(daemon, clusterFacts(host).memoryMb(), NAMENODE_EXPECTED_OBJECTS)
+
+def hadoopSiteValues(host=None):
+    # With a host, the values that depend on its hardware are filled in
+    siteValues = [
+        ("core-site.xml", CORE_SITE_VALUES),
+        ("hdfs-site.xml", HDFS_SITE_VALUES),
+        ("yarn-site.xml", YARN_SITE_VALUES),
+        ("mapred-site.xml", MAPRED_SITE_VALUES),
+    ]
+    if host is None:
+        return siteValues
+    hostValues = {}
+    for values in ([resourceSiteValues(host)] if AUTO_SIZE_RESOURCES else []) + \
+            ([dataDirectorySiteValues(host)] if DATA_DISKS else []):
+        for fileName, propertyDict in values.items():
+            hostValues.setdefault(fileName, {}).update(propertyDict)
+    return [(fileName, dict(propertyDict, **hostValues.get(fileName, {})))
+            for fileName, propertyDict in siteValues]
+
+def hadoopConfigFiles(host=None):
+    return [(os.path.join(HADOOP_CONF, fileName),
+             renderConfiguration(None, sorted((str(key), str(value))
+                                              for key, value in propertyDict.items())))
+            for fileName, propertyDict in hadoopSiteValues(host) if propertyDict]
+
+def zookeeperConfigFiles(host=None):
+    return [(os.path.join(ZOOKEEPER_CONF, "zoo.cfg"), renderZKConfig(zookeeperConfValues(host)))]
+
+def zookeeperConfValues(host=None):
+    # With a host, its transaction log directory is filled in
+    return dict(ZOOKEEPER_CONF_VALUES, dataLogDir=zookeeperDataLogDir(host))
+
+def zookeeperDataLogDir(host=None):
+    # Where ZooKeeper keeps its transaction log on host (see
+    # ZOOKEEPER_DATA_LOG_MOUNT)
+    if DATA_DISKS and host is not None and \
+            any(disk.get("MOUNTPOINT") == ZOOKEEPER_DATA_LOG_MOUNT
+                for disk in currentFacts(host).disks()):
+        return os.path.join(ZOOKEEPER_DATA_LOG_MOUNT, "zookeeper")
+    return ZOOKEEPER_DATA_DIR
 
 def formatHdfs():
     if env.host == NAMENODE_HOST:
         operationInHadoopEnvironment(r"/home/ubuntu/Programs/hadoop-2.8.5/bin/hdfs namenode -format")
 
 def changeHadoopProperties(fileName, propertyDict):
-    if not fileName or not propertyDict:
-        return
+    changeHadoopPropertyFiles([(fileName, propertyDict)])
+
+def changeHadoopPropertyFiles(propertyFiles):
+    # The helper upload and the rewrite of every file happen in a single
+    # remote command, with a single run of replaceHadoopProperty.py that reads
+    # the properties of every file from a JSON manifest on stdin. Only files
+    # whose content changes are backed up and rewritten.
+    # Returns the names of the files that changed.
+    manifest = dict((fileName, dict((str(key), str(value))
+                                    for key, value in propertyDict.items()))
+                    for fileName, propertyDict in propertyFiles
+                    if fileName and propertyDict)
+    if not manifest:
+        return []
+
+    options = "--backup"
+    if CONFIGURATION_FILES_CLEAN:
+        options += " --clean"
 
     with cd(HADOOP_CONF):
+        batch = CommandBatch()
+        queueHelperSync(batch, "replaceHadoopProperty.py")
         with settings(warn_only=True):
-            import hashlib
-            replaceHadoopPropertyHash = \
-                hashlib.md5(
-                    open("replaceHadoopProperty.py", 'rb').read()
-                ).hexdigest()
-            if run("test %s = `md5sum replaceHadoopProperty.py | cut -d ' ' -f 1`"
-                   % replaceHadoopPropertyHash).failed:
-                put("replaceHadoopProperty.py", HADOOP_CONF + "/")
-                run("chmod +x replaceHadoopProperty.py")
+            replaced = batch.run("./replaceHadoopProperty.py %s --manifest -" % options,
+                                 stdin=json.dumps(manifest, sort_keys=True))
+        batch.execute()
 
-        with settings(warn_only=True):
-            if not run("test -f %s" % fileName).failed:
-                op = "cp"
-
-                if CONFIGURATION_FILES_CLEAN:
-                    op = "mv"
-
-                currentBakNumber = getLastBackupNumber(fileName) + 1
-                run("%(op)s %(file)s %(file)s.bak%(bakNumber)d" %
-                    {"op": op, "file": fileName, "bakNumber": currentBakNumber})
-
-        run("touch %s" % fileName)
+    if replaced.return_code not in (0, REPLACE_UNCHANGED):
+        abort("replaceHadoopProperty.py failed on %s:\n%s" % (env.host, replaced))
 
-        command = "./replaceHadoopProperty.py '%s' %s" % (fileName,
-            " ".join(["'%s' '%s'" % (str(key), str(value)) for key, value in propertyDict.items()]))
-        run(command)
+    changedFiles = [line.split(": ", 1)[1] for line in str(replaced).splitlines()
+                    if line.startswith("changed: ")]
+    currentFacts().invalidate(*[os.path.join(HADOOP_CONF, fileName)
+                                for fileName in changedFiles])
+    return changedFiles
 
 def formatZK_NN():
     if env.host == NAMENODE_HOST:
         operationInHadoopEnvironment(r"/home/ubuntu/Programs/hadoop-2.8.5/bin/hdfs zkfc -formatZK")
 
 def formatZK_SNN():
-    if env.host == SLAVE_HOSTS[0]:
+    if env.host in standbyNamenodeHosts():
         operationInHadoopEnvironment(r"/home/ubuntu/Programs/hadoop-2.8.5/bin/hdfs zkfc -formatZK")
 
 def operation_Zkfc_NN(operation):
@@ -395,11 +1064,11 @@ def operation_Zkfc_NN(operation):
         operationInHadoopEnvironment(r"/home/ubuntu/Programs/hadoop-2.8.5/sbin/hadoop-daemon.sh %s zkfc"%operation)
 
 def operation_Zkfc_SNN(operation):
-    if env.host == SLAVE_HOSTS[0]:
+    if env.host in standbyNamenodeHosts():
         operationInHadoopEnvironment(r"/home/ubuntu/Programs/hadoop-2.8.5/sbin/hadoop-daemon.sh %s zkfc"%operation)
 
 def bootstrapStandby():
-    if env.host == SLAVE_HOSTS[0]:
+    if env.host in standbyNamenodeHosts():
         operationInHadoopEnvironment(r"/home/ubuntu/Programs/hadoop-2.8.5/bin/hdfs namenode -bootstrapStandby")
         operationInHadoopEnvironment(r"/home/ubuntu/Programs/hadoop-2.8.5/sbin/hadoop-daemon.sh start namenode")
 def operationInHadoopEnvironment(operation):
@@ -407,49 +1076,28 @@ def operationInHadoopEnvironment(operation):
         command = operation
         print (HADOOP_PREFIX)
         if ENVIRONMENT_FILE_NOTAUTOLOADED:
-            with settings(warn_only=True):
-                import hashlib
-                executeInHadoopEnvHash = \
-                    hashlib.md5(
-                        open("executeInHadoopEnv.sh", 'rb').read()
-                    ).hexdigest()
-                if run("test %s = `md5sum executeInHadoopEnv.sh | cut -d ' ' -f 1`"
-                    % executeInHadoopEnvHash).failed:
-                    put("executeInHadoopEnv.sh", HADOOP_PREFIX + "/")
-                    run("chmod +x executeInHadoopEnv.sh")
+            syncHelper("executeInHadoopEnv.sh", HADOOP_PREFIX)
             command = ("./executeInHadoopEnv.sh %s " % ENVIRONMENT_FILE) + command
-            print (command)
-            run(command)
+        print (command)
+        return run(command)
 #        sudo(command,user ='hadoop')
 @parallel
 def journalNodeOps(operation):
     operationInHadoopEnvironment(r"/home/ubuntu/Programs/hadoop-2.8.5/sbin/hadoop-daemon.sh %s journalnode" % operation)
 
+@runs_once
 def namenode_secondarynamenode_OPS():
-
-    formatHdfs()
+    # First start of the HA cluster (ZooKeeper and the JournalNodes already
+    # running): formats the first NameNode, copies its metadata to the
+    # standby and initializes the failover state in ZooKeeper (shared by
+    # both NameNodes, so formatted once). Everything else then starts tier
+    # by tier, like start does.
     with settings(warn_only=True):
-        if (env.host == NAMENODE_HOST):
-            operationInHadoopEnvironment(r"/home/ubuntu/Programs/hadoop-2.8.5/sbin/hadoop-daemon.sh start namenode")
-        bootstrapStandby()
-        #startZKserver()
-        # Start/Stop DataNode on all slave hosts
-        if env.host in SLAVE_HOSTS:
-            operationInHadoopEnvironment(r"/home/ubuntu/Programs/hadoop-2.8.5/sbin/hadoop-daemon.sh start datanode")
-
-        formatZK_NN()
-        operation_Zkfc_NN('start')
-        formatZK_SNN()
-        operation_Zkfc_SNN('start')
-
-        # Start/Stop NodeManager on all container hosts
-        if env.host in SLAVE_HOSTS:
-            operationInHadoopEnvironment(r"/home/ubuntu/Programs/hadoop-2.8.5/sbin/yarn-daemon.sh start nodemanager" )
-        # Start/Stop ResourceManager
-        if (env.host == SLAVE_HOSTS[0] or env.host == NAMENODE_HOST):
-            operationInHadoopEnvironment(r"/home/ubuntu/Programs/hadoop-2.8.5/sbin/yarn-daemon.sh start resourcemanager")
-        if (env.host == JOBHISTORY_HOST):
-            operationInHadoopEnvironment(r"/home/ubuntu/Programs/hadoop-2.8.5/sbin/mr-jobhistory-daemon.sh start historyserver" )
+        execute(formatHdfs, hosts=[NAMENODE_HOST])
+        execute(operationOnDaemon, "namenode", "start", hosts=[NAMENODE_HOST])
+        execute(bootstrapStandby, hosts=standbyNamenodeHosts())
+        execute(formatZK_NN, hosts=[NAMENODE_HOST])
+    startCluster()
 
 def operationOnHadoopDaemons(operation):
 
@@ -484,15 +1132,310 @@ def resetAll():
         sudo("rm -rf /HA/data")
         sudo("rm -rf  /home/ubuntu/Programs/hadoop-2.8.5/logs/*")
         sudo("rm -rf  /home/ubuntu/Programs/hadoop-2.8.5/etc/hadoop/*.bak*")
+    currentFacts().invalidate("/HA/data", HADOOP_PREFIX)
 
+@runs_once
 def start():
-    operationOnHadoopDaemons("start")
+    startCluster()
+@runs_once
 def stop():
-    operationOnHadoopDaemons("stop")
-    stopZKserver()
-    if env.host == SLAVE_HOSTS[0]:
-        operationInHadoopEnvironment(r"/home/ubuntu/Programs/hadoop-2.8.5/sbin/hadoop-daemon.sh stop namenode")
+    stopCluster()
+
+def startCluster(daemons=None):
+    # Starts the tiers in order, each on all of its hosts at once, and only
+    # moves on once the tier is ready. With daemons, only those are started.
+    health = clusterHealth()
+    latencies = []
+    for tier in daemonTiers(daemons):
+        begin = time.time()
+        ready = executeOnHosts(operationOnTier, tier, "start", START_TIMEOUT,
+                               hosts=tierHosts(tier))
+        notReady = sorted(host for host, isReady in ready.items() if not isReady)
+        if notReady:
+            abort("%s not listening on %s after %ds" %
+                  (", ".join(tier), ", ".join(notReady), START_TIMEOUT))
+        try:
+            if "zkfc" in tier and health.namenodes:
+                health.waitFor("an active NameNode",
+                               lambda: health.activeNamenode() is not None, START_TIMEOUT)
+            if "resourcemanager" in tier and health.resourcemanagers:
+                health.waitFor("an active ResourceManager",
+                               lambda: health.activeResourcemanager() is not None, START_TIMEOUT)
+        except HealthError as e:
+            abort(str(e))
+        if HDFS_SHORT_CIRCUIT_READS and "datanode" in tier:
+            # The socket is open before the DataNode's ports, unless
+            # libhadoop (or the socket's directory) is missing
+            status = executeOnHosts(shortCircuitReadStatus, hosts=daemonHosts("datanode"))
+            failed = sorted(host for host, reason in status.items() if reason)
+            if failed:
+                abort("Short-circuit reads are off on %s:\n%s" % (
+                    ", ".join(failed), "\n".join("  %s: %s" % (host, status[host])
+                                                  for host in failed)))
+        latencies.append((tier, time.time() - begin))
+    reportTiers(latencies)
+
+def stopCluster(daemons=None):
+    # Stops the tiers in reverse start order, each on all of its hosts at
+    # once. Hosts where a tier is still listening after the grace period get
+    # every java process killed. With daemons, only those are stopped.
+    latencies = []
+    for tier in reversed(daemonTiers(daemons)):
+        begin = time.time()
+        stopped = executeOnHosts(operationOnTier, tier, "stop", STOP_GRACE_SECONDS,
+                                 hosts=tierHosts(tier))
+        stuck = sorted(host for host, isStopped in stopped.items() if not isStopped)
+        if stuck:
+            print("%s still listening on %s after %ds, killing every java process there" %
+                  (", ".join(tier), ", ".join(stuck), STOP_GRACE_SECONDS))
+            executeOnHosts(forceStopEveryJava, hosts=stuck)
+        latencies.append((tier, time.time() - begin))
+    reportTiers(latencies)
+
+@parallel
+def operationOnTier(daemons, operation, timeout):
+    # Starts (or stops) those of daemons that run on this host and waits
+    # until their ports are open (or closed). Returns True if they got there
+    # within timeout seconds.
+    daemons = [daemon for daemon in daemons if daemon in hostDaemons()]
+    with settings(warn_only=True):
+        # Starting a daemon that is already running (or stopping one that
+        # isn't) fails, but it's the ports that tell whether the host is
+        # where it should be
+        for daemon in daemons:
+            operationOnDaemon(daemon, operation)
+        ports = [port for daemon in daemons for port in daemonPorts(daemon)]
+        return run(waitForPortsCommand(env.host, ports, operation == "start", timeout)).succeeded
+
+def daemonTiers(daemons=None):
+    # DAEMONS grouped so that every daemon comes after the ones it depends
+    # on, and the daemons of a tier don't depend on each other. With daemons,
+    # the tiers only keep those.
+    if daemons is not None:
+        return [selected for selected in ([daemon for daemon in tier if daemon in daemons]
+                                          for tier in daemonTiers()) if selected]
+    tiers = []
+    placed = set()
+    while len(placed) < len(DAEMONS):
+        tier = [daemon for daemon in DAEMONS if daemon not in placed and
+                all(dependency in placed for dependency in DAEMON_DEPENDENCIES.get(daemon, []))]
+        if not tier:
+            abort("Circular dependencies between %s" %
+                  ", ".join(daemon for daemon in DAEMONS if daemon not in placed))
+        tiers.append(tier)
+        placed.update(tier)
+    return tiers
+
+def tierHosts(tier):
+    seen = set()
+    return [host for daemon in tier for host in daemonHosts(daemon)
+            if host and host not in seen and not seen.add(host)]
+
+def daemonPorts(daemon):
+    # Ports each daemon listens on once it's ready. Standby ResourceManagers
+    # only open their RPC ports when they become active.
+    return {
+        "zookeeper": [int(ZOOKEEPER_CONF_VALUES["clientPort"])],
+        "journalnode": [8485],
+        "namenode": [9000],
+        "zkfc": [8019],
+        "datanode": [50010],
+        "resourcemanager": [8088],
+        "nodemanager": [8042],
+        "historyserver": [JOBHISTORY_PORT],
+    }[daemon]
+
+def waitForPortsCommand(host, ports, listening, timeout):
+    # Waits until every port of host accepts connections (or, if not
+    # listening, until none does), for at most timeout seconds
+    if not ports:
+        return "true"
+    checks = ["(true </dev/tcp/%s/%d) 2>/dev/null" % (host, port) for port in ports]
+    if listening:
+        condition = " && ".join(checks)
+    else:
+        condition = "! { %s; }" % " || ".join(checks)
+    return ("_end=$((`date +%%s` + %d)); until %s; do "
+            "if [ `date +%%s` -ge $_end ]; then exit 1; fi; sleep 1; done" %
+            (timeout, condition))
+
+def reportTiers(latencies):
+    print("")
+    print("%-50s %8s" % ("Tier", "Seconds"))
+    for tier, seconds in latencies:
+        print("%-50s %8.1f" % (", ".join(tier), seconds))
+    print("%-50s %8.1f" % ("Total", sum(seconds for tier, seconds in latencies)))
+
+
+def restartChanged():
+    # Restarts the daemons of this host whose config changed since they were
+    # last restarted by this task
+    with settings(warn_only=True):
+        flagged = run("cat %s" % RESTART_FLAGS_FILE)
+    if flagged.failed:
+        return
+
+    flaggedDaemons = set(flagged.split())
+    for daemon in hostDaemons():
+        if daemon in flaggedDaemons:
+            operationOnDaemon(daemon, "stop")
+            operationOnDaemon(daemon, "start")
+    run("rm -f %s" % RESTART_FLAGS_FILE)
+
+@runs_once
+def rollingRestart(scope="all"):
+    # Restarts the HDFS and YARN daemons while keeping the cluster up.
+    # "masters" restarts the standby NameNode and ResourceManager first and
+    # fails over to them before restarting the active ones, "workers"
+    # restarts the DataNodes and NodeManagers in batches, "all" does both.
+    # e.g. fab rollingRestart:workers
+    if ROLLING_RESTART_CHECK_ZK:
+        zkHealth()
+    health = clusterHealth()
+    try:
+        if scope in ("all", "masters"):
+            rollingRestartNamenodes(health)
+            rollingRestartResourcemanagers(health)
+        if scope in ("all", "workers"):
+            rollingRestartWorkers(health)
+    except HealthError as e:
+        abort(str(e))
 
+@runs_once
+def zkHealth():
+    # Prints the role, latency, outstanding requests, znodes and synced
+    # followers of every ZooKeeper server, and aborts if the ensemble isn't
+    # healthy (see ZK_HEALTH_MAX_AVG_LATENCY_MS)
+    results = probeEnsemble(daemonHosts("zookeeper"), int(ZOOKEEPER_CONF_VALUES["clientPort"]),
+                            ZK_PROBE_TIMEOUT)
+    print(formatTable(results))
+    problems = healthProblems(results, ZK_HEALTH_MAX_AVG_LATENCY_MS, ZK_HEALTH_MAX_OUTSTANDING)
+    if problems:
+        abort("The ZooKeeper ensemble isn't healthy:\n%s" %
+              "\n".join("  %s" % problem for problem in problems))
+
+def rollingRestartNamenodes(health):
+    namenodes = health.namenodes
+    active = health.activeNamenode()
+    if active is None:
+        raise HealthError("No active NameNode, not restarting the NameNodes")
+    standbys = sorted(namenodeId for namenodeId in namenodes if namenodeId != active)
+    if not standbys:
+        print("No standby NameNode to fail over to, not restarting %s" % active)
+        return
+
+    for namenodeId in standbys:
+        restartDaemonOn(addressHost(namenodes[namenodeId]), "namenode")
+        health.waitFor("NameNode %s to be standby" % namenodeId,
+                       lambda: health.namenodeState(namenodeId) == "standby",
+                       ROLLING_RESTART_TIMEOUT)
+
+    with settings(host_string=addressHost(namenodes[standbys[0]])):
+        operationInHadoopEnvironment("%s haadmin -failover %s %s" %
+                                     (os.path.join(HADOOP_PREFIX, "bin/hdfs"), active, standbys[0]))
+    health.waitFor("NameNode %s to be active" % standbys[0],
+                   lambda: health.namenodeState(standbys[0]) == "active",
+                   ROLLING_RESTART_TIMEOUT)
+
+    restartDaemonOn(addressHost(namenodes[active]), "namenode")
+    health.waitFor("NameNode %s to be standby" % active,
+                   lambda: health.namenodeState(active) == "standby",
+                   ROLLING_RESTART_TIMEOUT)
+
+def rollingRestartResourcemanagers(health):
+    resourcemanagers = health.resourcemanagers
+    active = health.activeResourcemanager()
+    if active is None:
+        raise HealthError("No active ResourceManager, not restarting the ResourceManagers")
+    standbys = sorted(rmId for rmId in resourcemanagers if rmId != active)
+    if not standbys:
+        print("No standby ResourceManager to fail over to, not restarting %s" % active)
+        return
+
+    for rmId in standbys:
+        restartDaemonOn(addressHost(resourcemanagers[rmId]), "resourcemanager")
+        health.waitFor("ResourceManager %s to be standby" % rmId,
+                       lambda: health.resourcemanagerState(rmId) == "STANDBY",
+                       ROLLING_RESTART_TIMEOUT)
+
+    # With automatic failover (the default with HA), a standby takes over as
+    # soon as the active ResourceManager stops
+    activeHost = addressHost(resourcemanagers[active])
+    execute(operationOnDaemon, "resourcemanager", "stop", hosts=[activeHost])
+    health.waitFor("another ResourceManager to take over from %s" % active,
+                   lambda: health.activeResourcemanager() not in (None, active),
+                   ROLLING_RESTART_TIMEOUT)
+    execute(operationOnDaemon, "resourcemanager", "start", hosts=[activeHost])
+    health.waitFor("ResourceManager %s to be standby" % active,
+                   lambda: health.resourcemanagerState(active) == "STANDBY",
+                   ROLLING_RESTART_TIMEOUT)
+
+def rollingRestartWorkers(health):
+    dataNodes = daemonHosts("datanode")
+    nodeManagers = daemonHosts("nodemanager")
+    seen = set()
+    workers = [host for host in dataNodes + nodeManagers
+               if host not in seen and not seen.add(host)]
+    batches = planBatches(workers, ROLLING_RESTART_BATCH_SIZE, ROLLING_RESTART_MIN_CAPACITY)
+
+    for number, batch in enumerate(batches, 1):
+        # Only start if the workers left up are enough, counting any that
+        # are already down
+        downDataNodes = len([host for host in batch if host in dataNodes])
+        downNodeManagers = len([host for host in batch if host in nodeManagers])
+        health.waitFor(
+            "enough live workers to restart batch %d of %d (%s)" % (number, len(batches), ", ".join(batch)),
+            lambda: health.liveDataNodes() - downDataNodes >=
+                    requiredUp(len(dataNodes), ROLLING_RESTART_MIN_CAPACITY) and
+                    health.activeNodeManagers() - downNodeManagers >=
+                    requiredUp(len(nodeManagers), ROLLING_RESTART_MIN_CAPACITY),
+            ROLLING_RESTART_TIMEOUT)
+
+        restarted = execute(restartDaemons, ["datanode", "nodemanager"], hosts=batch)
+        for host in batch:
+            if host in dataNodes:
+                health.waitFor("DataNode on %s to register" % host,
+                               lambda: health.dataNodeRegistered(host),
+                               ROLLING_RESTART_TIMEOUT)
+            if host in nodeManagers:
+                health.waitFor("NodeManager on %s to register" % host,
+                               lambda: health.nodeManagerRegistered(host, restarted[host]),
+                               ROLLING_RESTART_TIMEOUT)
+
+@parallel
+def restartDaemons(daemons):
+    # Restarts those of daemons that run on this host. Returns the time (on
+    # this host's clock) the restart started at.
+    started = int(run("date +%s"))
+    for daemon in daemons:
+        if daemon in hostDaemons():
+            operationOnDaemon(daemon, "stop")
+            operationOnDaemon(daemon, "start")
+    return started
+
+def restartDaemonOn(host, daemon):
+    execute(restartDaemons, [daemon], hosts=[host])
+
+def clusterHealth():
+    return ClusterHealth(NAMENODE_HOST, namenodeAddresses(), resourcemanagerAddresses())
+
+def namenodeAddresses():
+    # {NameNode id: HTTP address} of the HA NameNodes
+    return haAddresses(HDFS_SITE_VALUES, "dfs.ha.namenodes.%s" % CLUSTER_NAME,
+                       "dfs.namenode.http-address.%s.%%s" % CLUSTER_NAME)
+
+def resourcemanagerAddresses():
+    # {ResourceManager id: web address} of the HA ResourceManagers
+    return haAddresses(YARN_SITE_VALUES, "yarn.resourcemanager.ha.rm-ids",
+                       "yarn.resourcemanager.webapp.address.%s")
+
+def haAddresses(siteValues, idsProperty, addressProperty):
+    ids = [haId.strip() for haId in str(siteValues.get(idsProperty, "")).split(",")]
+    return dict((haId, str(siteValues[addressProperty % haId]))
+                for haId in ids if haId and addressProperty % haId in siteValues)
+
+def addressHost(address):
+    return address.rsplit(":", 1)[0]
 
 def test():
     if env.host == RESOURCEMANAGER_HOST:
@@ -503,60 +1446,267 @@ def testMapReduce():
         operationInHadoopEnvironment(r"/home/ubuntu/Programs/hadoop-2.8.5/bin/hadoop dfs -rm -f -r out")
         operationInHadoopEnvironment(r"/home/ubuntu/Programs/hadoop-2.8.5/bin/hadoop jar /home/ubuntu/Programs/hadoop-2.8.5/share/hadoop/mapreduce/hadoop-mapreduce-examples-%s.jar randomwriter out" % HADOOP_VERSION)
 
+@runs_once
+def benchmark(suite="all"):
+    # Runs the benchmarks of suite ("dfsio", "terasort", "nnbench",
+    # "mrbench" or "all") and prints how they compare with the previous run
+    # e.g. fab benchmark:dfsio
+    suites = [("dfsio", benchmarkDFSIO), ("terasort", benchmarkTeraSort),
+              ("nnbench", benchmarkNNBench), ("mrbench", benchmarkMRBench)]
+    if suite != "all" and suite not in dict(suites):
+        abort("Unknown benchmark suite %s, expected one of: all, %s" %
+              (suite, ", ".join(name for name, task in suites)))
+    for name, task in suites:
+        if suite in ("all", name):
+            task()
+
+@runs_once
+def benchmarkDFSIO():
+    files = BENCHMARK_DFSIO_FILES_PER_DATANODE * len(daemonHosts("datanode"))
+    baseDir = os.path.join(BENCHMARK_HDFS_DIR, "TestDFSIO")
+    for mode in ["write", "read"]:
+        runBenchmark("dfsio-" + mode,
+                     "%s TestDFSIO -D test.build.data=%s -%s -nrFiles %d -size %s" %
+                     (benchmarkJar("jobclient"), baseDir, mode, files, BENCHMARK_DFSIO_FILE_SIZE),
+                     {"files": files, "fileSize": BENCHMARK_DFSIO_FILE_SIZE},
+                     parseTestDFSIO)
+    benchmarkCommand("%s TestDFSIO -D test.build.data=%s -clean" % (benchmarkJar("jobclient"), baseDir))
+
+@runs_once
+def benchmarkTeraSort():
+    # TeraGen writes 100-byte rows
+    rows = BENCHMARK_TERASORT_GB_PER_DATANODE * len(daemonHosts("datanode")) * 10 ** 7
+    baseDir = os.path.join(BENCHMARK_HDFS_DIR, "TeraSort")
+    directories = dict((name, os.path.join(baseDir, name)) for name in ["input", "output", "report"])
+    benchmarkCommand("bin/hdfs dfs -rm -r -f -skipTrash %s" % baseDir)
+    parameters = {"rows": rows}
+    runBenchmark("teragen", "%s teragen %d %s" % (benchmarkJar("examples"), rows, directories["input"]),
+                 parameters)
+    runBenchmark("terasort", "%s terasort %s %s" %
+                 (benchmarkJar("examples"), directories["input"], directories["output"]),
+                 parameters)
+    runBenchmark("teravalidate", "%s teravalidate %s %s" %
+                 (benchmarkJar("examples"), directories["output"], directories["report"]),
+                 parameters)
+    # The report only has "error" entries if the output isn't sorted
+    report = benchmarkCommand("bin/hdfs dfs -cat %s/part-r-*" % directories["report"])
+    if "error" in report:
+        warn("TeraValidate found errors in the TeraSort output:\n%s" % report)
+    benchmarkCommand("bin/hdfs dfs -rm -r -f -skipTrash %s" % baseDir)
+
+@runs_once
+def benchmarkNNBench():
+    maps = len(daemonHosts("datanode"))
+    files = BENCHMARK_NNBENCH_FILES_PER_DATANODE
+    baseDir = os.path.join(BENCHMARK_HDFS_DIR, "NNBench")
+    benchmarkCommand("bin/hdfs dfs -rm -r -f -skipTrash %s" % baseDir)
+    for operation in ["create_write", "open_read", "rename", "delete"]:
+        # The maps wait until startTime, so that they all hit the NameNode
+        # at once (by default that is two minutes later)
+        runBenchmark("nnbench-" + operation,
+                     "%s nnbench -operation %s -maps %d -reduces 1 -numberOfFiles %d "
+                     "-readFileAfterOpen true -baseDir %s -startTime $((`date +%%s` + 15))" %
+                     (benchmarkJar("jobclient"), operation, maps, files, baseDir),
+                     {"maps": maps, "filesPerMap": files},
+                     parseNNBench)
+    benchmarkCommand("bin/hdfs dfs -rm -r -f -skipTrash %s" % baseDir)
+
+@runs_once
+def benchmarkMRBench():
+    maps = len(daemonHosts("nodemanager"))
+    runBenchmark("mrbench", "%s mrbench -numRuns %d -maps %d -reduces 1 -baseDir %s" %
+                 (benchmarkJar("jobclient"), BENCHMARK_MRBENCH_RUNS, maps,
+                  os.path.join(BENCHMARK_HDFS_DIR, "MRBench")),
+                 {"runs": BENCHMARK_MRBENCH_RUNS, "maps": maps},
+                 parseMRBench)
+
+def benchmarkJar(kind):
+    jars = {
+        "jobclient": "share/hadoop/mapreduce/hadoop-mapreduce-client-jobclient-%s-tests.jar",
+        "examples": "share/hadoop/mapreduce/hadoop-mapreduce-examples-%s.jar",
+    }
+    return "bin/hadoop jar %s" % (jars[kind] % HADOOP_VERSION)
+
+def benchmarkCommand(command):
+    # Runs command in the Hadoop environment of the ResourceManager host
+    with settings(host_string=RESOURCEMANAGER_HOST):
+        return operationInHadoopEnvironment(command)
+
+def runBenchmark(name, command, parameters, parseMetrics=None):
+    # Runs a benchmark, stores its record and compares it with the previous
+    # run of the same benchmark
+    start = time.time()
+    output = benchmarkCommand(command)
+    duration = time.time() - start
+    record = benchmarkRecord(name, parameters, configHash(), duration,
+                             parseMetrics(output) if parseMetrics else {},
+                             parseCounters(output))
+    store = BenchmarkStore(BENCHMARK_RESULTS_DIR)
+    previous = store.previous(name)
+    print("Stored in %s" % store.save(record))
+    print(formatComparison(record, previous))
+    return record
+
+_configHash = None
+
+def configHash():
+    # Hash of the configuration files on the ResourceManager host, which the
+    # benchmark jobs are submitted with
+    global _configHash
+    if _configHash is None:
+        import hashlib
+        fileNames = [os.path.join(HADOOP_CONF, fileName)
+                     for fileName, propertyDict in hadoopSiteValues()]
+        with settings(hide('running', 'stdout'), host_string=RESOURCEMANAGER_HOST, warn_only=True):
+            hashes = run("md5sum %s" % " ".join(fileNames))
+        _configHash = hashlib.sha1(hashes.encode("utf-8")).hexdigest()
+    return _configHash
+
+@runs_once
+def experiment(variantsFile):
+    # Runs the workload under every config variant in variantsFile (see
+    # EXPERIMENT_RUNS) and ranks the variants by runtime
+    # e.g. fab experiment:variants.json
+    with open(variantsFile) as f:
+        description = json.load(f)
+    variants = description.get("variants", {})
+    variants.setdefault("baseline", {})
+    runs = int(description.get("runs", EXPERIMENT_RUNS))
+    prepare, beforeEachRun, command = experimentWorkload(
+        description.get("workload", EXPERIMENT_WORKLOAD))
+    # Before applyConfigVariant forks a worker per host
+    ensureClusterFacts()
+
+    for step in prepare:
+        benchmarkCommand(step)
+    summaries = {}
+    store = BenchmarkStore(BENCHMARK_RESULTS_DIR)
+    for name in sorted(variants):
+        print("Variant %s: %s" % (name, json.dumps(variants[name], sort_keys=True)))
+        durations = runExperimentVariant(variants[name], beforeEachRun, command, runs)
+        summaries[name] = summarizeRuns(durations)
+        store.save(benchmarkRecord("experiment-%s" % name,
+                                   {"workload": description.get("workload", EXPERIMENT_WORKLOAD),
+                                    "variant": variants[name], "durations": durations},
+                                   configHash(), sum(durations), summaries[name]))
+    print("\nExperiment results:")
+    print(formatRanking(summaries))
+
+def experimentWorkload(workload):
+    # (commands run once before the experiment, commands run before each
+    # run, command that is timed)
+    teraSortDir = os.path.join(BENCHMARK_HDFS_DIR, "experiment/TeraSort")
+    dfsioDir = os.path.join(BENCHMARK_HDFS_DIR, "experiment/TestDFSIO")
+    dfsio = "%s TestDFSIO -D test.build.data=%s -%%s -nrFiles %d -size %s" % (
+        benchmarkJar("jobclient"), dfsioDir,
+        BENCHMARK_DFSIO_FILES_PER_DATANODE * len(daemonHosts("datanode")), BENCHMARK_DFSIO_FILE_SIZE)
+    if workload == "terasort":
+        rows = BENCHMARK_TERASORT_GB_PER_DATANODE * len(daemonHosts("datanode")) * 10 ** 7
+        return (["bin/hdfs dfs -rm -r -f -skipTrash %s" % teraSortDir,
+                 "%s teragen %d %s/input" % (benchmarkJar("examples"), rows, teraSortDir)],
+                ["bin/hdfs dfs -rm -r -f -skipTrash %s/output" % teraSortDir],
+                "%(jar)s terasort %(dir)s/input %(dir)s/output" %
+                {"dir": teraSortDir, "jar": benchmarkJar("examples")})
+    if workload == "dfsio-write":
+        return [], [], dfsio % "write"
+    if workload == "dfsio-read":
+        return [dfsio % "write"], [], dfsio % "read"
+    if workload == "mrbench":
+        return [], [], "%s mrbench -numRuns 1 -maps %d -reduces 1 -baseDir %s" % (
+            benchmarkJar("jobclient"), len(daemonHosts("nodemanager")),
+            os.path.join(BENCHMARK_HDFS_DIR, "experiment/MRBench"))
+    return [], [], workload
+
+def runExperimentVariant(overrides, beforeEachRun, command, runs):
+    # Applies overrides ({fileName: properties}) on every host, restarts the
+    # daemons whose config changed, times runs runs of command (each after
+    # the beforeEachRun commands) and reverts the changes. Returns the
+    # durations of the runs.
+    global _configHash
+    _configHash = None
+    changed = executeOnHosts(applyConfigVariant, overrides)
+    daemons = set(daemon for fileNames in changed.values() for fileName in fileNames
+                  for daemon in CONFIG_FILE_DAEMONS.get(fileName, []))
+    try:
+        if daemons:
+            stopCluster(daemons)
+            startCluster(daemons)
+        durations = []
+        for attempt in range(runs):
+            for step in beforeEachRun:
+                benchmarkCommand(step)
+            start = time.time()
+            benchmarkCommand(command)
+            durations.append(time.time() - start)
+            print("Run %d of %d: %.1fs" % (attempt + 1, runs, durations[-1]))
+        return durations
+    finally:
+        changedHosts = [host for host, fileNames in changed.items() if fileNames]
+        if changedHosts:
+            executeOnHosts(revertConfigVariant, changed, hosts=changedHosts)
+        if daemons:
+            stopCluster(daemons)
+            startCluster(daemons)
+        _configHash = None
+
+@parallel
+def applyConfigVariant(overrides):
+    # Rewrites the site files overrides has changes for, with every other
+    # value as configured. Returns the files that changed (and were backed up).
+    siteValues = dict(hadoopSiteValues(env.host))
+    for fileName in overrides:
+        if fileName not in siteValues:
+            abort("%s is not one of the site files (%s)" % (fileName, ", ".join(sorted(siteValues))))
+    return changeHadoopPropertyFiles([(fileName, dict(siteValues[fileName], **properties))
+                                      for fileName, properties in overrides.items()])
+
+@parallel
+def revertConfigVariant(changed):
+    # Puts back the backups applyConfigVariant made on this host
+    for fileName in changed.get(env.host, []):
+        revertHadoopPropertiesChange(fileName)
+
 def ensureImportantZKDirectoriesExist():
-    for importantDir in IMPORTANT_ZK_DIRS:
-        ensureDirectoryExists(importantDir)
+    ensureDirectoriesExist(IMPORTANT_ZK_DIRS)
 
 def install_ZK():
     installDirectory = os.path.dirname(ZOOKEEPER_PREFIX)
+    if PACKAGE_RELAY and not _packagesDistributed:
+        distributeZookeeperPackage()
     run("mkdir -p %s" % installDirectory)
     with cd(installDirectory):
-        with settings(warn_only=True):
-            if run("test -f %s.tar.gz" % ZOOKEEPER_PACKAGE).failed:
-                run("wget -O %s.tar.gz %s" % (ZOOKEEPER_PACKAGE, ZOOKEEPER_PACKAGE_URL))
-        run("tar --overwrite -xf %s.tar.gz" % ZOOKEEPER_PACKAGE)
+        if not PACKAGE_RELAY:
+            fetchPackage(ZOOKEEPER_PACKAGE_URL, "%s.tar.gz" % ZOOKEEPER_PACKAGE,
+                         ZOOKEEPER_PACKAGE_SHA512_URL)
+        activatePackage("%s.tar.gz" % ZOOKEEPER_PACKAGE, ZOOKEEPER_PREFIX)
+
+@runs_once
+def distributeZookeeperPackage():
+    distributeCachedPackage(ZOOKEEPER_PACKAGE_URL, "%s.tar.gz" % ZOOKEEPER_PACKAGE,
+                            os.path.dirname(ZOOKEEPER_PREFIX), ZOOKEEPER_PACKAGE_SHA512_URL)
 
 def config_ZK():
-    changeZKProperties("zoo.cfg", ZOOKEEPER_CONF_VALUES)
-    with cd(ZOOKEEPER_DATA_DIR):
-        if (env.host == NAMENODE_HOST):
-            run("echo 1 >> myid")
-        if env.host == SLAVE_HOSTS[0]: ## TODO: Remove hardcoding
-            run("echo 2 >> myid")
-        if env.host == SLAVE_HOSTS[1]: ## TODO: Remove hardcoding
-            run("echo 3 >> myid")
+    values = zookeeperConfValues(env.host)
+    ensureDirectoriesExist([values["dataLogDir"]])
+    changeZKProperties("zoo.cfg", values)
+    myid = TOPOLOGY.myid(env.host)
+    if myid is not None:
+        with cd(ZOOKEEPER_DATA_DIR):
+            run("test \"`cat myid 2>/dev/null`\" = %(id)d || echo %(id)d > myid" % {"id": myid})
+        # The same block configJvmProfiles writes, so that the heap is set
+        # with or without JVM_PROFILES
+        ensureDirectoriesExist([JVM_GC_LOG_DIR])
+        lines = envFileLines({"zookeeper": daemonHeap(env.host, "zookeeper")}, JVM_GC_LOG_DIR)
+        envFile = os.path.join(ZOOKEEPER_CONF, "zookeeper-env.sh")
+        if replaceManagedBlock(envFile, lines["zookeeper-env.sh"]):
+            flagRestarts([envFile])
 
 def changeZKProperties(fileName, propertyDict):
     if not fileName or not propertyDict:
-        return
-
-    with cd(ZOOKEEPER_CONF):
-        with settings(warn_only=True):
-            import hashlib
-            makeZKconfigHash = \
-                hashlib.md5(
-                    open("makeZKconfig.py", 'rb').read()
-                ).hexdigest()
-            if run("test %s = `md5sum makeZKconfig.py | cut -d ' ' -f 1`"
-                   % makeZKconfigHash).failed:
-                put("makeZKconfig.py", ZOOKEEPER_CONF + "/")
-                run("chmod +x makeZKconfig.py")
-
-        with settings(warn_only=True):
-            if not run("test -f %s" % fileName).failed:
-                op = "cp"
-
-                if CONFIGURATION_FILES_CLEAN:
-                    op = "mv"
-
-                currentBakNumber = getLastBackupNumber(fileName) + 1
-                run("%(op)s %(file)s %(file)s.bak%(bakNumber)d" %
-                    {"op": op, "file": fileName, "bakNumber": currentBakNumber})
+        return []
 
-        run("touch %s" % fileName)
-
-        command = "./makeZKconfig.py '%s' '%s' " % (fileName, json.dumps(propertyDict))
-        run(command)
+    return pushConfigFiles([(os.path.join(ZOOKEEPER_CONF, fileName),
+                             renderZKConfig(propertyDict))])
 
 def startZKserver():
     operationInZKEnvironment(r"/home/ubuntu/Programs/zookeeper-3.4.6/bin/zkServer.sh start")
@@ -567,16 +1717,7 @@ def operationInZKEnvironment(operation):
     with cd(ZOOKEEPER_PREFIX):
         command = operation
         if ENVIRONMENT_FILE_NOTAUTOLOADED:
-            with settings(warn_only=True):
-                import hashlib
-                executeInZookeeperEnvHash = \
-                    hashlib.md5(
-                        open("executeInZookeeperEnv.sh", 'rb').read()
-                    ).hexdigest()
-                if run("test %s = `md5sum executeInZookeeperEnv.sh | cut -d ' ' -f 1`"
-                    % executeInZookeeperEnvHash).failed:
-                    put("executeInZookeeperEnv.sh", ZOOKEEPER_PREFIX + "/")
-                    run("chmod +x executeInZookeeperEnv.sh")
+            syncHelper("executeInZookeeperEnv.sh", ZOOKEEPER_PREFIX)
             command = ("./executeInZookeeperEnv.sh %s " % ENVIRONMENT_FILE) + command
             print (command)
             run(command)
@@ -584,44 +1725,36 @@ def operationInZKEnvironment(operation):
 
 @runs_once
 def setupHosts():
-    privateIps = execute(getPrivateIp)
-    execute(updateHosts, privateIps)
+    privateIps = executeOnHosts(getPrivateIp)
+    executeOnHosts(updateHosts, privateIps)
 
     if env.host == RESOURCEMANAGER_HOST:
-        run("rm -f privateIps")
-        run("touch privateIps")
-
-        for host, privateIp in privateIps.items():
-            run("echo '%s' >> privateIps" % privateIp)
+        run("printf '%%s\\n' %s > privateIps" %
+            " ".join(privateIp for host, privateIp in sorted(privateIps.items())))
 def configRevertPrevious():
     revertHadoopPropertiesChange("core-site.xml")
     revertHadoopPropertiesChange("hdfs-site.xml")
     revertHadoopPropertiesChange("yarn-site.xml")
     revertHadoopPropertiesChange("mapred-site.xml")
 def setupEnvironment():
-    with settings(warn_only=True):
-        if not run("test -f %s" % ENVIRONMENT_FILE).failed:
-            op = "cp"
-
-            if ENVIRONMENT_FILE_CLEAN:
-                op = "mv"
+    op = "cp"
+    if ENVIRONMENT_FILE_CLEAN:
+        op = "mv"
 
-            currentBakNumber = getLastBackupNumber(ENVIRONMENT_FILE) + 1
-            run("%(op)s %(file)s %(file)s.bak%(bakNumber)d" %
-                {"op": op, "file": ENVIRONMENT_FILE, "bakNumber": currentBakNumber})
+    batch = CommandBatch()
+    with settings(warn_only=True):
+        batch.run(backupFileCommand(ENVIRONMENT_FILE, op))
 
-    run("touch %s" % ENVIRONMENT_FILE)
+    batch.run("touch %s" % ENVIRONMENT_FILE)
 
     for variable, value in ENVIRONMENT_VARIABLES:
-        lineNumber = run("grep -n 'export\s\+%(var)s\=' '%(file)s' | cut -d : -f 1" %
-                {"var": variable, "file": ENVIRONMENT_FILE})
-        try:
-            lineNumber = int(lineNumber)
-            run("sed -i \"" + str(lineNumber) + "s@.*@export %(var)s\=%(val)s@\" '%(file)s'" %
-                {"var": variable, "val": value, "file": ENVIRONMENT_FILE})
-        except ValueError:
-            run("echo \"export %(var)s=%(val)s\" >> \"%(file)s\"" %
+        batch.run(("lineNumber=`grep -n 'export\s\+%(var)s\=' '%(file)s' | cut -d : -f 1 | head -n 1`; "
+                   "if [ -n \"$lineNumber\" ]; then "
+                   "sed -i \"${lineNumber}s@.*@export %(var)s\=%(val)s@\" '%(file)s'; "
+                   "else echo \"export %(var)s=%(val)s\" >> \"%(file)s\"; fi") %
                 {"var": variable, "val": value, "file": ENVIRONMENT_FILE})
+    currentFacts().invalidate(ENVIRONMENT_FILE)
+    batch.execute()
 def installDependencies():
     with settings(warn_only=True):
         for command in REQUIREMENTS_PRE_COMMANDS:
@@ -629,44 +1762,298 @@ def installDependencies():
         for requirement in REQUIREMENTS:
             sudo(PACKAGE_MANAGER_INSTALL % requirement)
         setup_passwordless_SSH()
-def setup_passwordless_SSH(): #TODO remove hardcoding
+
+@runs_once
+def checkNativeCodecs():
+    # Installs the native compression libraries on every host, shows what
+    # `hadoop checknative` finds and records the map output codec (see
+    # NATIVE_CODECS). Aborts if a host can't load libhadoop or no codec of
+    # MAP_OUTPUT_CODECS works on every host.
+    support = executeOnHosts(nativeLibraries)
+    names = sorted(set(name for libraries in support.values() for name in libraries))
+    print("%-30s %s" % ("Host", " ".join("%-8s" % name for name in names)))
+    for host in sorted(support):
+        print("%-30s %s" % (host, " ".join(
+            "%-8s" % ("yes" if support[host].get(name, (False,))[0] else "NO") for name in names)))
+    try:
+        codec = chooseCodec(support, MAP_OUTPUT_CODECS)
+    except CodecError as e:
+        abort(str(e))
+    if codec is None:
+        abort("None of the codecs %s is loaded on every host" % ", ".join(MAP_OUTPUT_CODECS))
+
+    directory = os.path.dirname(NATIVE_CODECS_FILE)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(NATIVE_CODECS_FILE, "w") as f:
+        json.dump({"codec": codec, "hosts": support}, f, indent=2, sort_keys=True)
+    print("Map outputs will be compressed with %s (run syncConfig to apply it)" % codec)
+    useMapOutputCodec(codec)
+    return codec
+
+@parallel
+def nativeLibraries():
+    # Installs the native compression libraries and returns what
+    # `hadoop checknative` finds on this host
+    with settings(warn_only=True):
+        for package in NATIVE_CODEC_PACKAGES:
+            sudo(PACKAGE_MANAGER_INSTALL % package)
+        # Exits with 1 when a library is missing, which the caller reports
+        output = operationInHadoopEnvironment("bin/hadoop checknative -a")
+    return parseCheckNative(output)
+
+def mapOutputCodec():
+    # Codec map outputs are compressed with (see MAP_OUTPUT_CODEC), or None
+    if MAP_OUTPUT_CODEC != "auto":
+        return MAP_OUTPUT_CODEC
+    if not NATIVE_CODECS or not os.path.isfile(NATIVE_CODECS_FILE):
+        return None
+    with open(NATIVE_CODECS_FILE) as f:
+        return json.load(f).get("codec")
+
+def useMapOutputCodec(codec):
+    # Sets the site values of codec, leaving the others as they are (the
+    # site dicts also hold values bootstrapFabric adds)
+    values = compressionSiteValues(codec)
+    YARN_SITE_VALUES.update(values["yarn-site.xml"])
+    MAPRED_SITE_VALUES.update(values["mapred-site.xml"])
+def setup_passwordless_SSH():
+        # NAMENODE_HOST reaches every slave, and the hosts of the master roles
+        # (NameNodes, ResourceManagers, ZooKeeper, JournalNodes) reach each
+        # other, e.g. for sshfence
         run("ssh-keygen -q -t rsa -N '' -f ~/.ssh/id_rsa <<<y 2>&1 >/dev/null")
+        masterHosts = [host for role in ["namenode", "resourcemanager", "zookeeper", "journalnode"]
+                       for host in daemonHosts(role)]
+        targets = []
         if env.host == NAMENODE_HOST:
-            for slaves in SLAVE_HOSTS:
-                run("cat ~/.ssh/id_rsa.pub | ssh -i ~/.ssh/bdata1.pem ubuntu@%s 'cat >> ~/.ssh/authorized_keys'" % slaves)
-        if env.host == SLAVE_HOSTS[0]:
-            run("cat ~/.ssh/id_rsa.pub | ssh -i ~/.ssh/bdata1.pem ubuntu@%s 'cat >> ~/.ssh/authorized_keys'" % SLAVE_HOSTS[1])
-            run("cat ~/.ssh/id_rsa.pub | ssh -i ~/.ssh/bdata1.pem ubuntu@%s 'cat >> ~/.ssh/authorized_keys'" % NAMENODE_HOST)
-        if env.host == SLAVE_HOSTS[1]:
-            run("cat ~/.ssh/id_rsa.pub | ssh -i ~/.ssh/bdata1.pem ubuntu@%s 'cat >> ~/.ssh/authorized_keys'" % SLAVE_HOSTS[0])
-            run("cat ~/.ssh/id_rsa.pub | ssh -i ~/.ssh/bdata1.pem ubuntu@%s 'cat >> ~/.ssh/authorized_keys'" % NAMENODE_HOST)
+            targets += SLAVE_HOSTS
+        if env.host in masterHosts:
+            targets += masterHosts
+        seen = set([env.host])
+        for target in targets:
+            if target in seen:
+                continue
+            seen.add(target)
+            run("cat ~/.ssh/id_rsa.pub | ssh %s -i ~/.ssh/bdata1.pem ubuntu@%s 'cat >> ~/.ssh/authorized_keys'" % (REMOTE_MULTIPLEX_OPTIONS, target))
 def environmentRevertPrevious():
     revertBackup(ENVIRONMENT_FILE)
 
 # HELPER FUNCTIONS
 def ensureDirectoryExists(directory):
+    ensureDirectoriesExist([directory])
+
+def ensureDirectoriesExist(directories):
+    # Directories the cache doesn't know about are tested in the batch itself,
+    # so that they don't cost a probe of their own
+    facts = currentFacts()
+    missing = [directory for directory in directories
+               if "d" not in (facts.cached("path:" + directory) or "")]
+    if not missing:
+        return
+
+    batch = CommandBatch()
     with settings(warn_only=True):
         #sudo ("addgroup hadoop")
         #sudo ("adduser --ingroup hadoop --disabled-password --gecos '' hadoop")
-        if run("test -d %s" % directory).failed:
-            sudo("mkdir -p %s" % directory)
-            sudo("chown -R ubuntu %s" % directory )
-            run("chmod 755 %s" % directory)
+        created = [(directory, batch.sudo(
+            "test -d %(dir)s || "
+            "(mkdir -p %(dir)s && chown -R ubuntu %(dir)s && chmod 755 %(dir)s)" %
+            {"dir": directory})) for directory in missing]
+    batch.execute()
+    for directory, result in created:
+        if result.succeeded:
+            facts.record("path", directory, "d")
+
+def distributeCachedPackage(url, fileName, remoteDirectory, sha512Url=None):
+    # Downloads the package into the local cache (once) and relays it to
+    # every host, so the install tasks find it already in place.
+    localPath = cachePackage(url, fileName, PACKAGE_CACHE_DIR, sha512Url)
+    distributePackage(localPath, os.path.join(remoteDirectory, fileName),
+                      env.hosts, fanout=PACKAGE_RELAY_FANOUT,
+                      sshKey=PACKAGE_RELAY_SSH_KEY, execute=executeOnHosts)
+
+def activatePackage(tarball, prefix):
+    # Extracts tarball (in the current remote directory) once, into its own
+    # directory under .versions keyed by the tarball digest, and then points
+    # prefix to it with an atomic symlink swap. Reruns with the same tarball
+    # find the .extracted marker and leave everything as is. The version
+    # prefix pointed to before is kept in prefix.previous for rollbackInstall.
+    # A prefix that is still a real directory, from an install made before
+    # versions were kept, is moved into .versions and becomes the previous one.
+    versions = os.path.join(os.path.dirname(prefix), ".versions")
+    activated = run(" && ".join([
+        "mkdir -p %(versions)s",
+        "_version=%(versions)s/%(name)s-`md5sum %(tarball)s | cut -c 1-12`",
+        "if ! test -f $_version/.extracted; then "
+        "rm -rf $_version.tmp && mkdir $_version.tmp && "
+        "tar -xf %(tarball)s -C $_version.tmp --strip-components=1 && "
+        "touch $_version.tmp/.extracted && rm -rf $_version && "
+        "mv $_version.tmp $_version; fi",
+        "if test -d %(prefix)s -a ! -L %(prefix)s; then "
+        "_legacy=%(versions)s/%(name)s-legacy-`date +%%s` && "
+        "mv %(prefix)s $_legacy && %(keepLegacy)s; fi",
+        "_current=`readlink %(prefix)s || true`",
+        "if test \"$_current\" != $_version; then "
+        "if test -n \"$_current\"; then %(keepCurrent)s; fi && "
+        "%(activate)s && echo \"activated: $_version\"; fi",
+    ]) % {"versions": versions, "name": os.path.basename(prefix),
+          "tarball": tarball, "prefix": prefix,
+          "keepLegacy": switchLinkCommand(prefix + ".previous", "$_legacy"),
+          "keepCurrent": switchLinkCommand(prefix + ".previous", "$_current"),
+          "activate": switchLinkCommand(prefix, "$_version")})
+    if "activated: " in activated:
+        currentFacts().invalidate(prefix, prefix + ".previous", versions)
+
+def switchLinkCommand(link, target):
+    # Points the symlink link to target with a rename, so that anything
+    # following link sees either the old or the new target, never neither
+    return "ln -sfn %(target)s %(link)s.new && mv -T %(link)s.new %(link)s" % \
+        {"link": link, "target": target}
+
+_connectionPool = None
+_asyncEngine = None
+
+def connectionPool():
+    global _connectionPool
+    if _connectionPool is None:
+        _connectionPool = sshPool.SSHConnectionPool(SSH_MAX_CHANNELS_PER_HOST)
+    return _connectionPool
+
+def poolModules():
+    # Modules whose run/sudo/put go through the pool or the asyncio engine
+    import sys
+    import commandBatch
+    import packageDistribution
+    import hostFacts
+    import clusterHealth
+    return [sys.modules[__name__], commandBatch, packageDistribution, hostFacts, clusterHealth]
+
+def executeOnHosts(task, *args, **kwargs):
+    # Same as execute(), on the backend chosen with EXECUTION_BACKEND
+    global _asyncEngine
+    if EXECUTION_BACKEND == "asyncio":
+        if _asyncEngine is None:
+            from asyncEngine import AsyncSSHEngine
+            _asyncEngine = AsyncSSHEngine(connectionPool(), ASYNC_MAX_CONCURRENCY,
+                                          SSH_MAX_CHANNELS_PER_HOST, poolModules())
+            if COMMAND_TRACE:
+                enableTracing(COMMAND_TRACE_FILE, [_asyncEngine.operations])
+        return _asyncEngine.executeTask(task, *args, **kwargs)
+    return execute(task, *args, **kwargs)
+
+_factCache = None
+
+def currentFacts(host=None):
+    # Facts of host (the current one by default), collected once and cached
+    # (see FACTS_CACHE_TTL)
+    global _factCache
+    if _factCache is None:
+        _factCache = FactCache(FACTS_CACHE_DIR, FACTS_CACHE_TTL, factProbe())
+    return _factCache.facts(host)
+
+_clusterFacts = None
+
+def clusterFacts(host):
+    # Facts of any host, for the settings that depend on every host (e.g.
+    # the rack mapping): the IP and inventory of all of them, collected at
+    # once the first time and then shared by every host's config
+    ensureClusterFacts()
+    return KnownFacts(_clusterFacts.get(host, {}))
+
+def ensureClusterFacts():
+    # Collects the cluster facts in this process, if not done yet. Tasks
+    # that fork @parallel workers needing them call it first, so that the
+    # workers don't each collect them.
+    if _clusterFacts is None:
+        useClusterFacts(gatherClusterFacts())
+
+def gatherClusterFacts():
+    return executeOnHosts(inventoryFacts, hosts=TOPOLOGY.allHosts())
+
+def useClusterFacts(facts):
+    # Makes clusterFacts() answer from facts ({host: facts}, as returned by
+    # gatherClusterFacts), and sizes the NodeManagers from them here
+    global _clusterFacts, _nodeManagerSizes
+    _clusterFacts = facts
+    _nodeManagerSizes = None
+    if AUTO_SIZE_RESOURCES:
+        nodeManagerSizes()
 
 @parallel
-def getPrivateIp():
-    if not EC2:
-        return run("ifconfig %s | grep 'inet\s\+' | awk '{print $2}' | cut -d':' -f2" % NET_INTERFACE).strip()
+def inventoryFacts():
+    # Private IP and inventory of this host
+    facts = currentFacts()
+    return {"ip": facts.privateIp(), "inventory": facts.inventory()}
+
+def factProbe():
+    # Everything the tasks check before acting, collected in a single command
+    if EC2:
+        ipCommand = "wget -qO- http://instance-data/latest/meta-data/local-ipv4"
     else:
-        return run("wget -qO- http://instance-data/latest/meta-data/local-ipv4")
+        ipCommand = "ifconfig %s | grep 'inet\s\+' | awk '{print $2}' | cut -d':' -f2" % NET_INTERFACE
+    configFiles = [path for path, content in hadoopConfigFiles() + zookeeperConfigFiles()]
+    return FactProbe(
+        ipCommand=ipCommand,
+        paths=IMPORTANT_DIRS + IMPORTANT_ZK_DIRS +
+              [HOSTS_FILE, HADOOP_PREFIX + ".previous", ZOOKEEPER_PREFIX + ".previous"],
+        digests=[os.path.join(HADOOP_PREFIX, "executeInHadoopEnv.sh"),
+                 os.path.join(ZOOKEEPER_PREFIX, "executeInZookeeperEnv.sh"),
+                 os.path.join(HADOOP_CONF, "replaceHadoopProperty.py"),
+                 os.path.join(HADOOP_CONF, "topology.sh")] +
+                [os.path.join(os.path.dirname(prefix), "fetchArtifact.py")
+                 for prefix in [HADOOP_PREFIX, ZOOKEEPER_PREFIX]],
+        backups=[HOSTS_FILE, ENVIRONMENT_FILE, os.path.join(HADOOP_CONF, "topology.data")] +
+                configFiles)
+
+@runs_once
+def clearFacts():
+    # Forgets the cached facts of every host
+    FactCache(FACTS_CACHE_DIR, FACTS_CACHE_TTL, None).clear()
+
+def syncHelper(fileName, remoteDirectory):
+    # Uploads a local helper script to remoteDirectory unless the remote copy
+    # is known to be the same
+    import hashlib
+    helperHash = hashlib.md5(open(fileName, 'rb').read()).hexdigest()
+    remotePath = os.path.join(remoteDirectory, fileName)
+    if currentFacts().md5(remotePath) != helperHash:
+        put(fileName, remoteDirectory + "/")
+        run("chmod +x %s" % remotePath)
+        currentFacts().record("md5", remotePath, helperHash)
+
+def fetchPackage(url, fileName, sha512Url=None):
+    # Downloads url into fileName in the current remote directory. Partial
+    # downloads are resumed, and an existing file is only kept if it matches
+    # the published checksum (or, without one, the size of the original).
+    options = ""
+    if sha512Url:
+        options = "--sha512-url %s " % sha512Url
+    batch = CommandBatch()
+    queueHelperSync(batch, "fetchArtifact.py")
+    if env.get("cwd"):
+        currentFacts().invalidate(os.path.join(env.cwd, fileName))
+    batch.run("./fetchArtifact.py %s%s %s" % (options, url, fileName))
+    batch.execute()
+
+@parallel
+def getPrivateIp():
+    return currentFacts().privateIp()
 @parallel
 def updateHosts(privateIps):
+    if HOSTS_FILE_MANAGED_BLOCK:
+        # Entries added by the line-by-line mode are dropped in favour of
+        # the block
+        replaceManagedBlock(HOSTS_FILE, renderHostsBlock(privateIps),
+                            useSudo=True, staleKeys=privateIps.values())
+        return
+
     with settings(warn_only=True):
-        if not run("test -f %s" % HOSTS_FILE).failed:
+        if currentFacts().isFile(HOSTS_FILE):
             currentBakNumber = getLastBackupNumber(HOSTS_FILE) + 1
             sudo("cp %(file)s %(file)s.bak%(bakNumber)d" %
                 {"file": HOSTS_FILE, "bakNumber": currentBakNumber})
 
+    currentFacts().invalidate(HOSTS_FILE)
     sudo("touch %s" % HOSTS_FILE)
 
     for host, privateIp in privateIps.items():
@@ -679,16 +2066,145 @@ def updateHosts(privateIps):
         except ValueError:
             sudo("echo \"%(ip)s %(host)s\" >> \"%(file)s\"" %
                 {"host": host, "ip": privateIp, "file": HOSTS_FILE})
+def renderHostsBlock(privateIps):
+    return ["%s %s" % (privateIp, host)
+            for host, privateIp in sorted(privateIps.items())]
+def replaceManagedBlock(filePath, lines, useSudo=False, staleKeys=()):
+    """Replaces the lines between MANAGED_BLOCK_BEGIN and MANAGED_BLOCK_END in
+    filePath (appending the block if it isn't there yet) with a single remote
+    command. Lines outside the block whose first field is in staleKeys are
+    removed. The file is backed up and atomically replaced only if its
+    content changes. Returns True if it did."""
+    import base64
+    import hashlib
+
+    block = "\n".join([MANAGED_BLOCK_BEGIN] + list(lines) + [MANAGED_BLOCK_END]) + "\n"
+    blockHash = hashlib.md5(block.encode("utf-8")).hexdigest()
+
+    # Current block, plus a line per stale entry, hashes to blockHash only if
+    # there's nothing to do
+    awkVars = "-v b='%s' -v e='%s' -v stale='%s'" % (
+        MANAGED_BLOCK_BEGIN, MANAGED_BLOCK_END, " ".join(staleKeys))
+    awkStale = 'BEGIN { n = split(stale, s, " "); for (i = 1; i <= n; i++) drop[s[i]] = 1 }'
+    currentCommand = ("awk %s '%s $0 == b { p = 1 } p { print } $0 == e { p = 0; next } "
+                      "!p && ($1 in drop) { print \"stale\" }' %s | md5sum | cut -d ' ' -f 1" %
+                      (awkVars, awkStale, filePath))
+    rewriteCommand = ("awk %s -v blk=\"$blk\" '%s "
+                      "function block() { while ((getline l < blk) > 0) print l; done = 1 } "
+                      "$0 == b { block(); p = 1; next } $0 == e && p { p = 0; next } p { next } "
+                      "($1 in drop) { next } { print } END { if (!done) block() }' %s" %
+                      (awkVars, awkStale, filePath))
+
+    command = ("touch %(file)s && "
+               "if [ \"`%(current)s`\" = %(hash)s ]; then echo unchanged; else "
+               "blk=`mktemp` && echo %(block)s | base64 -d > \"$blk\" && "
+               "tmp=`mktemp %(file)s.XXXXXX` && %(rewrite)s > \"$tmp\" && "
+               "chmod --reference=%(file)s \"$tmp\" && chown --reference=%(file)s \"$tmp\" && "
+               "%(backup)s && "
+               # Bind-mounted files (e.g. /etc/hosts in a container) can't be
+               # renamed over, so fall back to rewriting them in place
+               "{ mv -f \"$tmp\" %(file)s 2>/dev/null || { cat \"$tmp\" > %(file)s && rm -f \"$tmp\"; }; } && "
+               "rm -f \"$blk\" && echo changed; fi" %
+               {"file": filePath, "current": currentCommand, "hash": blockHash,
+                "block": base64.b64encode(block.encode("utf-8")).decode("ascii"),
+                "rewrite": rewriteCommand, "backup": backupFileCommand(filePath)})
+
+    if useSudo:
+        result = sudo(command)
+    else:
+        result = run(command)
+    changed = result.strip().splitlines()[-1:] == ["changed"]
+    if changed:
+        currentFacts().invalidate(filePath)
+    return changed
 def getLastBackupNumber(filePath):
-    dirName = os.path.dirname(filePath)
-    fileName = os.path.basename(filePath)
-
-    with cd(dirName):
-        latestBak = run("ls -1 | grep %s.bak | tail -n 1" % fileName)
-        latestBakNumber = -1
-        if latestBak:
-            latestBakNumber = int(latestBak[len(fileName) + 4:])
-        return latestBakNumber
+    return currentFacts().lastBackupNumber(filePath)
+def pushConfigFiles(configFiles):
+    """Pushes the (remotePath, content) pairs in configFiles whose content
+    differs from the remote copy, backing the previous version up and
+    flagging the affected daemons for restart. The remote md5s are all
+    fetched with a single command. Returns the paths that changed."""
+    import hashlib
+
+    if not configFiles:
+        return []
+    with settings(hide('running', 'stdout'), warn_only=True):
+        # Fails if some of the files don't exist yet, which is fine
+        remoteHashes = run("md5sum %s 2>/dev/null" %
+                           " ".join(path for path, content in configFiles))
+    currentHashes = dict(reversed(line.split(None, 1))
+                         for line in remoteHashes.splitlines()
+                         if len(line.split(None, 1)) == 2)
+
+    changed = [(path, content) for path, content in configFiles
+               if currentHashes.get(path) !=
+               hashlib.md5(content.encode("utf-8")).hexdigest()]
+    if not changed:
+        return []
+
+    batch = CommandBatch()
+    for path, content in changed:
+        with settings(warn_only=True):
+            batch.run(backupFileCommand(path))
+        batch.run("tmp=`mktemp %(file)s.XXXXXX` && cat > \"$tmp\" && "
+                  "chmod 644 \"$tmp\" && mv -f \"$tmp\" %(file)s" % {"file": path},
+                  stdin=content)
+    queueRestartFlags(batch, [path for path, content in changed])
+    currentFacts().invalidate(*[path for path, content in changed])
+    batch.execute()
+
+    return [path for path, content in changed]
+def flagRestarts(changedFiles):
+    batch = CommandBatch()
+    queueRestartFlags(batch, changedFiles)
+    batch.execute()
+def queueRestartFlags(batch, changedFiles):
+    daemons = sorted(set(daemon for path in changedFiles
+                         for daemon in CONFIG_FILE_DAEMONS.get(os.path.basename(path), [])))
+    if daemons:
+        batch.run("printf '%%s\\n' %s >> %s" % (" ".join(daemons), RESTART_FLAGS_FILE))
+def daemonHosts(daemon):
+    # Hosts each daemon runs on
+    if daemon == "zkfc":
+        daemon = "namenode"
+    return TOPOLOGY.hosts(daemon)
+def standbyNamenodeHosts():
+    return daemonHosts("namenode")[1:]
+def hostDaemons(host=None):
+    # Daemons that run on host (env.host by default), in start order
+    if host is None:
+        host = env.host
+    return [daemon for daemon in DAEMONS if host in daemonHosts(daemon)]
+def operationOnDaemon(daemon, operation):
+    if daemon == "zookeeper":
+        operationInZKEnvironment("%s %s" % (os.path.join(ZOOKEEPER_PREFIX, "bin/zkServer.sh"), operation))
+    else:
+        operationInHadoopEnvironment("%s %s %s" % (os.path.join(HADOOP_PREFIX, DAEMON_SCRIPTS[daemon]),
+                                                   operation, daemon))
+def queueHelperSync(batch, fileName):
+    # Queues the upload of a local helper script to the current remote
+    # directory, which only happens if the remote copy differs. Nothing is
+    # queued if the cached facts already show the same copy there.
+    import hashlib
+    helper = open(fileName, 'rb').read()
+    helperHash = hashlib.md5(helper).hexdigest()
+    if env.get("cwd"):
+        remotePath = os.path.join(env.cwd, fileName)
+        if currentFacts().md5(remotePath) == helperHash:
+            return
+        currentFacts().invalidate(remotePath)
+    batch.run("test %(hash)s = `md5sum %(file)s 2>/dev/null | cut -d ' ' -f 1` || "
+              "(cat > %(file)s && chmod +x %(file)s)" %
+              {"hash": helperHash, "file": fileName},
+              stdin=helper)
+def backupFileCommand(filePath, op="cp"):
+    # Same as test -f + getLastBackupNumber + cp/mv, but as a single shell
+    # command so that it can be queued in a CommandBatch.
+    return ("if test -f %(file)s; then "
+            "_bak=`cd %(dir)s && %(last)s`; "
+            "%(op)s %(file)s %(file)s.bak$((${_bak:--1} + 1)); fi" %
+            {"op": op, "file": filePath, "dir": os.path.dirname(filePath) or ".",
+             "last": lastBackupNumberCommand(os.path.basename(filePath))})
 def revertBackup(fileName):
     dirName = os.path.dirname(fileName)
 
@@ -700,6 +2216,7 @@ def revertBackup(fileName):
             return
         # Otherwise, perform reversion
         else:
+            currentFacts().invalidate(fileName)
             run("mv %(file)s.bak%(bakNumber)d %(file)s" %
                 {"file": fileName, "bakNumber": latestBakNumber})
 def revertHadoopPropertiesChange(fileName):
@@ -9,9 +9,12 @@
 #   http://www.alexjf.net/blog/distributed-systems/hadoop-yarn-installation-definitive-guide
 
 import os
-from fabric.api import run, cd, env, settings, put, sudo
+from fabric.api import run, cd, env, settings, put, sudo, abort
 from fabric.decorators import runs_once, parallel
 from fabric.tasks import execute
+from commandBatch import CommandBatch
+from replaceHadoopProperty import EXIT_UNCHANGED as REPLACE_UNCHANGED
+from commandTrace import enableTracing
 
 ###############################################################
 #  START OF YOUR CONFIGURATION (CHANGE FROM HERE, IF NEEDED)  #
@@ -23,6 +26,15 @@ SSH_USER = "ubuntu"
 #env.key_filename = "~/.ssh/giraph.pem"
 
 
+#### Command traces ####
+# Record the host, task, timing, exit code and bytes transferred of every
+# remote command, and write them to COMMAND_TRACE_FILE (Chrome trace event
+# format, see chrome://tracing) with a summary of the slowest commands,
+# hosts and tasks at the end of a run
+COMMAND_TRACE = False
+COMMAND_TRACE_FILE = "fabric-trace.json"
+
+
 #### EC2 ####
 # Is this an EC2 deployment? If so, then we'll autodiscover the right nodes.
 EC2 = False
@@ -188,6 +200,11 @@ def bootstrapFabric():
         MAPRED_SITE_VALUES["mapred.job.tracker"] = "%s:%s" % \
             (JOBTRACKER_HOST, JOBTRACKER_PORT)
 
+    if COMMAND_TRACE:
+        import sys
+        import commandBatch
+        enableTracing(COMMAND_TRACE_FILE, [sys.modules[__name__], commandBatch])
+
 
 # MAIN FUNCTIONS
 def forceStopEveryJava():
@@ -218,8 +235,7 @@ def bootstrap():
 
 
 def ensureImportantDirectoriesExist():
-    for importantDir in IMPORTANT_DIRS:
-        ensureDirectoryExists(importantDir)
+    ensureDirectoriesExist(IMPORTANT_DIRS)
 
 
 def installDependencies():
@@ -252,29 +268,23 @@ def configRevertPrevious():
 
 
 def setupEnvironment():
-    with settings(warn_only=True):
-        if not run("test -f %s" % ENVIRONMENT_FILE).failed:
-            op = "cp"
-
-            if ENVIRONMENT_FILE_CLEAN:
-                op = "mv"
+    op = "cp"
+    if ENVIRONMENT_FILE_CLEAN:
+        op = "mv"
 
-            currentBakNumber = getLastBackupNumber(ENVIRONMENT_FILE) + 1
-            run("%(op)s %(file)s %(file)s.bak%(bakNumber)d" %
-                {"op": op, "file": ENVIRONMENT_FILE, "bakNumber": currentBakNumber})
+    batch = CommandBatch()
+    with settings(warn_only=True):
+        batch.run(backupFileCommand(ENVIRONMENT_FILE, op))
 
-    run("touch %s" % ENVIRONMENT_FILE)
+    batch.run("touch %s" % ENVIRONMENT_FILE)
 
     for variable, value in ENVIRONMENT_VARIABLES:
-        lineNumber = run("grep -n 'export\s\+%(var)s\=' '%(file)s' | cut -d : -f 1" %
-                {"var": variable, "file": ENVIRONMENT_FILE})
-        try:
-            lineNumber = int(lineNumber)
-            run("sed -i \"" + str(lineNumber) + "s@.*@export %(var)s\=%(val)s@\" '%(file)s'" %
-                {"var": variable, "val": value, "file": ENVIRONMENT_FILE})
-        except ValueError:
-            run("echo \"export %(var)s=%(val)s\" >> \"%(file)s\"" %
+        batch.run(("lineNumber=`grep -n 'export\s\+%(var)s\=' '%(file)s' | cut -d : -f 1 | head -n 1`; "
+                   "if [ -n \"$lineNumber\" ]; then "
+                   "sed -i \"${lineNumber}s@.*@export %(var)s\=%(val)s@\" '%(file)s'; "
+                   "else echo \"export %(var)s=%(val)s\" >> \"%(file)s\"; fi") %
                 {"var": variable, "val": value, "file": ENVIRONMENT_FILE})
+    batch.execute()
 
 
 def environmentRevertPrevious():
@@ -314,9 +324,15 @@ def test():
 
 # HELPER FUNCTIONS
 def ensureDirectoryExists(directory):
+    ensureDirectoriesExist([directory])
+
+
+def ensureDirectoriesExist(directories):
+    batch = CommandBatch()
     with settings(warn_only=True):
-        if run("test -d %s" % directory).failed:
-            run("mkdir -p %s" % directory)
+        for directory in directories:
+            batch.run("test -d %(dir)s || mkdir -p %(dir)s" % {"dir": directory})
+    batch.execute()
 
 
 @parallel
@@ -354,13 +370,29 @@ def getLastBackupNumber(filePath):
     fileName = os.path.basename(filePath)
 
     with cd(dirName):
-        latestBak = run("ls -1 | grep %s.bak | tail -n 1" % fileName)
+        latestBak = run(lastBackupNumberCommand(fileName))
         latestBakNumber = -1
         if latestBak:
-            latestBakNumber = int(latestBak[len(fileName) + 4:])
+            latestBakNumber = int(latestBak)
         return latestBakNumber
 
 
+def lastBackupNumberCommand(fileName):
+    # Prints the highest N of the fileName.bakN files in the current directory
+    return ("ls -1 | grep '^%s\\.bak[0-9][0-9]*$' | sed 's/^.*\\.bak//' | sort -n | tail -n 1"
+            % fileName)
+
+
+def backupFileCommand(filePath, op="cp"):
+    # Same as test -f + getLastBackupNumber + cp/mv, but as a single shell
+    # command so that it can be queued in a CommandBatch.
+    return ("if test -f %(file)s; then "
+            "_bak=`cd %(dir)s && %(last)s`; "
+            "%(op)s %(file)s %(file)s.bak$((${_bak:--1} + 1)); fi" %
+            {"op": op, "file": filePath, "dir": os.path.dirname(filePath) or ".",
+             "last": lastBackupNumberCommand(os.path.basename(filePath))})
+
+
 def changeHadoopProperties(fileName, propertyDict):
     if not fileName or not propertyDict:
         return
@@ -377,22 +409,17 @@ def changeHadoopProperties(fileName, propertyDict):
                 put("replaceHadoopProperty.py", HADOOP_CONF + "/")
                 run("chmod +x replaceHadoopProperty.py")
 
-        with settings(warn_only=True):
-            if not run("test -f %s" % fileName).failed:
-                op = "cp"
+        # The file is only backed up (and rewritten) if its content changes
+        options = "--backup"
+        if CONFIGURATION_FILES_CLEAN:
+            options += " --clean"
 
-                if CONFIGURATION_FILES_CLEAN:
-                    op = "mv"
-
-                currentBakNumber = getLastBackupNumber(fileName) + 1
-                run("%(op)s %(file)s %(file)s.bak%(bakNumber)d" %
-                    {"op": op, "file": fileName, "bakNumber": currentBakNumber})
-
-        run("touch %s" % fileName)
-
-        command = "./replaceHadoopProperty.py '%s' %s" % (fileName,
-            " ".join(["%s %s" % (str(key), str(value)) for key, value in propertyDict.items()]))
-        run(command)
+        command = "./replaceHadoopProperty.py %s '%s' %s" % (options, fileName,
+            " ".join(["'%s' '%s'" % (str(key), str(value)) for key, value in propertyDict.items()]))
+        with settings(warn_only=True):
+            result = run(command)
+        if result.return_code not in (0, REPLACE_UNCHANGED):
+            abort("replaceHadoopProperty.py failed on %s:\n%s" % (env.host, result))
 
 
 def revertBackup(fileName):
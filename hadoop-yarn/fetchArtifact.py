@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Downloads a file over HTTP(S) as parallel Range requests.
+#
+# Each chunk is written to its own <output>.partN file, so an interrupted
+# download picks up where every chunk stopped instead of starting over. The
+# chunks are only joined into <output> once all of them are complete and the
+# result matches the expected SHA-512 (or, when no checksum is published, the
+# size reported by the server). An existing <output> is checked the same way
+# and kept if it passes, so truncated files from an earlier run are never
+# mistaken for complete ones.
+
+import os
+import re
+import sys
+import json
+import hashlib
+import threading
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError, URLError
+
+USAGE = """./fetchArtifact.py [--sha512 <digest>|--sha512-url <url>] [--connections N] <url> <output>
+
+--sha512      expected SHA-512 digest (hex) of the file
+--sha512-url  URL of a published checksum file (sha512sum, BSD or gpg
+              --print-md(s) formats are understood)
+--connections number of parallel range requests (default %d)
+
+Without a checksum the file is only checked against the size reported by the
+server."""
+
+DEFAULT_CONNECTIONS = 4
+CHUNK_SIZE = 16 * 1024 * 1024
+BUFFER_SIZE = 256 * 1024
+RETRIES = 3
+TIMEOUT = 60
+
+CONTENT_RANGE_RE = re.compile(r'bytes\s+\d+-\d+/(\d+)')
+SHA512_HEX_RE = re.compile(r'\b[0-9a-fA-F]{128}\b')
+SHA512_LABELLED_RE = re.compile(r'SHA512[^=\n]*=\s*([0-9a-fA-F\s]+)', re.IGNORECASE)
+SHA512_GPG_RE = re.compile(r':\s*([0-9a-fA-F\s]+)')
+
+
+class FetchError(Exception):
+    pass
+
+
+def parseSha512(text):
+    """Returns the SHA-512 digest found in the content of a checksum file."""
+    # "<digest>  <file>" as written by sha512sum
+    match = SHA512_HEX_RE.search(text)
+    if match is None:
+        # "SHA512 (<file>) = <digest>" and the .mds files of older Apache
+        # releases ("<file>: SHA512 = 1234 ABCD ..." over several lines)
+        match = SHA512_LABELLED_RE.search(text) or SHA512_GPG_RE.search(text)
+    if match is not None:
+        digest = re.sub(r'\s', '', match.group(match.lastindex or 0))
+        if len(digest) >= 128:
+            return digest[:128].lower()
+    raise FetchError("No SHA-512 digest found in checksum file")
+
+
+def fetchSha512(url):
+    return parseSha512(urlopen(url, timeout=TIMEOUT).read().decode('utf-8', 'replace'))
+
+
+def probe(url):
+    """Returns (size, supportsRanges) for url. size is None if unknown."""
+    response = urlopen(Request(url, headers={"Range": "bytes=0-0"}), timeout=TIMEOUT)
+    try:
+        if response.getcode() == 206:
+            match = CONTENT_RANGE_RE.match(response.headers.get("Content-Range", ""))
+            if match is not None:
+                return int(match.group(1)), True
+        length = response.headers.get("Content-Length")
+        return (int(length) if length else None), False
+    finally:
+        response.close()
+
+
+def fileDigest(fileName):
+    sha512 = hashlib.sha512()
+    with open(fileName, 'rb') as f:
+        for data in iter(lambda: f.read(BUFFER_SIZE), b''):
+            sha512.update(data)
+    return sha512.hexdigest()
+
+
+def isComplete(fileName, size, sha512):
+    if not os.path.exists(fileName):
+        return False
+    if sha512 is not None:
+        return fileDigest(fileName) == sha512
+    return size is not None and os.path.getsize(fileName) == size
+
+
+def planChunks(size, supportsRanges):
+    if not supportsRanges or not size:
+        return [(0, None)]
+    return [(start, min(start + CHUNK_SIZE, size) - 1)
+            for start in range(0, size, CHUNK_SIZE)]
+
+
+def fetchChunk(url, partName, start, end):
+    # Resumes the chunk from whatever an earlier attempt left in partName
+    for attempt in range(RETRIES):
+        done = os.path.getsize(partName) if os.path.exists(partName) else 0
+        if end is not None and start + done > end:
+            return
+        headers = {}
+        if end is not None:
+            headers["Range"] = "bytes=%d-%d" % (start + done, end)
+        elif done:
+            headers["Range"] = "bytes=%d-" % done
+        try:
+            response = urlopen(Request(url, headers=headers), timeout=TIMEOUT)
+            if headers and response.getcode() != 206:
+                # Range ignored, the whole file is coming: start over
+                done = 0
+            with open(partName, 'ab' if done else 'wb') as f:
+                for data in iter(lambda: response.read(BUFFER_SIZE), b''):
+                    f.write(data)
+            response.close()
+        except (HTTPError, URLError, IOError, OSError) as e:
+            error = e
+            continue
+        if end is None or os.path.getsize(partName) == end - start + 1:
+            return
+        error = FetchError("short read")
+    raise FetchError("Could not download bytes %d-%s of %s: %s"
+                     % (start, end if end is not None else "", url, error))
+
+
+def fetch(url, output, sha512=None, connections=DEFAULT_CONNECTIONS):
+    """Makes sure output holds the complete, verified content of url.
+    Returns True if it had to be (partially) downloaded."""
+    size, supportsRanges = probe(url)
+    if isComplete(output, size, sha512):
+        return False
+
+    chunks = planChunks(size, supportsRanges)
+    stateName = output + ".parts"
+    state = {"url": url, "size": size, "chunks": chunks}
+    if os.path.exists(stateName):
+        with open(stateName) as f:
+            if json.load(f) != json.loads(json.dumps(state)):
+                removeParts(output)
+    with open(stateName, "w") as f:
+        json.dump(state, f)
+
+    pending = list(enumerate(chunks))
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not pending or errors:
+                    return
+                index, (start, end) = pending.pop(0)
+            try:
+                fetchChunk(url, "%s.part%d" % (output, index), start, end)
+            except FetchError as e:
+                with lock:
+                    errors.append(e)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(max(1, min(connections, len(chunks))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    # Join the chunks, hashing on the way, and only then replace output
+    digest = hashlib.sha512()
+    tempName = output + ".part"
+    with open(tempName, 'wb') as f:
+        for index in range(len(chunks)):
+            with open("%s.part%d" % (output, index), 'rb') as part:
+                for data in iter(lambda: part.read(BUFFER_SIZE), b''):
+                    digest.update(data)
+                    f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+    if sha512 is not None and digest.hexdigest() != sha512:
+        removeParts(output)
+        os.unlink(tempName)
+        raise FetchError("SHA-512 mismatch for %s: expected %s, got %s"
+                         % (url, sha512, digest.hexdigest()))
+    if size is not None and os.path.getsize(tempName) != size:
+        os.unlink(tempName)
+        raise FetchError("Size mismatch for %s: expected %d, got %d"
+                         % (url, size, os.path.getsize(tempName)))
+
+    os.rename(tempName, output)
+    removeParts(output)
+    return True
+
+
+def removeParts(output):
+    directory = os.path.dirname(output) or "."
+    prefix = os.path.basename(output) + ".part"
+    for name in os.listdir(directory):
+        if name == prefix + "s" or (name.startswith(prefix) and name[len(prefix):].isdigit()):
+            os.unlink(os.path.join(directory, name))
+
+
+def main(args):
+    options = {"--sha512": None, "--sha512-url": None,
+               "--connections": str(DEFAULT_CONNECTIONS)}
+    positional = []
+    while args:
+        arg = args.pop(0)
+        if arg in options and args:
+            options[arg] = args.pop(0)
+        else:
+            positional.append(arg)
+
+    if len(positional) != 2 or not options["--connections"].isdigit():
+        print(USAGE % DEFAULT_CONNECTIONS)
+        return 1
+    url, output = positional
+
+    try:
+        sha512 = options["--sha512"]
+        if sha512:
+            sha512 = sha512.lower()
+        elif options["--sha512-url"]:
+            sha512 = fetchSha512(options["--sha512-url"])
+        if fetch(url, output, sha512, int(options["--connections"])):
+            print("downloaded: %s" % output)
+        else:
+            print("verified: %s" % output)
+    except (FetchError, HTTPError, URLError, IOError, OSError) as e:
+        print("error: %s" % e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
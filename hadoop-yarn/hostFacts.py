@@ -0,0 +1,283 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+# Description:
+#   Facts about the remote hosts (private IP, name, CPU/memory/disk inventory,
+#   which paths exist, file digests, backup numbers) collected with a single
+#   remote command per host and cached on the control node.
+#
+#   A FactProbe lists the facts to collect. The first lookup on a host
+#   collects every fact of the probe that isn't cached yet in one command;
+#   later lookups, from this task, other (forked) tasks or a rerun within the
+#   TTL, are answered from the cache. Tasks that change a path on a host drop
+#   its cached facts with invalidate().
+#
+#   Usage:
+#       cache = FactCache("~/.cache/facts", 300, FactProbe(
+#           ipCommand="hostname -I | cut -d ' ' -f 1",
+#           paths=["/data"], digests=["/opt/helper.sh"], backups=["/etc/hosts"]))
+#       facts = cache.facts()
+#       if not facts.isDirectory("/data"):
+#           sudo("mkdir /data")
+#           facts.record("path", "/data", "d")
+#       # Facts collected elsewhere (e.g. by another process), without probing
+#       KnownFacts(facts.gather(["ip", "inventory"])).cpus()
+
+import os
+import re
+import json
+import time
+import fcntl
+import shutil
+import tempfile
+from fabric.api import run, env, settings, hide
+
+DISK_FIELDS = "NAME,KNAME,PKNAME,SIZE,TYPE,FSTYPE,MOUNTPOINT,UUID,RO,RM"
+LSBLK_PAIR_RE = re.compile(r'(\w+)="([^"]*)"')
+
+
+def lastBackupNumberCommand(fileName):
+    # Prints the highest N of the fileName.bakN files in the current directory
+    return ("ls -1 | grep '^%s\\.bak[0-9][0-9]*$' | sed 's/^.*\\.bak//' | sort -n | tail -n 1"
+            % fileName)
+
+
+class FactProbe(object):
+    """Facts to collect on every host. ipCommand prints the private IP."""
+
+    def __init__(self, ipCommand=None, paths=(), digests=(), backups=()):
+        self.ipCommand = ipCommand
+        self.paths = list(paths)
+        self.digests = list(digests)
+        self.backups = list(backups)
+
+    def keys(self):
+        keys = ["inventory"]
+        if self.ipCommand:
+            keys.append("ip")
+        keys += ["path:" + path for path in self.paths]
+        keys += ["md5:" + path for path in self.digests]
+        keys += ["backup:" + path for path in self.backups]
+        return keys
+
+    def command(self, keys):
+        """Returns a shell command printing a "<kind> <value> <path>" line
+        for each of keys."""
+        lines = []
+        for key in keys:
+            kind, _, path = key.partition(":")
+            if kind == "ip":
+                lines.append('echo "ip $(%s 2>/dev/null | head -n 1)"' % self.ipCommand)
+            elif kind == "inventory":
+                lines.append('echo "hostname $(hostname -f 2>/dev/null || hostname)"')
+                lines.append('echo "cpus $(nproc)"')
+                lines.append("echo \"memory $(awk '/^MemTotal:/ { print $2 }' /proc/meminfo)\"")
+                lines.append("lsblk -b -P -o %s 2>/dev/null | sed 's/^/disk /'" % DISK_FIELDS)
+            elif kind == "path":
+                lines.append('echo "path $(test -d %(p)s && printf d)$(test -f %(p)s && printf f)'
+                             '$(test -L %(p)s && printf l)- %(p)s"' % {"p": path})
+            elif kind == "md5":
+                lines.append("echo \"md5 $(md5sum %(p)s 2>/dev/null | cut -d ' ' -f 1)- %(p)s\"" %
+                             {"p": path})
+            elif kind == "backup":
+                lines.append('echo "backup $(cd %s 2>/dev/null && %s)- %s"' % (
+                    os.path.dirname(path) or ".",
+                    lastBackupNumberCommand(os.path.basename(path)), path))
+        lines.append("true")
+        return "; ".join(lines)
+
+
+def parseFacts(stdout):
+    """Returns the {key: value} dict for the output of FactProbe.command()."""
+    facts = {}
+    inventory = {"hostname": None, "cpus": None, "memoryKb": None, "disks": []}
+    hasInventory = False
+    for line in stdout.splitlines():
+        kind, _, rest = line.strip().partition(" ")
+        if kind == "ip":
+            facts["ip"] = rest.strip() or None
+        elif kind == "hostname":
+            hasInventory = True
+            inventory["hostname"] = rest.strip() or None
+        elif kind in ("cpus", "memory"):
+            hasInventory = True
+            value = rest.strip()
+            inventory["cpus" if kind == "cpus" else "memoryKb"] = \
+                int(value) if value.isdigit() else None
+        elif kind == "disk":
+            hasInventory = True
+            inventory["disks"].append(dict(LSBLK_PAIR_RE.findall(rest)))
+        elif kind in ("path", "md5", "backup"):
+            # Values end with "-" so that empty ones still leave a field
+            value, _, path = rest.partition(" ")
+            value = value[:-1]
+            if kind == "path":
+                facts["path:" + path] = value
+            elif kind == "md5":
+                facts["md5:" + path] = value or None
+            else:
+                facts["backup:" + path] = int(value) if value.isdigit() else -1
+    if hasInventory:
+        facts["inventory"] = inventory
+    return facts
+
+
+class FactCache(object):
+    """Per-host fact files under cacheDir, valid for ttl seconds. With a ttl
+    of 0 nothing is cached and every lookup runs its own probe."""
+
+    def __init__(self, cacheDir, ttl, probe):
+        self.cacheDir = os.path.expanduser(cacheDir)
+        self.ttl = ttl
+        self.probe = probe
+
+    def facts(self, hostString=None):
+        return HostFacts(self, hostString or env.host_string)
+
+    def clear(self):
+        shutil.rmtree(self.cacheDir, ignore_errors=True)
+
+    def _fileName(self, hostString):
+        return os.path.join(self.cacheDir, re.sub(r'[^\w.@-]', '_', hostString) + ".json")
+
+    def load(self, hostString):
+        fileName = self._fileName(hostString)
+        if self.ttl <= 0 or not os.path.exists(fileName):
+            return {}
+        try:
+            with open(fileName) as f:
+                entries = json.load(f)
+        except ValueError:
+            return {}
+        now = time.time()
+        return dict((key, value) for key, (value, collected) in entries.items()
+                    if now - collected < self.ttl)
+
+    def update(self, hostString, facts=None, dropped=()):
+        """Stores facts and drops the keys for which dropped(key) is true, in
+        a single locked read-modify-write of the host's file."""
+        if self.ttl <= 0:
+            return
+        if not os.path.isdir(self.cacheDir):
+            try:
+                os.makedirs(self.cacheDir)
+            except OSError:
+                pass
+        fileName = self._fileName(hostString)
+        # Several processes (or threads) may be working on the same host
+        with open(fileName + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = {}
+            if os.path.exists(fileName):
+                try:
+                    with open(fileName) as f:
+                        entries = json.load(f)
+                except ValueError:
+                    pass
+            now = time.time()
+            entries = dict((key, entry) for key, entry in entries.items()
+                           if now - entry[1] < self.ttl and not (dropped and dropped(key)))
+            for key, value in (facts or {}).items():
+                entries[key] = [value, now]
+            tempFile = tempfile.NamedTemporaryFile("w", dir=self.cacheDir, delete=False)
+            with tempFile:
+                json.dump(entries, tempFile, sort_keys=True)
+            os.rename(tempFile.name, fileName)
+
+
+class HostFacts(object):
+    def __init__(self, cache, hostString):
+        self.cache = cache
+        self.hostString = hostString
+
+    def get(self, key):
+        facts = self.cache.load(self.hostString)
+        if key in facts:
+            return facts[key]
+        if self.cache.ttl <= 0:
+            return self.gather([key])[key]
+        # Whatever else the probe wants and isn't cached comes along
+        missing = [probeKey for probeKey in self.cache.probe.keys()
+                   if probeKey not in facts and probeKey != key]
+        return self.gather([key] + missing)[key]
+
+    def cached(self, key):
+        """The value of key if it is cached, None otherwise. Never probes."""
+        return self.cache.load(self.hostString).get(key)
+
+    def gather(self, keys):
+        with settings(hide('running', 'stdout'), host_string=self.hostString):
+            result = run(self.cache.probe.command(keys))
+        facts = parseFacts(result)
+        for key in keys:
+            facts.setdefault(key, None)
+        self.cache.update(self.hostString, facts)
+        return facts
+
+    def refresh(self):
+        """Collects every fact of the probe again."""
+        return self.gather(self.cache.probe.keys())
+
+    def record(self, kind, path, value):
+        """Stores the new value of a fact a task has just changed."""
+        self.cache.update(self.hostString, {"%s:%s" % (kind, path): value})
+
+    def invalidate(self, *paths):
+        """Drops the facts about paths, and about anything under them."""
+        def dropped(key):
+            kind, _, keyPath = key.partition(":")
+            return any(keyPath == path or keyPath.startswith(path.rstrip("/") + "/")
+                       for path in paths)
+        self.cache.update(self.hostString, dropped=dropped)
+
+    def privateIp(self):
+        return self.get("ip")
+
+    def inventory(self):
+        return self.get("inventory") or {"hostname": None, "cpus": None,
+                                         "memoryKb": None, "disks": []}
+
+    def hostName(self):
+        """Fully qualified name of the host, as the daemons report it."""
+        return self.inventory().get("hostname")
+
+    def cpus(self):
+        return self.inventory()["cpus"]
+
+    def memoryMb(self):
+        memoryKb = self.inventory()["memoryKb"]
+        return memoryKb // 1024 if memoryKb is not None else None
+
+    def disks(self):
+        """lsblk entries (NAME, KNAME, PKNAME, SIZE, TYPE, FSTYPE, MOUNTPOINT,
+        UUID, RO, RM) of every block device and partition."""
+        return self.inventory()["disks"]
+
+    def isDirectory(self, path):
+        return "d" in (self.get("path:" + path) or "")
+
+    def isFile(self, path):
+        return "f" in (self.get("path:" + path) or "")
+
+    def isLink(self, path):
+        return "l" in (self.get("path:" + path) or "")
+
+    def md5(self, path):
+        return self.get("md5:" + path)
+
+    def lastBackupNumber(self, path):
+        lastBackup = self.get("backup:" + path)
+        return lastBackup if lastBackup is not None else -1
+
+
+class KnownFacts(HostFacts):
+    """HostFacts answered from the {key: value} facts of a host collected
+    beforehand (e.g. the return value of HostFacts.gather()). Facts that
+    weren't collected are None."""
+
+    def __init__(self, facts):
+        HostFacts.__init__(self, None, None)
+        self.facts = facts
+
+    def get(self, key):
+        return self.facts.get(key)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+# Description:
+#   JVM settings (heap, garbage collector, GC logs) of each daemon, by role,
+#   and the lines that set them in the *-env.sh files the daemon scripts
+#   source.
+#
+#   Heaps are sized from what the daemon holds: the NameNode keeps every
+#   file, directory and block in memory (about 1GB of heap per million of
+#   them), the rest are sized from the memory of their host. Every daemon
+#   uses G1 (a pause time goal instead of the long full collections of the
+#   default collector on large heaps) and writes rotated GC logs.
+#
+#   Usage:
+#       heap = heapMb("namenode", memoryMb=65536, namenodeObjects=30 * 10 ** 6)
+#       envFileLines({"namenode": heap, "zkfc": 512}, "/var/log/gc")
+#       # {"hadoop-env.sh": ['export HADOOP_NAMENODE_OPTS="..."', ...], ...}
+
+import math
+
+# Where each daemon's JVM options go: (env file, variable)
+ROLE_OPTIONS = {
+    "namenode": ("hadoop-env.sh", "HADOOP_NAMENODE_OPTS"),
+    "journalnode": ("hadoop-env.sh", "HADOOP_JOURNALNODE_OPTS"),
+    "zkfc": ("hadoop-env.sh", "HADOOP_ZKFC_OPTS"),
+    "datanode": ("hadoop-env.sh", "HADOOP_DATANODE_OPTS"),
+    "resourcemanager": ("yarn-env.sh", "YARN_RESOURCEMANAGER_OPTS"),
+    "nodemanager": ("yarn-env.sh", "YARN_NODEMANAGER_OPTS"),
+    "historyserver": ("mapred-env.sh", "HADOOP_JOB_HISTORYSERVER_OPTS"),
+    "zookeeper": ("zookeeper-env.sh", "SERVER_JVMFLAGS"),
+}
+ENV_FILES = ["hadoop-env.sh", "yarn-env.sh", "mapred-env.sh", "zookeeper-env.sh"]
+
+# Heap of the roles sized from their host's memory: (share of the memory,
+# smallest heap, largest heap), in MB
+MEMORY_SHARE_HEAPS = {
+    "resourcemanager": (0.10, 1024, 8192),
+    "datanode": (0.05, 1024, 4096),
+    "zookeeper": (0.05, 1024, 4096),
+}
+FIXED_HEAPS = {
+    "journalnode": 1024,
+    "zkfc": 512,
+    "nodemanager": 1024,
+    "historyserver": 1024,
+}
+# NameNode heap per million namespace objects (files, directories and
+# blocks), on top of a base for everything else
+NAMENODE_MB_PER_MILLION_OBJECTS = 1024
+NAMENODE_BASE_MB = 1024
+
+G1_OPTIONS = ["-XX:+UseG1GC", "-XX:MaxGCPauseMillis=200", "-XX:+ParallelRefProcEnabled"]
+GC_LOG_FILES = 10
+GC_LOG_FILE_SIZE = "20M"
+
+
+def heapMb(role, memoryMb=None, namenodeObjects=0):
+    if role == "namenode":
+        return NAMENODE_BASE_MB + NAMENODE_MB_PER_MILLION_OBJECTS * \
+            int(math.ceil(namenodeObjects / 1e6))
+    if role in MEMORY_SHARE_HEAPS:
+        share, smallest, largest = MEMORY_SHARE_HEAPS[role]
+        if not memoryMb:
+            return smallest
+        heap = int(memoryMb * share)
+        return max(smallest, min(largest, heap - heap % 256))
+    return FIXED_HEAPS.get(role, 1024)
+
+
+def jvmOptions(role, heap, gcLogDir):
+    """JVM options of role with a heap of heap MB. Initial and maximum heap
+    are the same, so that the heap doesn't resize under load."""
+    return ["-Xms%dm" % heap, "-Xmx%dm" % heap] + G1_OPTIONS + [
+        # %t: each start gets its own log instead of overwriting the last one
+        "-Xloggc:%s/gc-%s-%%t.log" % (gcLogDir, role),
+        "-XX:+PrintGCDetails", "-XX:+PrintGCDateStamps", "-XX:+PrintGCApplicationStoppedTime",
+        "-XX:+UseGCLogFileRotation", "-XX:NumberOfGCLogFiles=%d" % GC_LOG_FILES,
+        "-XX:GCLogFileSize=%s" % GC_LOG_FILE_SIZE]
+
+
+def envFileLines(heaps, gcLogDir):
+    """{env file: [lines]} setting the JVM options of the roles in heaps
+    ({role: heap MB}). The options go after any others so that they win."""
+    lines = dict((fileName, []) for fileName in ENV_FILES)
+    for role in sorted(heaps):
+        fileName, variable = ROLE_OPTIONS[role]
+        lines[fileName].append('export %s="$%s %s"' % (
+            variable, variable, " ".join(jvmOptions(role, heaps[role], gcLogDir))))
+    return lines
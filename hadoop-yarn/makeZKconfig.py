@@ -5,12 +5,27 @@ import sys
 import re
 import json
 
-fileName = sys.argv[1]
-strPropertyDict = sys.argv[2]
 
-print(strPropertyDict)
+def _keyOrder(pKey):
+    # Numbered keys in numeric order, so that server.10 comes after server.9
+    name, _, number = pKey.rpartition(".")
+    if name and number.isdigit():
+        return (name, int(number))
+    return (pKey, -1)
 
-with open(fileName, "w") as f:
-    propertyDict =json.loads(strPropertyDict)
-    for pKey, pValue in propertyDict.items():
-        f.write("%s=%s\n"%(pKey,pValue))
+
+def renderZKConfig(propertyDict):
+    # Sorted, so that the same properties always give the same file
+    return "".join("%s=%s\n" % (pKey, propertyDict[pKey])
+                   for pKey in sorted(propertyDict, key=_keyOrder))
+
+
+if __name__ == "__main__":
+    fileName = sys.argv[1]
+    strPropertyDict = sys.argv[2]
+
+    print(strPropertyDict)
+
+    with open(fileName, "w") as f:
+        propertyDict = json.loads(strPropertyDict)
+        f.write(renderZKConfig(propertyDict))
@@ -0,0 +1,68 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+# Description:
+#   Which native libraries `hadoop checknative -a` finds on each host, and
+#   the best compression codec for intermediate (map output) data that all
+#   of them support.
+#
+#   Usage:
+#       support = dict((host, parseCheckNative(output)) for host, output in ...)
+#       codec = chooseCodec(support, ["zstd", "snappy", "lz4"])
+#       compressionSiteValues(codec)  # {"mapred-site.xml": {...}, ...}
+
+import re
+
+CHECKNATIVE_RE = re.compile(r'^\s*(\w+)\s*:\s*(true|false)\b\s*(.*)$')
+
+CODEC_CLASSES = {
+    "zstd": "org.apache.hadoop.io.compress.ZStandardCodec",
+    "snappy": "org.apache.hadoop.io.compress.SnappyCodec",
+    "lz4": "org.apache.hadoop.io.compress.Lz4Codec",
+    "zlib": "org.apache.hadoop.io.compress.DefaultCodec",
+}
+
+
+class CodecError(Exception):
+    pass
+
+
+def parseCheckNative(output):
+    """{library: (found, detail)} from the output of hadoop checknative.
+    Libraries the Hadoop version doesn't know about (e.g. zstd before 2.9)
+    are missing from it."""
+    libraries = {}
+    for line in output.splitlines():
+        match = CHECKNATIVE_RE.match(line)
+        if match:
+            libraries[match.group(1)] = (match.group(2) == "true", match.group(3).strip())
+    return libraries
+
+
+def chooseCodec(support, preferences):
+    """The first codec of preferences that every host in support ({host:
+    parseCheckNative()}) has, or None. Raises CodecError if libhadoop
+    itself is missing somewhere, as no native codec works without it."""
+    missing = sorted(host for host, libraries in support.items()
+                     if not libraries.get("hadoop", (False,))[0])
+    if missing:
+        raise CodecError("The native Hadoop library isn't loaded on %s" % ", ".join(missing))
+    for codec in preferences:
+        if codec in CODEC_CLASSES and support and \
+                all(libraries.get(codec, (False,))[0] for libraries in support.values()):
+            return codec
+    return None
+
+
+def compressionSiteValues(codec):
+    """Site values compressing map outputs with codec, and the aggregated
+    YARN logs with gzip (the only compression TFile has without LZO)."""
+    return {
+        "mapred-site.xml": {
+            "mapreduce.map.output.compress": "true",
+            "mapreduce.map.output.compress.codec": CODEC_CLASSES[codec],
+        },
+        "yarn-site.xml": {
+            "yarn.nodemanager.log-aggregation.compression-type": "gz",
+        },
+    }
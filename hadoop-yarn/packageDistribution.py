@@ -0,0 +1,119 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+# Description:
+#   Downloads packages once into a cache on the control node and spreads
+#   them over the cluster in waves. In every wave the control node and each
+#   host that already holds a verified copy send it on to `fanout` more
+#   hosts (host to host, over SSH), so the number of holders multiplies with
+#   every wave and reaching N hosts takes O(log N) waves instead of N
+#   downloads from the same mirror.
+
+import hashlib
+import os
+from fabric.api import run, put, env, settings, hide, abort
+from fabric.decorators import parallel
+from fabric.tasks import execute as fabricExecute
+from fetchArtifact import FetchError, fetch, fetchSha512
+
+
+def fileMd5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def cachePackage(url, fileName, cacheDir, sha512Url=None):
+    """Returns the path of fileName in cacheDir, downloading it from url
+    first if it isn't cached (and verified) yet."""
+    cachedPath = os.path.join(cacheDir, fileName)
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    try:
+        sha512 = fetchSha512(sha512Url) if sha512Url else None
+        if fetch(url, cachedPath, sha512):
+            print("Downloaded %s into %s" % (url, cacheDir))
+    except (FetchError, IOError, OSError) as e:
+        abort("Could not download %s: %s" % (url, e))
+    return cachedPath
+
+
+def planRelayWave(holders, pending, fanout):
+    """Assigns up to fanout pending hosts to the control node (None) and to
+    each holder. Returns a {source: [targets]} dict."""
+    assignments = {}
+    pending = list(pending)
+    for source in [None] + list(holders):
+        if not pending:
+            break
+        assignments[source], pending = pending[:fanout], pending[fanout:]
+    return assignments
+
+
+def distributePackage(localPath, remotePath, hosts, fanout=2, sshKey=None,
+                      execute=fabricExecute):
+    """Makes sure that every host in hosts has a copy of localPath (as found
+    in the control node) at remotePath. execute is the function used to run
+    tasks on many hosts, Fabric's execute() by default."""
+    checksum = fileMd5(localPath)
+
+    verified = execute(hasVerifiedCopy, remotePath, checksum, hosts=hosts)
+    holders = [host for host in hosts if verified.get(host)]
+    pending = [host for host in hosts if not verified.get(host)]
+
+    wave = 0
+    while pending:
+        wave += 1
+        assignments = planRelayWave(holders, pending, fanout)
+        print("%s, wave %d: %s" % (os.path.basename(localPath), wave, ", ".join(
+            "%s -> %s" % (source or "control node", ",".join(targets))
+            for source, targets in assignments.items())))
+
+        participants = assignments.get(None, []) + \
+            [source for source in assignments if source is not None]
+        results = execute(relayWave, assignments, localPath, remotePath,
+                          checksum, sshKey, hosts=participants)
+
+        delivered = set(target for targets in results.values() if targets
+                        for target in targets)
+        if not delivered:
+            abort("Could not distribute %s to %s" % (localPath, ", ".join(pending)))
+        holders += [host for host in pending if host in delivered]
+        pending = [host for host in pending if host not in delivered]
+
+
+@parallel
+def hasVerifiedCopy(remotePath, checksum):
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        return run("md5sum %s | cut -d ' ' -f 1" % remotePath).strip() == checksum
+
+
+@parallel
+def relayWave(assignments, localPath, remotePath, checksum, sshKey):
+    # Either receives the package from the control node or sends it on to
+    # the hosts assigned to this one. Returns the hosts that got a verified
+    # copy.
+    partialPath = remotePath + ".part"
+    activate = ("[ \"`md5sum < %(part)s | cut -c 1-32`\" = %(sum)s ] && mv -f %(part)s %(path)s" %
+                {"part": partialPath, "path": remotePath, "sum": checksum})
+    delivered = []
+
+    with settings(warn_only=True):
+        if env.host_string in assignments.get(None, []):
+            run("mkdir -p %s" % os.path.dirname(remotePath))
+            if put(localPath, partialPath).succeeded and run(activate).succeeded:
+                delivered.append(env.host_string)
+
+        sshOptions = "-o StrictHostKeyChecking=no -o BatchMode=yes"
+        if sshKey:
+            sshOptions += " -i %s" % sshKey
+        for target in assignments.get(env.host_string, []):
+            if run("ssh %(options)s %(user)s@%(target)s 'mkdir -p %(dir)s && cat > %(part)s && %(activate)s' < %(path)s" %
+                   {"options": sshOptions, "user": env.user, "target": target,
+                    "dir": os.path.dirname(remotePath), "part": partialPath,
+                    "activate": activate, "path": remotePath}).succeeded:
+                delivered.append(target)
+
+    return delivered
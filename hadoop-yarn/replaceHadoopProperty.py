@@ -1,63 +1,175 @@
 #!/usr/bin/env python
 # encoding: utf-8
 
-import sys
+# Sets properties in Hadoop *-site.xml files.
+#
+# Existing properties are updated in place and missing ones are appended
+# before </configuration>, so the rest of the file (comments, ordering,
+# indentation) is left as it was. Files are only written, atomically through
+# a temporary file and a rename, if their content actually changes.
+#
+# Exit status is 0 if at least one file changed, EXIT_UNCHANGED if every file
+# was left untouched and 1 on errors.
+
+import os
 import re
-import xml.etree.ElementTree as ElementTree
-import xml.dom.minidom as minidom
+import sys
+import json
+import tempfile
+from xml.sax.saxutils import escape, unescape
+
+USAGE = """./replaceHadoopProperty [--clean] [--backup] <file> <name1> <value1> <name2> <value2> ...
+./replaceHadoopProperty [--clean] [--backup] --manifest <manifest.json|->
+
+The manifest is a JSON object mapping each file to the properties to set on
+it, e.g. {"core-site.xml": {"fs.defaultFS": "hdfs://cluster/"}, ...}
+
+--clean   only keep the given properties, dropping every other one
+--backup  before changing a file, keep its previous version as <file>.bakN"""
+
+EXIT_UNCHANGED = 3
+
+EMPTY_CONFIGURATION = '<?xml version="1.0" ?>\n<configuration>\n</configuration>\n'
+
+# Comments are matched too so that commented out properties are skipped
+TOKEN_RE = re.compile(r'<!--.*?-->|<property>.*?</property>', re.DOTALL)
+NAME_RE = re.compile(r'<name>(.*?)</name>', re.DOTALL)
+VALUE_RE = re.compile(r'<value>(.*?)</value>|<value\s*/>', re.DOTALL)
+INDENT_RE = re.compile(r'^([ \t]*)<property>.*?\n([ \t]*)<name>',
+                       re.DOTALL | re.MULTILINE)
+CONFIGURATION_END_RE = re.compile(r'([ \t]*)</configuration>')
+
+
+def renderConfiguration(content, properties, clean=False):
+    """Returns content with the (name, value) pairs in properties set."""
+    if clean or CONFIGURATION_END_RE.search(content or "") is None:
+        content = EMPTY_CONFIGURATION
+
+    targets = dict(properties)
+    seen = set()
+
+    def replaceProperty(match):
+        prop = match.group(0)
+        if prop.startswith("<!--"):
+            return prop
+
+        nameMatch = NAME_RE.search(prop)
+        if nameMatch is None:
+            return prop
+        name = unescape(nameMatch.group(1).strip())
+        if name not in targets:
+            return prop
+        seen.add(name)
 
-if len(sys.argv) < 2 or len(sys.argv) % 2 != 0:
-    print("./replaceHadoopProperty <file> <name1> <value1> <name2> <value2> ...")
+        value = escape("%s" % targets[name])
+        valueMatch = VALUE_RE.search(prop)
+        if valueMatch is None:
+            return "%s<value>%s</value>%s" % (prop[:nameMatch.end()], value,
+                                              prop[nameMatch.end():])
+        if valueMatch.group(1) is not None and \
+                unescape(valueMatch.group(1)) == unescape(value):
+            return prop
+        return "%s<value>%s</value>%s" % (prop[:valueMatch.start()], value,
+                                          prop[valueMatch.end():])
 
-fileName = sys.argv[1]
-propertyNames = sys.argv[2::2]
-propertyValues = sys.argv[3::2]
-replaced = [False] * len(propertyNames)
+    content = TOKEN_RE.sub(replaceProperty, content)
 
-print(propertyNames)
-print(propertyValues)
+    missing = [(name, value) for name, value in properties if name not in seen]
+    if missing:
+        propertyIndent, childIndent = "\t", "\t\t"
+        indentMatch = INDENT_RE.search(content)
+        if indentMatch is not None:
+            propertyIndent, childIndent = indentMatch.groups()
 
-root = None
+        newProperties = "".join(
+            "%(p)s<property>\n%(c)s<name>%(name)s</name>\n"
+            "%(c)s<value>%(value)s</value>\n%(p)s</property>\n" %
+            {"p": propertyIndent, "c": childIndent,
+             "name": escape(name), "value": escape("%s" % value)}
+            for name, value in missing)
 
-try:
-    tree = ElementTree.parse(fileName)
-    root = tree.getroot()
-except Exception:
-    configurationElement = ElementTree.Element("configuration")
-    tree = ElementTree.ElementTree(configurationElement)
-    root = tree.getroot()
+        endMatch = list(CONFIGURATION_END_RE.finditer(content))[-1]
+        content = content[:endMatch.start()] + newProperties + content[endMatch.start():]
 
-for prop in root.getiterator('property'):
-    children = dict((child.tag, child) for child in prop)
+    return content
 
-    propertyName = children['name'].text.strip()
 
+def nextBackupName(fileName):
+    directory = os.path.dirname(fileName) or "."
+    prefix = os.path.basename(fileName) + ".bak"
+    numbers = [int(name[len(prefix):]) for name in os.listdir(directory)
+               if name.startswith(prefix) and name[len(prefix):].isdigit()]
+    return "%s.bak%d" % (fileName, max(numbers + [-1]) + 1)
+
+
+def replaceProperties(fileName, properties, clean=False, backup=False):
+    """Sets properties in fileName. Returns True if the file changed."""
+    content = None
+    if os.path.exists(fileName):
+        with open(fileName) as f:
+            content = f.read()
+
+    newContent = renderConfiguration(content, properties, clean)
+    if newContent == content:
+        return False
+
+    directory = os.path.dirname(fileName) or "."
+    fd, tempName = tempfile.mkstemp(dir=directory,
+                                    prefix=".%s." % os.path.basename(fileName))
     try:
-        index = propertyNames.index(propertyName)
-        children['value'].text = propertyValues[index]
-        replaced[index] = True
-    except Exception as e:
-        print(str(e))
-        pass
-
-for i, propertyReplaced in enumerate(replaced):
-    if not propertyReplaced:
-        newProperty = ElementTree.SubElement(root, "property")
-        newPropertyName = ElementTree.SubElement(newProperty, "name")
-        newPropertyName.text = propertyNames[i]
-        newPropertyValue = ElementTree.SubElement(newProperty, "value")
-        newPropertyValue.text = propertyValues[i]
-
-def prettify(elem):
-    """Return a pretty-printed XML string for the Element.
-    """
-    rough_string = ElementTree.tostring(elem, 'utf-8')
-    reparsed = minidom.parseString(rough_string)
-    pretty = reparsed.toprettyxml(indent="\t")
-    prettyStr = "\n".join([line for line in pretty.split('\n') if line.strip() != ''])
-    fix = re.compile(r'((?<=>)(\n[\t]*)(?=[^<\t]))|(?<=[^>\t])(\n[\t]*)(?=<)')
-    fixedPrettyStr = re.sub(fix, '', prettyStr)
-    return fixedPrettyStr
-
-with open(fileName, "w") as f:
-    f.write(prettify(root))
+        with os.fdopen(fd, "w") as f:
+            f.write(newContent)
+            f.flush()
+            os.fsync(f.fileno())
+        if content is not None:
+            os.chmod(tempName, os.stat(fileName).st_mode & 0o7777)
+            if backup:
+                os.link(fileName, nextBackupName(fileName))
+        else:
+            os.chmod(tempName, 0o644)
+        os.rename(tempName, fileName)
+    except Exception:
+        os.unlink(tempName)
+        raise
+    return True
+
+
+def loadManifest(manifestFileName):
+    if manifestFileName == "-":
+        manifest = json.load(sys.stdin)
+    else:
+        with open(manifestFileName) as f:
+            manifest = json.load(f)
+
+    return [(fileName, sorted(manifest[fileName].items()))
+            for fileName in sorted(manifest)]
+
+
+def main(args):
+    clean = "--clean" in args
+    backup = "--backup" in args
+    args = [arg for arg in args if arg not in ("--clean", "--backup")]
+
+    if len(args) == 2 and args[0] == "--manifest":
+        propertyFiles = loadManifest(args[1])
+    elif len(args) >= 1 and len(args) % 2 == 1:
+        propertyFiles = [(args[0], list(zip(args[1::2], args[2::2])))]
+    else:
+        print(USAGE)
+        return 1
+
+    changed = False
+    for fileName, properties in propertyFiles:
+        if replaceProperties(fileName, properties, clean, backup):
+            print("changed: %s" % fileName)
+            changed = True
+        else:
+            print("unchanged: %s" % fileName)
+
+    if changed:
+        return 0
+    return EXIT_UNCHANGED
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
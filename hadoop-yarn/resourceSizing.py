@@ -0,0 +1,128 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+# Description:
+#   YARN and MapReduce memory/vcore settings computed from the hardware of
+#   each host (cores, memory and disks, as collected by hostFacts), along
+#   the lines of the Hortonworks yarn-utils.py guidelines.
+#
+#   Every NodeManager gets the memory and vcores left once the OS and the
+#   Hadoop daemons running next to it have their share. The container sizes
+#   (scheduler allocations, map/reduce/AM memory and heaps) are read by the
+#   clients and the ResourceManager, so they are the same for the whole
+#   cluster and have to fit on its smallest NodeManager.
+#
+#   Usage:
+#       sizes = dict((host, sizeHost(cpus, memoryMb, disks, daemonHeapMb=2048))
+#                    for host, (cpus, memoryMb, disks) in inventories.items())
+#       sizes["worker-1"].nodeManagerValues()  # yarn-site.xml of worker-1
+#       clusterValues(sizes.values())  # {"yarn-site.xml": ..., "mapred-site.xml": ...}
+
+import math
+
+# (host memory up to, memory kept for the OS), in GB
+OS_RESERVED_GB = [(4, 1), (8, 2), (16, 2), (24, 4), (48, 6), (64, 8), (72, 8),
+                  (96, 12), (128, 24), (256, 32), (512, 64)]
+# (host memory up to, smallest container), in GB and MB
+MIN_CONTAINER_MB = [(4, 256), (8, 512), (24, 1024)]
+LARGEST_MIN_CONTAINER_MB = 2048
+# Share of a container's memory given to the JVM heap
+HEAP_RATIO = 0.8
+# Share of the map heap used to sort its output (capped by Hadoop at 2047)
+SORT_RATIO = 0.4
+MAX_SORT_MB = 2047
+
+
+class SizingError(Exception):
+    pass
+
+
+def osReservedMb(memoryMb):
+    for upToGb, reservedGb in OS_RESERVED_GB:
+        if memoryMb <= upToGb * 1024:
+            return reservedGb * 1024
+    return OS_RESERVED_GB[-1][1] * 1024
+
+
+def minContainerMb(memoryMb):
+    for upToGb, containerMb in MIN_CONTAINER_MB:
+        if memoryMb <= upToGb * 1024:
+            return containerMb
+    return LARGEST_MIN_CONTAINER_MB
+
+
+def heapOpts(containerMb):
+    return "-Xmx%dm" % int(containerMb * HEAP_RATIO)
+
+
+class HostSize(object):
+    """What YARN gets on a host: containers of containerMb each, memoryMb
+    and vcores in total."""
+
+    def __init__(self, containers, containerMb, vcores):
+        self.containers = containers
+        self.containerMb = containerMb
+        self.memoryMb = containers * containerMb
+        self.vcores = vcores
+
+    def nodeManagerValues(self):
+        return {
+            "yarn.nodemanager.resource.memory-mb": self.memoryMb,
+            "yarn.nodemanager.resource.cpu-vcores": self.vcores,
+        }
+
+
+def sizeHost(cpus, memoryMb, disks, daemonHeapMb=0, reservedVcores=None):
+    """Sizes the NodeManager of a host with cpus cores, memoryMb of memory
+    and disks data disks, where Hadoop daemons with daemonHeapMb of heap in
+    total run besides it. reservedVcores (by default one core on hosts with
+    more than 4) are kept for the OS and the daemons."""
+    if not cpus or not memoryMb:
+        raise SizingError("Unknown number of cores or amount of memory")
+    available = memoryMb - osReservedMb(memoryMb) - daemonHeapMb
+    minContainer = minContainerMb(memoryMb)
+    if available < minContainer:
+        raise SizingError("Only %dMB left for containers out of %dMB" % (available, memoryMb))
+
+    # Bounded by the cores and by the disks, as containers share both
+    containers = min(2 * cpus, int(math.ceil(1.8 * max(1, disks))), available // minContainer)
+    containers = max(1, containers)
+    containerMb = max(minContainer, available // containers)
+    if containerMb > 1024:
+        # Keep the sizes in round numbers, which also leaves some slack
+        containerMb -= containerMb % 512
+    containers = min(containers, available // containerMb)
+
+    if reservedVcores is None:
+        reservedVcores = 1 if cpus > 4 else 0
+    return HostSize(containers, containerMb, max(1, cpus - reservedVcores))
+
+
+def clusterValues(sizes):
+    """Container settings for the whole cluster given the HostSize of every
+    NodeManager host: a container, and a reduce/AM container of two of
+    them, fit on every host, and the scheduler allows up to the largest
+    host."""
+    sizes = list(sizes)
+    if not sizes:
+        raise SizingError("No NodeManager hosts to size the containers for")
+    smallest = min(sizes, key=lambda size: size.memoryMb)
+    containerMb = min(size.containerMb for size in sizes)
+    reduceMb = min(2 * containerMb, smallest.memoryMb)
+
+    yarnValues = {
+        "yarn.scheduler.minimum-allocation-mb": containerMb,
+        "yarn.scheduler.maximum-allocation-mb": max(size.memoryMb for size in sizes),
+        "yarn.scheduler.minimum-allocation-vcores": 1,
+        "yarn.scheduler.maximum-allocation-vcores": max(size.vcores for size in sizes),
+    }
+    mapredValues = {
+        "yarn.app.mapreduce.am.resource.mb": reduceMb,
+        "yarn.app.mapreduce.am.command-opts": heapOpts(reduceMb),
+        "mapreduce.map.memory.mb": containerMb,
+        "mapreduce.map.java.opts": heapOpts(containerMb),
+        "mapreduce.reduce.memory.mb": reduceMb,
+        "mapreduce.reduce.java.opts": heapOpts(reduceMb),
+        "mapreduce.task.io.sort.mb": min(MAX_SORT_MB, int(containerMb * HEAP_RATIO * SORT_RATIO)),
+    }
+    return {"yarn-site.xml": yarnValues, "mapred-site.xml": mapredValues}
@@ -0,0 +1,335 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+# Description:
+#   SSH connection reuse and statistics.
+#
+#   enableStats() counts, per host, the SSH handshakes Fabric makes, the
+#   channels (commands, transfers) it opens and the time it spends
+#   connecting, in every process of the run (including the ones @parallel
+#   forks), and prints a report when the run ends.
+#
+#   SSHConnectionPool keeps one OpenSSH ControlMaster connection per host
+#   open for the whole run. Every command is a new channel multiplexed over
+#   it, whichever process it comes from, so each host costs one handshake per
+#   run instead of one per forked task. Its run/sudo/put methods behave like
+#   Fabric's and can replace them in existing modules with usePool().
+
+import os
+import json
+import time
+import uuid
+import atexit
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from fabric.api import env, abort, warn
+from fabric.state import output
+from fabric.network import normalize
+from fabric.operations import _AttributeString, _prefix_commands, \
+    _prefix_env_vars, _shell_wrap, _sudo_prefix
+
+# Options for ssh commands that hosts run to reach each other: consecutive
+# hops to the same host share one connection, kept for a minute after the
+# last one finishes
+REMOTE_MULTIPLEX_OPTIONS = ("-o ControlMaster=auto -o ControlPersist=60 "
+                            "-o ControlPath=~/.ssh/fab-mux-%r@%h:%p")
+
+_statsDir = None
+_statsOwner = None
+
+
+def _record(host, handshakes=0, connectSeconds=0.0, channels=0):
+    if _statsDir is None:
+        return
+    # One file per process, since forked processes can't share memory
+    with open(os.path.join(_statsDir, "%d.jsonl" % os.getpid()), "a") as f:
+        f.write(json.dumps({"host": host, "handshakes": handshakes,
+                            "connectSeconds": connectSeconds,
+                            "channels": channels}) + "\n")
+
+
+def enableStats():
+    """Starts counting SSH handshakes and channels. The report is printed when
+    the process that called this exits."""
+    global _statsDir, _statsOwner
+    if _statsDir is not None:
+        return
+    _statsDir = tempfile.mkdtemp(prefix="fab-ssh-stats-")
+    _statsOwner = os.getpid()
+
+    import paramiko
+    import fabric.network
+
+    connect = fabric.network.connect
+
+    def timedConnect(user, host, port, *args, **kwargs):
+        start = time.time()
+        try:
+            return connect(user, host, port, *args, **kwargs)
+        finally:
+            _record(host, handshakes=1, connectSeconds=time.time() - start)
+    fabric.network.connect = timedConnect
+
+    openSession = paramiko.Transport.open_session
+
+    def countedOpenSession(self, *args, **kwargs):
+        _record(env.host or env.host_string, channels=1)
+        return openSession(self, *args, **kwargs)
+    paramiko.Transport.open_session = countedOpenSession
+
+    atexit.register(_reportStats)
+
+
+def collectStats():
+    """Returns {host: {"handshakes", "channels", "connectSeconds"}} for every
+    process of the run so far."""
+    stats = {}
+    for fileName in os.listdir(_statsDir):
+        with open(os.path.join(_statsDir, fileName)) as f:
+            for line in f:
+                event = json.loads(line)
+                hostStats = stats.setdefault(event["host"], {
+                    "handshakes": 0, "channels": 0, "connectSeconds": 0.0})
+                for key in ("handshakes", "channels", "connectSeconds"):
+                    hostStats[key] += event[key]
+    return stats
+
+
+def _reportStats():
+    if os.getpid() != _statsOwner:
+        return
+    stats = collectStats()
+    shutil.rmtree(_statsDir, ignore_errors=True)
+    if not stats:
+        return
+
+    print("")
+    print("%-30s %10s %10s %8s %12s" % ("Host", "Handshakes", "Channels", "Reuse", "Connect (s)"))
+    for host in sorted(stats):
+        hostStats = stats[host]
+        print("%-30s %10d %10d %7.0f%% %12.2f" % (
+            host, hostStats["handshakes"], hostStats["channels"],
+            100 * _reuse(hostStats), hostStats["connectSeconds"]))
+    total = {"handshakes": sum(s["handshakes"] for s in stats.values()),
+             "channels": sum(s["channels"] for s in stats.values())}
+    print("%-30s %10d %10d %7.0f%% %12.2f" % (
+        "Total", total["handshakes"], total["channels"], 100 * _reuse(total),
+        sum(s["connectSeconds"] for s in stats.values())))
+
+
+def _reuse(hostStats):
+    # Share of the channels that didn't need a handshake of their own
+    if not hostStats["channels"]:
+        return 0.0
+    return max(0.0, 1 - float(hostStats["handshakes"]) / hostStats["channels"])
+
+
+class FabricOperations(object):
+    """run/sudo/put with Fabric's semantics (cd(), settings(), warn_only,
+    output levels...) on env.host_string, on top of an execute(hostString,
+    command, stdin) method returning (returnCode, stdout, stderr)."""
+
+    def run(self, command, shell=True, warn_only=False, quiet=False, **kwargs):
+        return self._run(command, shell, warn_only, quiet, None, "run")
+
+    def sudo(self, command, shell=True, warn_only=False, quiet=False,
+             user=None, group=None, **kwargs):
+        return self._run(command, shell, warn_only, quiet,
+                         _sudo_prefix(user, group), "sudo")
+
+    def _run(self, command, shell, warnOnly, quiet, sudoPrefix, name, stdin=None):
+        wrappedCommand = _shell_wrap(
+            _prefix_env_vars(_prefix_commands(command, 'remote')),
+            True, shell, sudoPrefix)
+        if sudoPrefix and env.password and stdin is None:
+            stdin = (env.password + "\n").encode('utf-8')
+
+        if output.running and not quiet:
+            print("[%s] %s: %s" % (env.host_string, name, command))
+        returnCode, stdout, stderr = self.execute(env.host_string, wrappedCommand, stdin)
+        if not quiet:
+            for stream, label, lines in ((output.stdout, "out", stdout),
+                                         (output.stderr, "err", stderr)):
+                if stream:
+                    for line in lines.splitlines():
+                        print("[%s] %s: %s" % (env.host_string, label, line))
+
+        result = _AttributeString(stdout.rstrip("\r\n"))
+        result.command = command
+        result.real_command = wrappedCommand
+        result.return_code = returnCode
+        result.stderr = stderr.rstrip("\r\n")
+        result.failed = returnCode != 0
+        result.succeeded = not result.failed
+        if result.failed:
+            message = ("%s() received nonzero return code %s while executing!"
+                       "\n\nRequested: %s\nExecuted: %s"
+                       % (name, returnCode, command, wrappedCommand))
+            if warnOnly or quiet or env.warn_only:
+                if not quiet:
+                    warn(message)
+            else:
+                abort(message)
+        return result
+
+    def put(self, local_path, remote_path=None, use_sudo=False, mode=None, **kwargs):
+        if hasattr(local_path, "read"):
+            data = local_path.read()
+            localName = getattr(local_path, "name", "<file-like object>")
+        else:
+            localName = os.path.expanduser(local_path)
+            with open(localName, "rb") as f:
+                data = f.read()
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        if not remote_path:
+            remote_path = os.path.basename(localName)
+        elif remote_path.endswith("/"):
+            remote_path += os.path.basename(localName)
+
+        if output.running:
+            print("[%s] put: %s -> %s" % (env.host_string, localName, remote_path))
+        uploadPath = remote_path
+        if use_sudo:
+            uploadPath = "/tmp/fab-put-%s" % uuid.uuid4().hex
+        command = "cat > %s" % uploadPath
+        if mode is not None:
+            command += " && chmod %o %s" % (mode, uploadPath)
+
+        failedPaths = []
+        with _quietOutput():
+            result = self._run(command, True, True, False, None, "put", stdin=data)
+            if result.succeeded and use_sudo:
+                result = self._run("mv %s %s" % (uploadPath, remote_path), True, True,
+                                   False, _sudo_prefix(None), "sudo")
+        if result.failed:
+            failedPaths.append(localName)
+            if not env.warn_only:
+                abort("put() encountered an exception while uploading '%s'" % localName)
+
+        uploaded = _PutResult([remote_path] if not failedPaths else [])
+        uploaded.failed = failedPaths
+        uploaded.succeeded = not failedPaths
+        return uploaded
+
+
+class SSHConnectionPool(FabricOperations):
+    """One multiplexed OpenSSH connection per host, shared by every command
+    (and every forked process) of the run."""
+
+    def __init__(self, maxChannelsPerHost=8, persistSeconds=600):
+        # Kept short: UNIX socket paths are limited to ~100 characters
+        self.controlDir = tempfile.mkdtemp(prefix="fab-ssh-", dir="/tmp")
+        self.maxChannelsPerHost = maxChannelsPerHost
+        self.persistSeconds = persistSeconds
+        self.semaphores = {}
+        self.lock = threading.Lock()
+        self.owner = os.getpid()
+        atexit.register(self.close)
+
+    def prepare(self, hosts):
+        """Creates the per-host channel limits. Call before forking, so that
+        forked processes share them instead of each getting its own."""
+        for hostString in hosts:
+            self._semaphore(hostString)
+
+    def _semaphore(self, hostString):
+        with self.lock:
+            if hostString not in self.semaphores:
+                self.semaphores[hostString] = multiprocessing.BoundedSemaphore(
+                    self.maxChannelsPerHost)
+            return self.semaphores[hostString]
+
+    def sshArgs(self, hostString):
+        """Returns the ssh command line (without the remote command) that
+        goes through hostString's master connection."""
+        user, host, port = normalize(hostString)
+        controlPath = os.path.join(self.controlDir, hashlib.md5(
+            ("%s@%s:%s" % (user, host, port)).encode('utf-8')).hexdigest()[:16])
+        args = ["ssh", "-S", controlPath, "-p", str(port), "-l", user,
+                "-o", "BatchMode=yes", "-o", "StrictHostKeyChecking=no"]
+        keys = env.key_filename or []
+        if not isinstance(keys, (list, tuple)):
+            keys = [keys]
+        for key in keys:
+            args += ["-i", os.path.expanduser(key)]
+        return args + [host]
+
+    def ensureMaster(self, hostString):
+        args = self.sshArgs(hostString)
+        with open(os.devnull, "w") as devnull:
+            if subprocess.call(args[:-1] + ["-O", "check", args[-1]],
+                               stdout=devnull, stderr=devnull) == 0:
+                return
+
+            # Other processes may be trying to start the same master
+            with open(args[2] + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if subprocess.call(args[:-1] + ["-O", "check", args[-1]],
+                                   stdout=devnull, stderr=devnull) == 0:
+                    return
+                start = time.time()
+                if subprocess.call(args[:-1] + ["-M", "-f", "-N", "-o",
+                                                "ControlPersist=%d" % self.persistSeconds,
+                                                args[-1]], stdout=devnull) != 0:
+                    abort("Could not connect to %s" % hostString)
+                _record(normalize(hostString)[1], handshakes=1,
+                        connectSeconds=time.time() - start)
+
+    def execute(self, hostString, command, stdin=None):
+        """Runs command on hostString. Returns (returnCode, stdout, stderr)."""
+        with self._semaphore(hostString):
+            self.ensureMaster(hostString)
+            process = subprocess.Popen(self.sshArgs(hostString) + [command],
+                                       stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            stdout, stderr = process.communicate(stdin)
+            _record(normalize(hostString)[1], channels=1)
+        return (process.returncode, stdout.decode('utf-8', 'replace'),
+                stderr.decode('utf-8', 'replace'))
+
+    def close(self):
+        if os.getpid() != self.owner:
+            return
+        with open(os.devnull, "w") as devnull:
+            for hostString in list(self.semaphores):
+                args = self.sshArgs(hostString)
+                subprocess.call(args[:-1] + ["-O", "exit", args[-1]],
+                                stdout=devnull, stderr=devnull)
+        shutil.rmtree(self.controlDir, ignore_errors=True)
+
+
+class _PutResult(list):
+    pass
+
+
+class _quietOutput(object):
+    # Hides the commands put() is made of, like Fabric does
+    def __enter__(self):
+        self.running = output.running
+        output.running = False
+
+    def __exit__(self, *excInfo):
+        output.running = self.running
+
+
+def usePool(pool, modules):
+    """Makes run/sudo/put in each of modules go through pool. Returns the
+    previous bindings, for restoreBindings()."""
+    previous = []
+    for module in modules:
+        for name in ("run", "sudo", "put"):
+            if hasattr(module, name):
+                previous.append((module, name, getattr(module, name)))
+                setattr(module, name, getattr(pool, name))
+    return previous
+
+
+def restoreBindings(previous):
+    for module, name, value in previous:
+        setattr(module, name, value)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+# Description:
+#   Runs a set of Fabric tasks ("steps") as a dependency graph instead of
+#   host by host. Each step declares the steps it depends on and its scope:
+#   PER_HOST steps run on every host (or on the hosts given, for steps that
+#   only apply to some roles) and RUNS_ONCE steps run a single time.
+#
+#   A PER_HOST step on a host depends on the same host's unit of each of its
+#   dependencies when that dependency runs there too, and on every unit of it
+#   otherwise. Units whose dependencies are done run concurrently, each in
+#   its own process, with at most `workers` of them at a time. A failed unit
+#   only blocks the units that depend on it; everything else carries on.
+#
+#   As every unit runs in its own process, nothing a step leaves behind in
+#   memory (globals, @runs_once return values) reaches the steps after it.
+#   A step that later steps need something from returns it and gives a
+#   collect function, which gets the return value in the scheduling process
+#   before any unit depending on the step starts (and so is inherited by
+#   their processes).
+#
+#   Usage:
+#       graph = TaskGraph()
+#       graph.add("installDependencies", installDependencies)
+#       graph.add("setupHosts", setupHosts, scope=RUNS_ONCE)
+#       graph.add("sizes", computeSizes, scope=RUNS_ONCE, collect=useSizes)
+#       graph.add("startZK", startZKserver, hosts=zkHosts,
+#                 deps=["installDependencies", "setupHosts"])
+#       graph.run(workers=10)
+
+import time
+import multiprocessing
+from fabric.api import env, abort
+from fabric import state
+from fabric.tasks import execute
+
+PER_HOST = "host"
+RUNS_ONCE = "once"
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+BLOCKED = "blocked"
+
+
+class Step(object):
+    def __init__(self, name, function, args=(), deps=(), scope=PER_HOST, hosts=None,
+                 collect=None):
+        self.name = name
+        self.function = function
+        self.args = tuple(args)
+        self.deps = list(deps)
+        self.scope = scope
+        self.hosts = hosts
+        self.collect = collect
+
+    def unitHosts(self):
+        hosts = self.hosts if self.hosts is not None else env.hosts
+        if self.scope == RUNS_ONCE:
+            return [None]
+        seen = set()
+        return [host for host in hosts if host and host not in seen and not seen.add(host)]
+
+    def onceHost(self):
+        # Host the context of a RUNS_ONCE step is set to
+        hosts = self.hosts if self.hosts is not None else env.hosts
+        return hosts[0]
+
+
+class TaskGraph(object):
+    def __init__(self):
+        self.steps = []
+        self.stepsByName = {}
+
+    def add(self, name, function, args=(), deps=(), scope=PER_HOST, hosts=None, collect=None):
+        if name in self.stepsByName:
+            raise ValueError("Duplicate step %s" % name)
+        for dep in deps:
+            if dep not in self.stepsByName:
+                # Steps have to be added after their dependencies, which also
+                # keeps the graph free of cycles
+                raise ValueError("Step %s depends on unknown step %s" % (name, dep))
+        step = Step(name, function, args, deps, scope, hosts, collect)
+        self.steps.append(step)
+        self.stepsByName[name] = step
+        return step
+
+    def units(self):
+        """Returns an ordered {(stepName, host): [dependency units]} dict."""
+        unitHosts = dict((step.name, step.unitHosts()) for step in self.steps)
+        units = {}
+        order = []
+        for step in self.steps:
+            for host in unitHosts[step.name]:
+                deps = []
+                for dep in step.deps:
+                    if host is not None and host in unitHosts[dep]:
+                        deps.append((dep, host))
+                    else:
+                        deps.extend((dep, depHost) for depHost in unitHosts[dep])
+                units[(step.name, host)] = deps
+                order.append((step.name, host))
+        return order, units
+
+    def run(self, workers=10):
+        """Runs every step and aborts at the end if any unit failed or was
+        blocked. Returns the {unit: state} dict otherwise."""
+        if workers < 1:
+            raise ValueError("TaskGraph needs at least one worker, not %s" % workers)
+        order, deps = self.units()
+        states = dict((unit, PENDING) for unit in order)
+        errors = {}
+        started = {}
+        durations = {}
+        running = {}
+
+        try:
+            context = multiprocessing.get_context("fork")
+        except AttributeError:
+            context = multiprocessing
+        results = context.Queue()
+
+        while any(states[unit] in (PENDING, RUNNING) for unit in order):
+            for unit in order:
+                if states[unit] != PENDING:
+                    continue
+                depStates = [states[dep] for dep in deps[unit]]
+                if any(depState in (FAILED, BLOCKED) for depState in depStates):
+                    states[unit] = BLOCKED
+                    continue
+                if not all(depState == DONE for depState in depStates):
+                    continue
+
+                step = self.stepsByName[unit[0]]
+                if len(running) < workers:
+                    states[unit] = RUNNING
+                    started[unit] = time.time()
+                    process = context.Process(target=_runWorker,
+                                              args=(step, unit, results))
+                    process.start()
+                    running[unit] = process
+
+            if not running:
+                continue
+
+            try:
+                received = [results.get(timeout=1)]
+            except Exception:
+                # A worker may report back and exit right as the wait times
+                # out, so whatever is queued is taken before deciding which
+                # workers died without reporting back
+                received = self._drain(results)
+                reported = set(unit for unit, error, value in received)
+                for unit, process in list(running.items()):
+                    if not process.is_alive() and unit not in reported:
+                        process.join()
+                        del running[unit]
+                        self._finish(unit, "worker exited with code %s" % process.exitcode,
+                                     states, errors, started, durations)
+            for unit, error, value in received:
+                if unit not in running:
+                    # Already given up on
+                    continue
+                running.pop(unit).join()
+                step = self.stepsByName[unit[0]]
+                if error is None and step.collect is not None:
+                    try:
+                        step.collect(value)
+                    except (Exception, SystemExit) as e:
+                        error = "collecting its result failed: %s" % (str(e) or e.__class__.__name__)
+                self._finish(unit, error, states, errors, started, durations)
+
+        self._report(order, states, errors, durations)
+        if any(states[unit] != DONE for unit in order):
+            abort("%d of %d steps did not complete" %
+                  (len([unit for unit in order if states[unit] != DONE]), len(order)))
+        return states
+
+    def _drain(self, results):
+        received = []
+        while True:
+            try:
+                received.append(results.get_nowait())
+            except Exception:
+                return received
+
+    def _finish(self, unit, error, states, errors, started, durations):
+        durations[unit] = time.time() - started[unit]
+        if error is None:
+            states[unit] = DONE
+        else:
+            states[unit] = FAILED
+            errors[unit] = error
+
+    def _report(self, order, states, errors, durations):
+        print("")
+        print("%-30s %-20s %-8s %8s" % ("Step", "Host", "State", "Seconds"))
+        for unit in order:
+            stepName, host = unit
+            duration = durations.get(unit)
+            print("%-30s %-20s %-8s %8s" % (stepName, host or "(once)", states[unit],
+                                            "%.1f" % duration if duration is not None else "-"))
+        for unit in order:
+            if unit in errors:
+                print("%s on %s failed: %s" % (unit[0], unit[1] or "(once)", errors[unit]))
+
+
+def _runUnit(step, host):
+    # Returns (None, return value) on success and (error message, None)
+    # otherwise
+    try:
+        values = execute(step.function, *step.args, hosts=[host])
+    except (Exception, SystemExit) as e:
+        return str(e) or e.__class__.__name__, None
+    return None, list(values.values())[0] if values else None
+
+
+def _runWorker(step, unit, results):
+    # Connections opened by the parent can't be shared with it
+    state.connections.clear()
+    host = step.onceHost() if step.scope == RUNS_ONCE else unit[1]
+    error, value = _runUnit(step, host)
+    # Only values someone collects are sent back, as they must be picklable
+    results.put((unit, error, value if step.collect is not None else None))
@@ -0,0 +1,12 @@
+# encoding: utf-8
+
+# Description:
+#   Makes the modules next to the fabfile importable from the tests.
+#
+#   Usage:
+#       cd hadoop-yarn && python -m pytest tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
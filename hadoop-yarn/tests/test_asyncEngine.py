@@ -0,0 +1,101 @@
+# encoding: utf-8
+
+# Description:
+#   AsyncSSHEngine running fabfile tasks on fake hosts: the pool's ssh
+#   command line is replaced by a local sh that runs the command with the
+#   host it was meant for in $FAKE_HOST.
+#
+#   Usage:
+#       cd hadoop-yarn && python3 -m pytest tests/test_asyncEngine.py
+
+import os
+
+import pytest
+
+pytest.importorskip("asyncio")
+pytest.importorskip("fabric")
+
+from fabric.api import cd, env, settings
+
+import fabfile
+from asyncEngine import AsyncSSHEngine
+from hostFacts import FactCache, FactProbe
+
+HOSTS = ["h1", "deploy@h2", "h3:2222"]
+
+# Stands in for `ssh ... host command`: master checks (-O) succeed, the
+# command runs locally
+FAKE_SSH = '[ "$1" = -O ] && exit 0; FAKE_HOST="$1" exec sh -c "$2"'
+
+
+class FakePool(object):
+    persistSeconds = 60
+
+    def __init__(self):
+        self.prepared = []
+
+    def sshArgs(self, hostString):
+        return ["sh", "-c", FAKE_SSH, "fakessh", hostString]
+
+    def prepare(self, hosts):
+        self.prepared += hosts
+
+
+@pytest.fixture
+def engine(request, monkeypatch):
+    # Without the local login profile, which has nothing to do with the hosts
+    monkeypatch.setitem(env, "shell", "/bin/sh -c")
+    pool = FakePool()
+    engine = AsyncSSHEngine(pool, maxConcurrency=2, maxChannelsPerHost=1,
+                            modules=fabfile.poolModules())
+    request.addfinalizer(engine.stop)
+    return engine
+
+
+@pytest.fixture
+def fakeFacts(monkeypatch, tmpdir):
+    # Facts aren't cached, and each host's private IP is its name
+    monkeypatch.setattr(fabfile, "_factCache", FactCache(
+        str(tmpdir), 0, FactProbe(ipCommand='echo "$FAKE_HOST"')))
+
+
+def testExecuteTask(engine, fakeFacts):
+    bindings = [(module, getattr(module, "run")) for module in fabfile.poolModules()
+                if hasattr(module, "run")]
+    privateIps = engine.executeTask(fabfile.getPrivateIp, hosts=HOSTS)
+    assert privateIps == dict((host, host) for host in HOSTS)
+    assert sorted(engine.pool.prepared) == sorted(HOSTS)
+    for module, originalRun in bindings:
+        assert getattr(module, "run") is originalRun
+    assert env.host_string is None
+
+
+def testEnvIsPrivateToEachHost(engine, tmpdir):
+    for hostname in ["h1", "h2", "h3"]:
+        tmpdir.mkdir(hostname)
+
+    def task():
+        with cd(os.path.join(str(tmpdir), env.host)):
+            with settings(hostPort=env.port):
+                return (env.user, env.hostPort, fabfile.run('echo "$FAKE_HOST"'),
+                        os.path.basename(fabfile.run("pwd")))
+    results = engine.executeTask(task, hosts=HOSTS)
+    assert results == {
+        "h1": (env.user, "22", "h1", "h1"),
+        "deploy@h2": ("deploy", "22", "deploy@h2", "h2"),
+        "h3:2222": (env.user, "2222", "h3:2222", "h3"),
+    }
+    assert "hostPort" not in env
+    assert not env.get("cwd")
+
+
+def testExecuteTaskAbortsIfAnyHostFails(engine):
+    originalRun = fabfile.run
+
+    def task():
+        if env.host == "h3":
+            fabfile.run("exit 3")
+        return fabfile.run("echo ok")
+    with pytest.raises(SystemExit):
+        engine.executeTask(task, hosts=HOSTS)
+    assert fabfile.run is originalRun
@@ -0,0 +1,206 @@
+# encoding: utf-8
+
+# Description:
+#   zkProbe against fake ZooKeeper servers answering the four letter words
+#   from threads on local ports.
+#
+#   Usage:
+#       cd hadoop-yarn && python -m pytest tests/test_zkProbe.py
+
+import socket
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from zkProbe import NOT_SERVING, healthProblems, parseMntr, parseStat, probeEnsemble, probeServer
+
+LEADER_STAT = """Zookeeper version: 3.4.14-4c25d480e66aadd371de8bd2fd8da255ac140bcf, built on 03/06/2019 16:18 GMT
+Clients:
+ /127.0.0.1:51234[0](queued=0,recved=1,sent=0)
+
+Latency min/avg/max: 0/3/41
+Received: 1024
+Sent: 1023
+Connections: 1
+Outstanding: 2
+Zxid: 0x100000a2c
+Mode: leader
+Node count: 143
+"""
+
+LEADER_MNTR = """zk_version\t3.4.14-4c25d480e66aadd371de8bd2fd8da255ac140bcf, built on 03/06/2019 16:18 GMT
+zk_avg_latency\t3
+zk_max_latency\t41
+zk_min_latency\t0
+zk_outstanding_requests\t2
+zk_server_state\tleader
+zk_znode_count\t143
+zk_followers\t2
+zk_synced_followers\t2
+"""
+
+FOLLOWER_STAT = LEADER_STAT.replace("Mode: leader", "Mode: follower")
+FOLLOWER_MNTR = """zk_avg_latency\t1.5
+zk_max_latency\t12
+zk_min_latency\t0
+zk_outstanding_requests\t0
+zk_server_state\tfollower
+zk_znode_count\t143
+"""
+
+
+class FakeZooKeeper(socketserver.ThreadingTCPServer):
+    """Answers each four letter word with answers[word] and closes the
+    connection, like ZooKeeper does. Unknown words get no answer."""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, answers):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0), FakeZooKeeperHandler)
+        self.answers = answers
+        self.asked = []
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={"poll_interval": 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeZooKeeperHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        word = self.request.recv(4).decode("ascii")
+        self.server.asked.append(word)
+        self.request.sendall(self.server.answers.get(word, "").encode("utf-8"))
+
+
+def fakeServer(request, answers):
+    server = FakeZooKeeper(answers)
+    request.addfinalizer(server.stop)
+    return server
+
+
+def unusedPort():
+    # Bound then released, so nothing listens there during the test
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    return port
+
+
+def testParseMntr():
+    values = parseMntr(LEADER_MNTR + "not a zk line\nzk_empty\t\n")
+    assert values["server_state"] == "leader"
+    assert values["avg_latency"] == 3
+    assert values["synced_followers"] == 2
+    assert values["version"].startswith("3.4.14")
+    assert "empty" not in values
+
+
+def testParseStat():
+    values = parseStat(LEADER_STAT)
+    assert values == {"min_latency": 0, "avg_latency": 3, "max_latency": 41,
+                      "outstanding_requests": 2, "zxid": "0x100000a2c",
+                      "server_state": "leader", "znode_count": 143}
+
+
+def testProbeServer(request):
+    server = fakeServer(request, {"ruok": "imok", "stat": LEADER_STAT, "mntr": LEADER_MNTR})
+    result = probeServer("127.0.0.1", server.port, timeout=5)
+    assert result["ok"] and result["error"] is None
+    assert result["server_state"] == "leader"
+    assert result["followers"] == 2
+    assert result["zxid"] == "0x100000a2c"
+    assert server.asked == ["ruok", "stat", "mntr"]
+
+
+def testProbeServerNotServing(request):
+    # What a server that lost its quorum answers: imok, but no stat
+    server = fakeServer(request, {"ruok": "imok", "stat": NOT_SERVING + "\n"})
+    result = probeServer("127.0.0.1", server.port, timeout=5)
+    assert not result["ok"]
+    assert result["error"] == "not serving requests"
+    assert server.asked == ["ruok", "stat"]
+
+
+def testProbeServerWithoutImok(request):
+    server = fakeServer(request, {"ruok": ""})
+    result = probeServer("127.0.0.1", server.port, timeout=5)
+    assert not result["ok"]
+    assert result["error"] == "didn't answer imok"
+
+
+def testProbeServerUnreachable():
+    result = probeServer("127.0.0.1", unusedPort(), timeout=5)
+    assert not result["ok"]
+    assert result["error"]
+
+
+def testMntrFallsBackToStat(request):
+    # mntr not whitelisted: stat alone gives the role and the latency
+    server = fakeServer(request, {"ruok": "imok", "stat": FOLLOWER_STAT})
+    result = probeServer("127.0.0.1", server.port, timeout=5)
+    assert result["ok"]
+    assert result["server_state"] == "follower"
+    assert result["avg_latency"] == 3
+
+
+def probeFakeEnsemble(request, answersByServer):
+    # probeEnsemble() takes one port for all the hosts, so the servers are
+    # told apart by their results instead
+    results = []
+    for answers in answersByServer:
+        server = fakeServer(request, answers)
+        results += probeEnsemble(["127.0.0.1"], server.port, timeout=5)
+    for number, result in enumerate(results):
+        result["host"] = "zk%d" % (number + 1)
+    return results
+
+
+def testHealthyEnsemble(request):
+    results = probeFakeEnsemble(request, [
+        {"ruok": "imok", "stat": LEADER_STAT, "mntr": LEADER_MNTR},
+        {"ruok": "imok", "stat": FOLLOWER_STAT, "mntr": FOLLOWER_MNTR},
+        {"ruok": "imok", "stat": FOLLOWER_STAT, "mntr": FOLLOWER_MNTR},
+    ])
+    assert healthProblems(results, maxAvgLatencyMs=50, maxOutstanding=100) == []
+    assert healthProblems(results, maxAvgLatencyMs=2, maxOutstanding=1) == [
+        "zk1: average latency 3ms (more than 2ms)",
+        "zk1: 2 outstanding requests (more than 1)",
+    ]
+
+
+def testEnsembleWithoutQuorum(request):
+    notServing = {"ruok": "imok", "stat": NOT_SERVING + "\n"}
+    results = probeFakeEnsemble(request, [
+        notServing, notServing,
+        {"ruok": "imok", "stat": FOLLOWER_STAT, "mntr": FOLLOWER_MNTR},
+    ])
+    assert healthProblems(results, maxAvgLatencyMs=50, maxOutstanding=100) == [
+        "zk1 is down: not serving requests",
+        "zk2 is down: not serving requests",
+        "only 1 of 3 servers serve requests, no quorum",
+        "0 leaders (none)",
+    ]
+
+
+def testFollowerOutOfSync(request):
+    results = probeFakeEnsemble(request, [
+        {"ruok": "imok", "stat": LEADER_STAT,
+         "mntr": LEADER_MNTR.replace("zk_synced_followers\t2", "zk_synced_followers\t1")},
+        {"ruok": "imok", "stat": FOLLOWER_STAT, "mntr": FOLLOWER_MNTR},
+        {"ruok": "imok", "stat": FOLLOWER_STAT, "mntr": FOLLOWER_MNTR},
+    ])
+    assert healthProblems(results, maxAvgLatencyMs=50, maxOutstanding=100) == [
+        "1 of 2 followers in sync with the leader zk1",
+    ]
+
@@ -0,0 +1,10 @@
+#!/bin/sh
+
+# Prints the rack of each host name or IP given as argument, as listed in
+# the topology.data file next to this script ("<name> <rack>" lines, "*"
+# for the default rack). Used by Hadoop as net.topology.script.file.name.
+data=`dirname $0`/topology.data
+for host in "$@"; do
+    rack=`awk -v h="$host" '$1 == h { r = $2 } $1 == "*" { d = $2 } END { print (r != "" ? r : d) }' "$data" 2>/dev/null`
+    echo "${rack:-/default-rack}"
+done
@@ -0,0 +1,167 @@
+#!/usr/bin/env python2
+# encoding: utf-8
+
+# Description:
+#   State of every server of a ZooKeeper ensemble through its four letter
+#   words (ruok, stat, mntr), sent to all of them at once from the control
+#   node: whether it serves requests, its role (leader/follower), latency,
+#   outstanding requests, znode count and, for the leader, how many
+#   followers are in sync. mntr is preferred and stat fills in what it
+#   doesn't give (e.g. when mntr isn't allowed).
+#
+#   Usage:
+#       results = probeEnsemble(["zk1", "zk2", "zk3"], 2181, timeout=5)
+#       print(formatTable(results))
+#       problems = healthProblems(results, maxAvgLatencyMs=50, maxOutstanding=100)
+
+import socket
+import threading
+
+NOT_SERVING = "This ZooKeeper instance is not currently serving requests"
+
+
+def fourLetterWord(host, port, command, timeout):
+    """What the server at host:port answers to command. Raises socket.error
+    if it can't be reached."""
+    connection = socket.create_connection((host, port), timeout)
+    try:
+        connection.sendall(command.encode("ascii"))
+        chunks = []
+        while True:
+            chunk = connection.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        connection.close()
+    return b"".join(chunks).decode("utf-8", "replace")
+
+
+def _number(value):
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+def parseMntr(output):
+    """{key: value} of the tab separated lines of mntr, without the zk_
+    prefix."""
+    values = {}
+    for line in output.splitlines():
+        key, _, value = line.partition("\t")
+        if key.startswith("zk_") and value:
+            values[key[3:]] = _number(value.strip())
+    return values
+
+
+def parseStat(output):
+    """The same keys as parseMntr for what stat reports."""
+    values = {}
+    for line in output.splitlines():
+        name, _, value = line.partition(":")
+        value = value.strip()
+        if name == "Latency min/avg/max":
+            latencies = value.split("/")
+            if len(latencies) == 3:
+                values["min_latency"], values["avg_latency"], values["max_latency"] = \
+                    [_number(latency) for latency in latencies]
+        elif name == "Mode":
+            values["server_state"] = value
+        elif name == "Outstanding":
+            values["outstanding_requests"] = _number(value)
+        elif name == "Node count":
+            values["znode_count"] = _number(value)
+        elif name == "Zxid":
+            values["zxid"] = value
+    return values
+
+
+def probeServer(host, port, timeout):
+    """{"host", "ok", "error", and the keys of parseMntr} for the server at
+    host:port. ok is whether it answered ruok and serves requests."""
+    result = {"host": host, "ok": False, "error": None}
+    try:
+        if fourLetterWord(host, port, "ruok", timeout).strip() != "imok":
+            result["error"] = "didn't answer imok"
+            return result
+        stat = fourLetterWord(host, port, "stat", timeout)
+        if NOT_SERVING in stat:
+            result["error"] = "not serving requests"
+            return result
+        result.update(parseStat(stat))
+        result.update(parseMntr(fourLetterWord(host, port, "mntr", timeout)))
+    except (socket.error, socket.timeout) as e:
+        result["error"] = str(e) or e.__class__.__name__
+        return result
+    result["ok"] = True
+    return result
+
+
+def probeEnsemble(hosts, port, timeout):
+    """probeServer() of every host, queried concurrently, in hosts order."""
+    results = {}
+
+    def probe(host):
+        results[host] = probeServer(host, port, timeout)
+
+    threads = [threading.Thread(target=probe, args=(host,)) for host in hosts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [results[host] for host in hosts]
+
+
+def formatTable(results):
+    lines = ["%-30s %-10s %9s %9s %11s %8s %9s" % (
+        "Server", "Role", "Avg (ms)", "Max (ms)", "Outstanding", "Znodes", "Followers")]
+    for result in results:
+        if not result["ok"]:
+            lines.append("%-30s %-10s %s" % (result["host"], "down", result["error"]))
+            continue
+        followers = "-"
+        if result.get("server_state") == "leader" and "followers" in result:
+            followers = "%s/%s" % (result.get("synced_followers", "?"), result["followers"])
+        lines.append("%-30s %-10s %9s %9s %11s %8s %9s" % (
+            result["host"], result.get("server_state", "?"), result.get("avg_latency", "?"),
+            result.get("max_latency", "?"), result.get("outstanding_requests", "?"),
+            result.get("znode_count", "?"), followers))
+    return "\n".join(lines)
+
+
+def healthProblems(results, maxAvgLatencyMs, maxOutstanding):
+    """Why the ensemble of results isn't healthy, if it isn't: servers down,
+    no quorum or no single leader, followers out of sync with the leader,
+    or latency / outstanding requests above the thresholds."""
+    problems = []
+    serving = [result for result in results if result["ok"]]
+    for result in results:
+        if not result["ok"]:
+            problems.append("%s is down: %s" % (result["host"], result["error"]))
+    if len(serving) <= len(results) // 2:
+        problems.append("only %d of %d servers serve requests, no quorum" %
+                        (len(serving), len(results)))
+
+    leaders = [result for result in serving
+               if result.get("server_state") in ("leader", "standalone")]
+    if serving and len(leaders) != 1:
+        problems.append("%d leaders (%s)" % (
+            len(leaders), ", ".join(result["host"] for result in leaders) or "none"))
+    for leader in leaders:
+        synced = leader.get("synced_followers")
+        if synced is not None and synced < len(results) - 1:
+            problems.append("%d of %d followers in sync with the leader %s" %
+                            (synced, len(results) - 1, leader["host"]))
+
+    for result in serving:
+        if result.get("avg_latency", 0) > maxAvgLatencyMs:
+            problems.append("%s: average latency %sms (more than %sms)" %
+                            (result["host"], result["avg_latency"], maxAvgLatencyMs))
+        if result.get("outstanding_requests", 0) > maxOutstanding:
+            problems.append("%s: %s outstanding requests (more than %s)" %
+                            (result["host"], result["outstanding_requests"], maxOutstanding))
+    return problems
@@ -21,8 +21,17 @@
 #   have to dive into the DON'T CHANGE section but it shouldn't
 #   be too hard.
 
+import os
+import sys
 from fabric.api import run, cd, env, settings, put, sudo
 
+# Helper modules are shared with the hadoop-yarn scripts instead of copied
+HELPERS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           "hadoop-yarn")
+sys.path.insert(0, HELPERS_DIR)
+
+from commandTrace import enableTracing
+
 ###############################################################
 #  START OF YOUR CONFIGURATION (CHANGE FROM HERE, IF NEEDED)  #
 ###############################################################
@@ -49,10 +58,17 @@ JENKINS_SLAVE_HOSTS = []
 DEBIAN_32_COMPAT = ["libc6-i386", "lib32stdc++6", "lib32gcc1", 
     "lib32ncurses5", "lib32z1"]
 # Packages that should be installed on the master host
-MASTER_REQUIREMENTS = ["openjdk-7-jre-headless", "git"] + DEBIAN_32_COMPAT
+MASTER_REQUIREMENTS = ["openjdk-7-jre-headless", "git", "python"] + DEBIAN_32_COMPAT
 # Packages that should be installed on the slave hosts
 SLAVE_REQUIREMENTS = ["openjdk-7-jre-headless", "git", "php5", "php5-json", 
     "ant"] + DEBIAN_32_COMPAT
+
+# Record the host, task, timing, exit code and bytes transferred of every
+# remote command, and write them to COMMAND_TRACE_FILE (Chrome trace event
+# format, see chrome://tracing) with a summary of the slowest commands,
+# hosts and tasks at the end of a run
+COMMAND_TRACE = False
+COMMAND_TRACE_FILE = "fabric-trace.json"
 ##############################################################
 #  END OF YOUR CONFIGURATION (CHANGE UNTIL HERE, IF NEEDED)  #
 ##############################################################
@@ -75,6 +91,9 @@ if not env.hosts:
 
 JENKINS_MASTER_HOST = env.hosts[0]
 
+if COMMAND_TRACE:
+    enableTracing(COMMAND_TRACE_FILE, [sys.modules[__name__]])
+
 # Main functions
 def setup():
     setupMaster()
@@ -117,9 +136,13 @@ def installJenkinsPlugins(plugins):
         if run("test -d /var/lib/jenkins/plugins").failed:
             sudo("mkdir -p /var/lib/jenkins/plugins")
             sudo("chown jenkins /var/lib/jenkins/plugins")
+    # Reruns resume or skip plugins that were already downloaded, instead
+    # of leaving truncated files behind or piling up plugin.hpi.N copies
+    put(os.path.join(HELPERS_DIR, "fetchArtifact.py"), "/tmp/fetchArtifact.py", mode=0o755)
     with cd("/var/lib/jenkins/plugins"):
         for plugin in plugins:
-            sudo("wget %s/%s.hpi" % (JENKINS_PLUGIN_DOWNLOAD_URL, plugin))
+            sudo("/tmp/fetchArtifact.py %s/%s.hpi %s.hpi" %
+                 (JENKINS_PLUGIN_DOWNLOAD_URL, plugin, plugin))
     print("+ Jenkins plugins installed")
 
 def changeIniStyleConfig(fileName, variables, useSudo=False):
@@ -7,12 +7,21 @@
 #   in a cluster.
 
 import os
+import sys
 import tempfile
 import textwrap
 from fabric.api import run, cd, env, settings, put, sudo
 from fabric.decorators import runs_once, parallel
 from fabric.tasks import execute
 
+# Helper modules are shared with the hadoop-yarn scripts instead of copied
+HELPERS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           "hadoop-yarn")
+sys.path.insert(0, HELPERS_DIR)
+
+from commandBatch import CommandBatch
+from commandTrace import enableTracing
+
 env.password = "password"
 
 # Packages info
@@ -70,6 +79,7 @@ PREINSTALL_COMMANDS = [
 INSTALL_COMMAND = "apt-get -qq install {package}"
 DEPENDENCIES = [
     "wget",
+    "python",
     "build-essential",
     "apache2",
     "apache2-utils",
@@ -89,6 +99,14 @@ POSTINSTALL_COMMANDS = [
     "service {0} restart".format(APACHE2_DAEMON)
 ]
 
+# Command traces
+# Record the host, task, timing, exit code and bytes transferred of every
+# remote command, and write them to COMMAND_TRACE_FILE (Chrome trace event
+# format, see chrome://tracing) with a summary of the slowest commands,
+# hosts and tasks at the end of a run
+COMMAND_TRACE = False
+COMMAND_TRACE_FILE = "fabric-trace.json"
+
 def bootstrapFabric():
     hosts = [CLUSTER_MASTER] + CLUSTER_WORKERS
     seen = set()
@@ -96,6 +114,10 @@ def bootstrapFabric():
     cleanedHosts = [host for host in hosts if host and host not in seen and not seen.add(host)]
     env.hosts = cleanedHosts
 
+    if COMMAND_TRACE:
+        import commandBatch
+        enableTracing(COMMAND_TRACE_FILE, [sys.modules[__name__], commandBatch])
+
     retrieveClusterInformation()
 
     print("Hosts to IPS:")
@@ -138,9 +160,7 @@ def installCore():
             print("Core already installed.")
             return
 
-    with settings(warn_only=True):
-        if run("test -f %s.tar.gz" % NAGIOS_CORE_PACKAGE).failed:
-            run("wget -O %s.tar.gz %s" % (NAGIOS_CORE_PACKAGE, NAGIOS_CORE_URL))
+    fetchPackage(NAGIOS_CORE_URL, "%s.tar.gz" % NAGIOS_CORE_PACKAGE)
     run("tar --overwrite -xf %s.tar.gz" % NAGIOS_CORE_PACKAGE)
 
     with cd(NAGIOS_CORE_PACKAGE):
@@ -160,9 +180,7 @@ def installCore():
 
 
 def installPlugins():
-    with settings(warn_only=True):
-        if run("test -f {}.tar.gz".format(NAGIOS_PLUGINS_PACKAGE)).failed:
-            run("wget -O {}.tar.gz {}".format(NAGIOS_PLUGINS_PACKAGE, NAGIOS_PLUGINS_URL))
+    fetchPackage(NAGIOS_PLUGINS_URL, "{}.tar.gz".format(NAGIOS_PLUGINS_PACKAGE))
     run("tar --overwrite -xf {}.tar.gz".format(NAGIOS_PLUGINS_PACKAGE))
 
     with cd(NAGIOS_PLUGINS_PACKAGE):
@@ -172,9 +190,7 @@ def installPlugins():
 
 
 def installNRPE():
-    with settings(warn_only=True):
-        if run("test -f %s.tar.gz" % NRPE_PACKAGE).failed:
-            run("wget -O %s.tar.gz %s" % (NRPE_PACKAGE, NRPE_URL))
+    fetchPackage(NRPE_URL, "%s.tar.gz" % NRPE_PACKAGE)
     run("tar --overwrite -xf %s.tar.gz" % NRPE_PACKAGE)
 
     with cd(NRPE_PACKAGE):
@@ -195,9 +211,7 @@ def installPNP4Nagios():
     if not env.host == CLUSTER_MASTER:
         return
 
-    with settings(warn_only=True):
-        if run("test -f %s.tar.gz" % PNP4NAGIOS_PACKAGE).failed:
-            run("wget -O %s.tar.gz %s" % (PNP4NAGIOS_PACKAGE, PNP4NAGIOS_URL))
+    fetchPackage(PNP4NAGIOS_URL, "%s.tar.gz" % PNP4NAGIOS_PACKAGE)
     run("tar --overwrite -xf %s.tar.gz" % PNP4NAGIOS_PACKAGE)
 
     with cd(PNP4NAGIOS_PACKAGE):
@@ -337,21 +351,16 @@ def addCommandsToConfig():
 
 
 def addLinesToFile(cfg_file, lines):
+    batch = CommandBatch()
     with settings(warn_only=True):
-        if not sudo("test -f {}".format(cfg_file)).failed:
-            currentBakNumber = getLastBackupNumber(cfg_file) + 1
-            sudo("cp {file} {file}.bak{bakNumber}".format(file=cfg_file, bakNumber=currentBakNumber))
+        batch.sudo(backupFileCommand(cfg_file))
 
-    sudo("touch %s" % cfg_file)
+    batch.sudo("touch %s" % cfg_file)
 
     for line in lines:
-        lineNumber = sudo("grep -n -F -x '{line}' '{file}' | cut -d : -f 1".format(line=line, file=cfg_file))
-        try:
-            lineNumber = int(lineNumber)
-            # Line already exists
-            pass
-        except ValueError:
-            sudo("echo '{line}' >> \"{file}\"".format(line=line, file=cfg_file))
+        # Only append lines that aren't there yet
+        batch.sudo("grep -q -F -x '{line}' '{file}' || echo '{line}' >> \"{file}\"".format(line=line, file=cfg_file))
+    batch.execute()
 
 
 def getLastBackupNumber(filePath):
@@ -359,12 +368,36 @@ def getLastBackupNumber(filePath):
     fileName = os.path.basename(filePath)
 
     with cd(dirName):
-        latestBak = sudo("ls -1 | grep %s.bak | tail -n 1" % fileName)
+        latestBak = sudo(lastBackupNumberCommand(fileName))
         latestBakNumber = -1
         if latestBak:
-            latestBakNumber = int(latestBak[len(fileName) + 4:])
+            latestBakNumber = int(latestBak)
         return latestBakNumber
 
+def lastBackupNumberCommand(fileName):
+    # Prints the highest N of the fileName.bakN files in the current directory
+    return ("ls -1 | grep '^%s\\.bak[0-9][0-9]*$' | sed 's/^.*\\.bak//' | sort -n | tail -n 1"
+            % fileName)
+
+def backupFileCommand(filePath, op="cp"):
+    # Same as test -f + getLastBackupNumber + cp/mv, but as a single shell
+    # command so that it can be queued in a CommandBatch.
+    return ("if test -f %(file)s; then "
+            "_bak=`cd %(dir)s && %(last)s`; "
+            "%(op)s %(file)s %(file)s.bak$((${_bak:--1} + 1)); fi" %
+            {"op": op, "file": filePath, "dir": os.path.dirname(filePath) or ".",
+             "last": lastBackupNumberCommand(os.path.basename(filePath))})
+
+def fetchPackage(url, fileName, sha512Url=None):
+    # Downloads url into fileName, resuming partial downloads. An existing
+    # file is only kept if it matches the published checksum or, without
+    # one, the size the server reports.
+    options = ""
+    if sha512Url:
+        options = "--sha512-url {} ".format(sha512Url)
+    put(os.path.join(HELPERS_DIR, "fetchArtifact.py"), "fetchArtifact.py", mode=0o755)
+    run("./fetchArtifact.py {}{} {}".format(options, url, fileName))
+
 CLUSTER_PRIVATE_IPS = {}
 CLUSTER_MASTER_IP = None
 